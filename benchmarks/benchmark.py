@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Benchmark of the cache under contention.
+
+Many processes use the cache at the same time, as the jobs of a workflow
+do. Images are pulled with a fake singularity that waits for a configurable
+time and writes an image of a configurable size. For each number of
+processes and each number of images in the cache two scenarios are run:
+
+hit
+    All images are in the cache. Measures the latency of
+    pull_image_to_cache, and for comparison the latency of cache hits that
+    take the lock of the image, as they did before cache hits were
+    lock-free.
+miss
+    All processes request the same new images at the same time. Measures
+    the throughput, the time spent waiting for locks and the number of
+    duplicate pulls, which should be 0.
+
+The results are written as JSON. With --baseline the results are compared
+with an earlier run and the program exits with status 1 on a regression.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from singularity_permanent_cache import (LOCK_BACKENDS, get_lock_backend,
+                                         open_index, parse_size,
+                                         pull_image_to_cache, store_image,
+                                         uri_to_filename)
+
+FAKE_SINGULARITY = """#!{python}
+import sys
+import time
+
+# Mimics 'singularity pull <destination> <uri>'.
+command, destination, uri = sys.argv[1:4]
+time.sleep({delay!r})
+with open(destination, "wb") as destination_h:
+    destination_h.truncate({size!r})
+with open({log!r}, "at") as log_h:
+    log_h.write(uri + "\\n")
+"""
+
+
+def argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=_int_list, default=[1, 16, 64],
+                        help="Comma-separated numbers of concurrent "
+                             "processes. Default: 1,16,64.")
+    parser.add_argument("--entries", type=_int_list, default=[0, 1000],
+                        help="Comma-separated numbers of images in the "
+                             "cache. Default: 0,1000.")
+    parser.add_argument("--hits", type=int, default=20,
+                        help="Number of cache hits per process. Default: 20.")
+    parser.add_argument("--images", type=int, default=4,
+                        help="Number of new images that all processes "
+                             "request in the miss scenario. Default: 4.")
+    parser.add_argument("--delay", type=float, default=0.5,
+                        help="Seconds that a fake pull takes. Default: 0.5.")
+    parser.add_argument("--size", type=parse_size, default=parse_size("1M"),
+                        help="Size of a pulled image. Default: 1M.")
+    parser.add_argument("--lock-backend", choices=list(LOCK_BACKENDS),
+                        help="The lock backend to benchmark.")
+    parser.add_argument("--dir",
+                        help="Dir in which the caches are created, for "
+                             "instance on the filesystem to benchmark. A "
+                             "temporary dir by default.")
+    parser.add_argument("-o", "--output",
+                        help="File to write the results to. Default: stdout.")
+    parser.add_argument("--baseline",
+                        help="Results of an earlier run to compare with.")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="Factor by which a result may be worse than the "
+                             "baseline. Default: 1.5.")
+    return parser
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(number) for number in value.split(",")]
+
+
+def percentiles(values: Sequence[float]) -> Dict[str, Optional[float]]:
+    """Summarize a distribution with nearest-rank percentiles."""
+    ordered = sorted(values)
+    summary = OrderedDict()  # type: Dict[str, Optional[float]]
+    summary["count"] = len(ordered)
+    if not ordered:
+        for name in ("mean", "p50", "p90", "p99", "max"):
+            summary[name] = None
+        return summary
+    summary["mean"] = sum(ordered) / len(ordered)
+    for percentile in (50, 90, 99):
+        rank = max(0, -(-percentile * len(ordered) // 100) - 1)
+        summary["p{0}".format(percentile)] = ordered[rank]
+    summary["max"] = ordered[-1]
+    return summary
+
+
+def make_fake_singularity(directory: Path, delay: float, size: int) -> Path:
+    exe = Path(directory, "singularity")
+    exe.write_text(FAKE_SINGULARITY.format(
+        python=sys.executable, delay=delay, size=size,
+        log=str(Path(directory, "pulls.log"))))
+    exe.chmod(0o755)
+    return exe
+
+
+def fill_cache(cache: Path, entries: int, lock_backend: Optional[str]):
+    """Add small images to the cache without pulling them."""
+    cache.mkdir(parents=True, exist_ok=True)
+    with open_index(cache, lock_backend) as index:
+        for number in range(entries):
+            uri = "docker://benchmark/filler:{0}".format(number)
+            image_path = Path(cache, uri_to_filename(uri) + ".sif")
+            image_tmp = image_path.with_suffix(".tmp")
+            content = uri.encode()
+            image_tmp.write_bytes(content)
+            store_image(image_path, image_tmp, None, index, uri, lock_backend,
+                        hashlib.sha256(content).hexdigest())
+
+
+def _worker(barrier, uris: List[str], calls: int, cache: str, exe: str,
+            lock_backend: Optional[str], metrics: str, seed: int):
+    uris = list(uris)
+    random.Random(seed).shuffle(uris)
+    barrier.wait()
+    for call in range(calls):
+        pull_image_to_cache(uris[call % len(uris)], Path(cache), exe,
+                            lock_backend, metrics=metrics)
+
+
+def run_processes(processes: int, uris: List[str], calls: int, cache: Path,
+                  exe: Path, lock_backend: Optional[str],
+                  metrics: Path) -> float:
+    """
+    Run processes that each call pull_image_to_cache for the uris, starting
+    at the same time.
+    :return: the time until all processes finished.
+    """
+    barrier = multiprocessing.Barrier(processes + 1)
+    workers = [multiprocessing.Process(
+        target=_worker,
+        args=(barrier, uris, calls, str(cache), str(exe), lock_backend,
+              str(metrics), seed))
+        for seed in range(processes)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.monotonic()
+    for worker in workers:
+        worker.join()
+    wall_time = time.monotonic() - start
+    failed = [worker.exitcode for worker in workers if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError("{0} benchmark processes failed.".format(
+            len(failed)))
+    return wall_time
+
+
+def _locked_worker(barrier, image_paths: List[str], calls: int,
+                   lock_backend: Optional[str], durations, seed: int):
+    image_paths = list(image_paths)
+    random.Random(seed).shuffle(image_paths)
+    lock_class = get_lock_backend(lock_backend)
+    times = []
+    barrier.wait()
+    for call in range(calls):
+        image_path = image_paths[call % len(image_paths)]
+        start = time.monotonic()
+        with lock_class(image_path + ".lock"):
+            Path(image_path).exists()
+        times.append(time.monotonic() - start)
+    durations.put(times)
+
+
+def run_locked_hits(processes: int, image_paths: List[Path], calls: int,
+                    lock_backend: Optional[str]) -> List[float]:
+    """
+    Run processes that each do cache hits on the images with the lock of
+    the image held, starting at the same time.
+    :return: the latency of each cache hit.
+    """
+    barrier = multiprocessing.Barrier(processes + 1)
+    durations = multiprocessing.Queue()  # type: multiprocessing.Queue
+    workers = [multiprocessing.Process(
+        target=_locked_worker,
+        args=(barrier, [str(path) for path in image_paths], calls,
+              lock_backend, durations, seed))
+        for seed in range(processes)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    # The queue is emptied before the processes are joined, because they
+    # only exit after their results are sent.
+    times = [duration for _ in workers for duration in durations.get()]
+    for worker in workers:
+        worker.join()
+    return times
+
+
+def read_metrics(metrics: Path) -> List[Dict]:
+    if not metrics.exists():
+        return []
+    return [json.loads(line) for line in metrics.read_text().splitlines()]
+
+
+def benchmark(args: argparse.Namespace, work_dir: Path) -> List[Dict]:
+    exe = make_fake_singularity(work_dir, args.delay, args.size)
+    pull_log = Path(work_dir, "pulls.log")
+    results = []  # type: List[Dict]
+    for entries in args.entries:
+        cache = Path(work_dir, "cache-{0}".format(entries))
+        fill_cache(cache, entries, args.lock_backend)
+        hit_uris = ["docker://benchmark/hit:{0}".format(number)
+                    for number in range(args.images)]
+        for uri in hit_uris:
+            pull_image_to_cache(uri, cache, str(exe), args.lock_backend)
+        for processes in args.processes:
+            run = "{0}-{1}".format(entries, processes)
+            metrics = Path(work_dir, "hit-{0}.jsonl".format(run))
+            wall_time = run_processes(processes, hit_uris, args.hits, cache,
+                                      exe, args.lock_backend, metrics)
+            records = read_metrics(metrics)
+            locked_latency = run_locked_hits(
+                processes, [Path(cache, uri_to_filename(uri) + ".sif")
+                            for uri in hit_uris],
+                args.hits, args.lock_backend)
+            results.append(OrderedDict([
+                ("scenario", "hit"), ("processes", processes),
+                ("entries", entries), ("wall_time", wall_time),
+                ("latency", percentiles(
+                    [record["duration"] for record in records])),
+                ("locked_latency", percentiles(locked_latency)),
+                ("misses", sum(not record["hit"] for record in records)),
+            ]))
+
+            miss_uris = ["docker://benchmark/miss-{0}:{1}".format(run, number)
+                         for number in range(args.images)]
+            metrics = Path(work_dir, "miss-{0}.jsonl".format(run))
+            wall_time = run_processes(processes, miss_uris, len(miss_uris),
+                                      cache, exe, args.lock_backend, metrics)
+            records = read_metrics(metrics)
+            pulls = sum(line in miss_uris
+                        for line in pull_log.read_text().splitlines())
+            results.append(OrderedDict([
+                ("scenario", "miss"), ("processes", processes),
+                ("entries", entries), ("images", len(miss_uris)),
+                ("wall_time", wall_time),
+                ("throughput", len(miss_uris) / wall_time),
+                ("latency", percentiles(
+                    [record["duration"] for record in records])),
+                ("lock_wait", percentiles(
+                    [record["lock_wait"] for record in records])),
+                ("pulls", pulls),
+                ("duplicate_pulls", pulls - len(miss_uris)),
+            ]))
+            print("{0} images, {1} processes: hit p50 {2:.1f} ms (with "
+                  "lock {3:.1f} ms), miss {4:.2f} s, {5} duplicate pulls"
+                  "".format(entries, processes,
+                            results[-2]["latency"]["p50"] * 1e3,
+                            results[-2]["locked_latency"]["p50"] * 1e3,
+                            wall_time, pulls - len(miss_uris)),
+                  file=sys.stderr)
+    return results
+
+
+def regressions(results: List[Dict], baseline: List[Dict],
+                tolerance: float) -> List[str]:
+    """
+    Compare results with a baseline. The median hit latency and the time to
+    pull the new images are compared. Duplicate pulls are always a
+    regression.
+    :return: a description of each regression.
+    """
+    def key(result):
+        return result["scenario"], result["processes"], result["entries"]
+
+    previous = {key(result): result for result in baseline}
+    found = []
+    for result in results:
+        if result.get("duplicate_pulls"):
+            found.append("{0}: {1} duplicate pulls".format(
+                key(result), result["duplicate_pulls"]))
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        if result["scenario"] == "hit":
+            value, old_value = result["latency"]["p50"], old["latency"]["p50"]
+        else:
+            value, old_value = result["wall_time"], old["wall_time"]
+        if value > old_value * tolerance:
+            found.append("{0}: {1:.4f} s instead of {2:.4f} s".format(
+                key(result), value, old_value))
+    return found
+
+
+def main():
+    args = argument_parser().parse_args()
+    with tempfile.TemporaryDirectory(dir=args.dir) as work_dir:
+        results = benchmark(args, Path(work_dir))
+    report = OrderedDict([
+        ("environment", OrderedDict([
+            ("python", platform.python_version()),
+            ("platform", platform.platform()),
+            ("cpus", os.cpu_count()),
+        ])),
+        ("config", OrderedDict(
+            (name, value) for name, value in sorted(vars(args).items())
+            if name not in ("output", "baseline", "tolerance"))),
+        ("results", results),
+    ])
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        Path(args.output).write_text(output + "\n")
+    if args.baseline is not None:
+        baseline = json.loads(Path(args.baseline).read_text())["results"]
+        found = regressions(results, baseline, args.tolerance)
+        for regression in found:
+            print("Regression: " + regression, file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
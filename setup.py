@@ -51,8 +51,9 @@ setup(
     python_requires=">=3.5",  # Because we use typing.
     entry_points={
         'console_scripts': [
-            'singularity-permanent-cache = singularity_permanent_cache:main',
-            'spc = singularity_permanent_cache:main',
+            'singularity-permanent-cache = '
+            'singularity_permanent_cache.cli:main',
+            'spc = singularity_permanent_cache.cli:main',
         ],
     },
 )
@@ -20,18 +20,134 @@
 
 # This makes the package usable while singularity_permanent_cache.py can also
 # be used as a stand-alone script.
-from .singularity_permanent_cache import (SimpleUnixFileLock,
-                                          get_cache_dir_from_env,
-                                          main,
-                                          pull_image_to_cache,
-                                          singularity_command,
-                                          uri_to_filename)
+#
+# The module is imported when one of its names is used for the first time.
+# This way the command line programs in the cli module start without
+# importing it. Python versions before 3.7 do not support __getattr__ on
+# modules and import it right away.
+import importlib
+import sys
+
+# The same as typing.TYPE_CHECKING, without importing typing. See cli.
+TYPE_CHECKING = False
+if TYPE_CHECKING or sys.version_info < (3, 7):
+    from .singularity_permanent_cache import (CacheIndex,
+                                              CacheServer,
+                                              CacheServerError,
+                                              FETCH_BACKENDS,
+                                              FetchError,
+                                              LOCK_BACKENDS,
+                                              LeaseFileLock,
+                                              LockTimeoutError,
+                                              PosixFileLock,
+                                              PullFailedError,
+                                              SimpleUnixFileLock,
+                                              copy_file,
+                                              default_socket_path,
+                                              evict_images,
+                                              export_images,
+                                              fetch_file,
+                                              fetch_http,
+                                              fetch_with_singularity,
+                                              filename_to_uri,
+                                              get_cache_dir_from_env,
+                                              get_check_hits_from_env,
+                                              get_fetch_backend,
+                                              get_local_max_size_from_env,
+                                              get_lock_backend,
+                                              get_lock_timeout_from_env,
+                                              get_max_size_from_env,
+                                              get_retries_from_env,
+                                              get_socket_path,
+                                              image_digest,
+                                              import_images,
+                                              lookup_images,
+                                              main,
+                                              migrate_cache,
+                                              open_index,
+                                              parse_duration,
+                                              parse_size,
+                                              pin_images,
+                                              pull_image_to_cache,
+                                              pull_image_to_cache_async,
+                                              pull_images_to_cache,
+                                              pull_images_to_cache_async,
+                                              request_image,
+                                              resolve_images,
+                                              serve,
+                                              sha256_file,
+                                              singularity_command,
+                                              singularity_command_async,
+                                              store_image,
+                                              unpin_images,
+                                              uri_to_filename,
+                                              verify_cache,
+                                              write_metrics)
 
 __all__ = [
+    "CacheIndex",
+    "CacheServer",
+    "CacheServerError",
+    "FETCH_BACKENDS",
+    "FetchError",
+    "LOCK_BACKENDS",
+    "LeaseFileLock",
+    "LockTimeoutError",
+    "PosixFileLock",
+    "PullFailedError",
     "SimpleUnixFileLock",
+    "copy_file",
+    "default_socket_path",
+    "evict_images",
+    "export_images",
+    "fetch_file",
+    "fetch_http",
+    "fetch_with_singularity",
+    "filename_to_uri",
     "get_cache_dir_from_env",
+    "get_check_hits_from_env",
+    "get_fetch_backend",
+    "get_local_max_size_from_env",
+    "get_lock_backend",
+    "get_lock_timeout_from_env",
+    "get_max_size_from_env",
+    "get_retries_from_env",
+    "get_socket_path",
+    "image_digest",
+    "import_images",
+    "lookup_images",
     "main",
+    "migrate_cache",
+    "open_index",
+    "parse_duration",
+    "parse_size",
+    "pin_images",
     "pull_image_to_cache",
+    "pull_image_to_cache_async",
+    "pull_images_to_cache",
+    "pull_images_to_cache_async",
+    "request_image",
+    "resolve_images",
+    "serve",
+    "sha256_file",
     "singularity_command",
-    "uri_to_filename"
+    "singularity_command_async",
+    "store_image",
+    "unpin_images",
+    "uri_to_filename",
+    "verify_cache",
+    "write_metrics"
 ]
+
+
+def __getattr__(name):
+    if name not in __all__ and name != "singularity_permanent_cache":
+        raise AttributeError("module {0!r} has no attribute {1!r}"
+                             "".format(__name__, name))
+    module = importlib.import_module(".singularity_permanent_cache",
+                                     __name__)
+    if name == "singularity_permanent_cache":
+        return module
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,272 @@
+# Copyright (c) 2020 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The entry point of the command line programs.
+
+The programs are usually run once for every job of a workflow and almost
+always for an image that is in the cache already. Starting the interpreter
+and importing argparse, logging, subprocess and the other modules that are
+needed to pull images takes much longer than finding the image. This module
+therefore only imports os and sys and answers cache hits of a single image
+and lookups in a manifest by itself. Everything else is handled by the main
+function of the singularity_permanent_cache module, which is only imported
+when needed.
+"""
+
+import os
+import sys
+import time
+
+# The same as typing.TYPE_CHECKING, which type checkers treat as True.
+# Importing typing would take longer than answering a cache hit.
+TYPE_CHECKING = False
+if TYPE_CHECKING:  # pragma: no cover
+    from typing import List, Optional, Tuple  # noqa: F401, I300
+
+# These copies of the constants and functions in singularity_permanent_cache
+# keep this module free of its imports. The test suite checks that they are
+# the same.
+COMMANDS = ("list", "info", "gc", "pin", "unpin", "migrate", "serve",
+            "export", "import", "verify", "resolve", "lookup")
+INDEX_FILE = ".index.sqlite"
+FILENAME_SAFE_CHARACTERS = frozenset(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._@+=,")
+MAX_FILENAME_LENGTH = 200
+HASHED_FILENAME_PREFIX = "sha256~"
+ACCESS_TIME_RESOLUTION = 60.0
+# Options that only matter when an image is pulled, with their types.
+PULL_OPTIONS = {"-s": str, "--singularity-exe": str, "--lock-timeout": float,
+                "--retries": int}
+
+
+def uri_to_filename(uri):
+    # type: (str) -> str
+    filename = "".join(
+        character if character in FILENAME_SAFE_CHARACTERS else
+        "".join("%{0:02X}".format(byte) for byte in character.encode())
+        for character in uri)
+    if filename.startswith("."):
+        filename = "%2E" + filename[1:]
+    if len(filename) > MAX_FILENAME_LENGTH:
+        # Only import hashlib for the few URIs that need it.
+        import hashlib
+        return (HASHED_FILENAME_PREFIX +
+                hashlib.sha256(uri.encode()).hexdigest())
+    return filename
+
+
+def cache_dir_from_env():
+    # type: () -> str
+    singularity_permanentcachedir = os.environ.get(
+        "SINGULARITY_PERMANENTCACHEDIR")
+    singularity_cachedir = os.environ.get("SINGULARITY_CACHEDIR")
+    if singularity_permanentcachedir:
+        return singularity_permanentcachedir
+    if singularity_cachedir:
+        return os.path.join(singularity_cachedir, "permanent_cache")
+    raise OSError("Cannot determine a permanent cache dir from the "
+                  "environment.")
+
+
+def check_hits_from_env():
+    # type: () -> bool
+    return os.environ.get("SINGULARITY_PERMANENTCACHE_CHECK_HITS",
+                          "").lower() in ("1", "true", "yes", "on")
+
+
+def normalize_path(path):
+    # type: (str) -> str
+    """Normalize a path in the same way as str(pathlib.Path(path))."""
+    root = ""
+    if path.startswith("//") and not path.startswith("///"):
+        root = "//"
+    elif path.startswith("/"):
+        root = "/"
+    parts = [part for part in path.split("/") if part not in ("", ".")]
+    return (root + "/".join(parts)) or "."
+
+
+def parse_hit_arguments(argv):
+    # type: (List[str]) -> Optional[Tuple[str, Optional[str]]]
+    """
+    Get the image URI and cache dir from a command line that only asks for
+    the location of a single image.
+    :param argv: the command line arguments, without the program name.
+    :return: a tuple of the URI and the cache dir, which is None if it
+             was not given. None if the command line does anything else.
+    """
+    uri = None
+    cache_dirs = []  # type: List[str]
+    arguments = iter(argv)
+    for argument in arguments:
+        if argument in ("-d", "--cache-dir"):
+            cache_dir = next(arguments, None)
+            if cache_dir is None:
+                return None
+            cache_dirs.append(cache_dir)
+        elif argument.startswith("--cache-dir="):
+            cache_dirs.append(argument[len("--cache-dir="):])
+        elif argument in PULL_OPTIONS:
+            value = next(arguments, None)
+            if value is None:
+                return None
+            # Invalid values are reported by the full program.
+            try:
+                PULL_OPTIONS[argument](value)
+            except ValueError:
+                return None
+        elif argument.startswith("-") or uri is not None:
+            return None
+        else:
+            uri = argument
+    if uri is None or uri in COMMANDS:
+        return None
+    # Images are returned from the first tier of the cache.
+    return uri, cache_dirs[0] if cache_dirs else None
+
+
+def parse_lookup_arguments(argv):
+    # type: (List[str]) -> Optional[Tuple[str, List[str]]]
+    """
+    Get the manifest and image URIs from a lookup command line.
+    :param argv: the command line arguments, without the program name.
+    :return: a tuple of the manifest and the URIs. None if the command line
+             is not a valid lookup.
+    """
+    if not argv or argv[0] != "lookup":
+        return None
+    manifest = None
+    uris = []  # type: List[str]
+    arguments = iter(argv[1:])
+    for argument in arguments:
+        if argument == "--manifest":
+            manifest = next(arguments, None)
+            if manifest is None:
+                return None
+        elif argument.startswith("--manifest="):
+            manifest = argument[len("--manifest="):]
+        elif argument.startswith("-"):
+            return None
+        else:
+            uris.append(argument)
+    if manifest is None or not uris:
+        return None
+    return manifest, uris
+
+
+def manifest_lookup(manifest, uris):
+    # type: (str, List[str]) -> Optional[List[str]]
+    """
+    Find images in a manifest that was written by the resolve command.
+    :param manifest: the manifest file.
+    :param uris: the uris of the images.
+    :return: the locations of the images, or None if the manifest cannot be
+             read or does not contain all images.
+    """
+    import json
+    try:
+        with open(manifest) as manifest_h:
+            images = json.load(manifest_h)["images"]
+        return [images[uri]["path"] for uri in uris]
+    except (OSError, ValueError, KeyError, TypeError):
+        # Errors are reported by the full program.
+        return None
+
+
+def cache_hit(uri, cache_dir=None):
+    # type: (str, Optional[str]) -> Optional[str]
+    """
+    Find an image in the cache without pulling it or writing to the cache.
+    :param uri: the uri of the image.
+    :param cache_dir: the cache dir. If not given, the location from the
+                      environment is used.
+    :return: the location of the image, or None if the image is not in the
+             cache, its last access time in the cache index has to be
+             updated or it does not match the index when hits are checked.
+    """
+    if os.environ.get("SINGULARITY_PERMANENTCACHE_METRICS"):
+        # Hits are recorded in the metrics as well.
+        return None
+    try:
+        cache = cache_dir if cache_dir is not None else cache_dir_from_env()
+    except OSError:
+        return None
+    # The same location as pull_image_to_cache returns.
+    image_path = normalize_path(
+        cache + "/" + uri_to_filename(uri) + ".sif")
+    index_path = os.path.join(cache, INDEX_FILE)
+    if not (os.path.exists(image_path) and os.path.exists(index_path)):
+        return None
+    # Only import sqlite3 once the image is known to exist.
+    import sqlite3
+    try:
+        connection = sqlite3.connect(index_path, timeout=0.1)
+        try:
+            row = connection.execute(
+                "SELECT path, accessed, size, mtime FROM images "
+                "WHERE uri = ?", (uri,)).fetchone()
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return None
+    # The access time is used to remove the least recently used images, so
+    # an image whose access time is outdated is left to the full program,
+    # which updates it. With ACCESS_TIME_RESOLUTION this happens at most
+    # once per minute for every image.
+    if (row is None or row[0] != os.path.basename(image_path) or
+            (row[1] or 0) < time.time() - ACCESS_TIME_RESOLUTION):
+        return None
+    # Images are only removed after they are renamed, so the image may have
+    # been removed since the first check.
+    try:
+        stat = os.stat(image_path)
+    except OSError:
+        return None
+    # Images that do not match are quarantined by the full program.
+    if (check_hits_from_env() and row[3] is not None and
+            (stat.st_size != row[2] or stat.st_mtime != row[3])):
+        return None
+    return image_path
+
+
+def main():
+    # type: () -> None
+    lookup = parse_lookup_arguments(sys.argv[1:])
+    if lookup is not None:
+        manifest, uris = lookup
+        image_paths = manifest_lookup(manifest, uris)
+        if image_paths is not None:
+            # The same output as the lookup command.
+            if len(uris) == 1:
+                sys.stdout.write(image_paths[0])
+            else:
+                sys.stdout.write("".join(
+                    "{0}\t{1}\n".format(uri, path)
+                    for uri, path in zip(uris, image_paths)))
+            return
+    arguments = parse_hit_arguments(sys.argv[1:])
+    if arguments is not None:
+        image_path = cache_hit(*arguments)
+        if image_path is not None:
+            sys.stdout.write(image_path)
+            return
+    from .singularity_permanent_cache import main as full_main
+    full_main()
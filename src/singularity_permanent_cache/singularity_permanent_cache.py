@@ -21,15 +21,158 @@
 # SOFTWARE.
 
 import argparse
+import asyncio
+import errno
 import fcntl
+import glob
+import hashlib
+import http.client
+import io
+import itertools
+import json
 import logging
 import os
+import random
+import re
+import shutil
+import signal
+import socket
+import socketserver
+import sqlite3
+import stat
+import struct
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import (Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from pathlib import Path
-from typing import Optional
+from typing import (BinaryIO, Callable, Dict, Iterable, Iterator, List,
+                    Optional, Sequence, Tuple, Union, cast)
+
+# A cache dir, or cache dirs (tiers) with the fastest first.
+CacheLocation = Union[Path, Sequence[Path]]
 
 DEFAULT_SINGULARITY_EXE = "singularity"
+DEFAULT_JOBS = 4
+DEFAULT_LOCK_BACKEND = "flock"
+# Seconds after which a lease that is not refreshed is considered stale.
+DEFAULT_LEASE_STALE_AFTER = 120.0
+# Locks with a timeout are polled. The interval between attempts starts at
+# the first value and is doubled after each attempt up to the second.
+LOCK_POLL_INTERVAL = 0.01
+LOCK_MAX_POLL_INTERVAL = 1.0
+# ioctl that makes a file share the data of another file (a reflink) on
+# filesystems that support it, such as Btrfs and XFS. From linux/fs.h.
+FICLONE = 0x40049409
+# Errors of copy_file_range and sendfile when they can not copy between two
+# files, after which the next method is tried.
+COPY_UNSUPPORTED_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                           errno.EOPNOTSUPP, errno.ENOTSOCK, errno.EBADF)
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+# Images are read in blocks of this size to calculate their checksums.
+HASH_BUFFER_SIZE = 8 * 1024 * 1024
+# Seconds without data after which an HTTP download is interrupted.
+HTTP_TIMEOUT = 60.0
+# Number of times an interrupted HTTP download is resumed.
+HTTP_MAX_RESUMES = 10
+# HTTP client errors after which a download is retried: Too Many Requests.
+# Other client errors, such as Not Found, are not retried.
+HTTP_RETRYABLE_CLIENT_ERRORS = frozenset([429])
+# Number of times a failed pull is retried.
+DEFAULT_RETRIES = 2
+# Failed pulls are retried after a random delay of up to this many seconds,
+# which is doubled after each attempt.
+RETRY_BACKOFF = 5.0
+# Names of the commands that manage the cache. Anything else on the command
+# line is an image URI.
+COMMANDS = ("list", "info", "gc", "pin", "unpin", "migrate", "serve",
+            "export", "import", "verify", "resolve", "lookup")
+INDEX_FILE = ".index.sqlite"
+# Characters that are used as they are in the filenames of images. Other
+# characters are escaped as in URLs.
+FILENAME_SAFE_CHARACTERS = frozenset(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._@+=,")
+# Longer filenames are replaced by the checksum of the URI, with the prefix.
+# This leaves room for suffixes such as '.sif.<uuid>.tmp' within the limit
+# of 255 bytes of most filesystems.
+MAX_FILENAME_LENGTH = 200
+HASHED_FILENAME_PREFIX = "sha256~"
+# Corrupt images are moved to this dir in the cache.
+QUARANTINE_DIR = "quarantine"
+# The last access time of an image in the index is updated at most once per
+# this many seconds.
+ACCESS_TIME_RESOLUTION = 60.0
+# Seconds that SQLite waits for a lock on the index. Cache hits do not wait:
+# they skip updating the index when another process is writing to it.
+INDEX_TIMEOUT = 60.0
+CACHE_HIT_INDEX_TIMEOUT = 0.0
+# Images that were used less than this many seconds ago are not evicted, so
+# an image is not removed right after its location was given to a job.
+EVICTION_MIN_AGE = 3600.0
+# Images in a manifest are pinned for this many seconds by default, which
+# should be longer than a workflow runs.
+DEFAULT_MANIFEST_PIN = 7 * 24 * 3600.0
+# Number of lines of singularity output that are kept for error messages.
+OUTPUT_TAIL_LINES = 100
+MAX_OUTPUT_LINE_LENGTH = 4096
+# Images that are addressed by digest, such as docker://debian@sha256:<hex>.
+IMAGE_DIGEST_PATTERN = re.compile(
+    r"@sha256(?::|_|%3A)([0-9a-f]{64})(\.sif)?$")
+
+
+def common_argument_parser(tiers: bool = False) -> argparse.ArgumentParser:
+    """
+    Arguments that are shared by all commands.
+    :param tiers: whether multiple cache dirs can be given.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    if tiers:
+        parser.add_argument("-d", "--cache-dir", action="append",
+                            help="Path to the cache location. Uses the "
+                                 "SINGULARITY_PERMANENTCACHEDIR, "
+                                 "or SINGULARITY_CACHEDIR environment "
+                                 "variable by default. Can be given "
+                                 "multiple times for a cache with tiers, "
+                                 "fastest first. For example a cache on a "
+                                 "local disk and a cache on a shared "
+                                 "filesystem. Images that are not in a tier "
+                                 "are copied from the next tier, only the "
+                                 "last tier pulls images. The location in "
+                                 "the first tier is returned.")
+    else:
+        parser.add_argument("-d", "--cache-dir", required=False,
+                            help="Path to the cache location. Uses the "
+                                 "SINGULARITY_PERMANENTCACHEDIR, "
+                                 "or SINGULARITY_CACHEDIR environment "
+                                 "variable by default.")
+    parser.add_argument("--lock-backend", choices=list(LOCK_BACKENDS),
+                        help="How the cache is locked. 'flock' only works "
+                             "for processes on the same machine. 'lockf' "
+                             "uses POSIX locks which work across machines on "
+                             "network filesystems that support them, such as "
+                             "NFS. 'lease' uses lease files which work on any "
+                             "shared filesystem. Uses the "
+                             "SINGULARITY_PERMANENTCACHE_LOCK_BACKEND "
+                             "environment variable or 'flock' by default.")
+    parser.add_argument("-v", "--verbose", action="count", default=0,
+                        help="Increase log verbosity. Can be used multiple "
+                             "times.")
+    parser.add_argument("-q", "--quiet", action="count", default=0,
+                        help="Decrease log verbosity. Can be used multiple "
+                             "times."
+                        )
+    return parser
 
 
 def argument_parser() -> argparse.ArgumentParser:
@@ -38,26 +181,255 @@ def argument_parser() -> argparse.ArgumentParser:
                     "images. Returns the location of the image in the cache. "
                     "WARNING: This program will never check if a "
                     "newer image is available. Make sure unique tags or "
-                    "hashes are used!")
-    parser.add_argument("uri", metavar="<IMAGE>", type=str,
+                    "hashes are used!",
+        epilog="Commands to manage the cache: {0}. Use "
+               "'<command> --help' for more information."
+               "".format(", ".join(COMMANDS)),
+        parents=[common_argument_parser(tiers=True)])
+    parser.add_argument("uris", metavar="<IMAGE>", type=str, nargs="*",
                         help="The singularity URI to the image. For example: "
-                             "'docker://debian:buster-slim'")
-    parser.add_argument("-d", "--cache-dir", required=False,
-                        help="Path to the cache location. Uses the "
-                             "SINGULARITY_PERMANENTCACHEDIR, "
-                             "or SINGULARITY_CACHEDIR environment variable "
-                             "by default.")
+                             "'docker://debian:buster-slim'. Multiple URIs "
+                             "can be given.")
     parser.add_argument("-s", "--singularity-exe", type=str,
                         default=DEFAULT_SINGULARITY_EXE,
                         help="Path to singularity executable.")
+    parser.add_argument("-f", "--from-file", type=str,
+                        help="Read URIs from this file, one per line. Use "
+                             "'-' to read from stdin.")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                        help="Maximum number of images that are pulled at "
+                             "the same time. Default: {0}."
+                             "".format(DEFAULT_JOBS))
+    parser.add_argument("--output-format", choices=["tsv", "json"],
+                        default="tsv",
+                        help="Output format when multiple URIs are given. "
+                             "'tsv' prints the URI and the image location "
+                             "separated by a tab on each line. 'json' prints "
+                             "a mapping of URIs to image locations. "
+                             "Default: tsv.")
+    parser.add_argument("--max-size", type=parse_size,
+                        help="Maximum size of the cache, for example '500G'. "
+                             "When a pull makes the cache larger, the least "
+                             "recently used images are removed. Uses the "
+                             "SINGULARITY_PERMANENTCACHE_MAX_SIZE environment "
+                             "variable by default.")
+    parser.add_argument("--check-hits", action="store_const", const=True,
+                        help="Check the size and modification time of "
+                             "images in the cache against the cache index "
+                             "before they are returned. Images that do not "
+                             "match are moved to the quarantine dir of the "
+                             "cache and pulled again. Use the verify command "
+                             "to check the contents of all images. Uses the "
+                             "SINGULARITY_PERMANENTCACHE_CHECK_HITS "
+                             "environment variable by default.")
+    parser.add_argument("--local-max-size", type=parse_size,
+                        help="Maximum size of each cache tier except the "
+                             "last, for example '100G'. Uses the "
+                             "SINGULARITY_PERMANENTCACHE_LOCAL_MAX_SIZE "
+                             "environment variable by default.")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="Append metrics for each image as a line of "
+                             "JSON to this file: cache hit or miss, time "
+                             "spent waiting for locks and pulling, and bytes "
+                             "pulled. Use /dev/fd/<N> to write to a file "
+                             "descriptor. Uses the "
+                             "SINGULARITY_PERMANENTCACHE_METRICS environment "
+                             "variable by default.")
+    parser.add_argument("--lock-timeout", type=float, metavar="SECONDS",
+                        help="Maximum time to wait for another process that "
+                             "pulls the same image. Use 0 to fail right away "
+                             "when the image is being pulled. The program "
+                             "exits with status {0} when the timeout "
+                             "expires, so the job can be retried later. Uses "
+                             "the SINGULARITY_PERMANENTCACHE_LOCK_TIMEOUT "
+                             "environment variable or no timeout by default."
+                             "".format(os.EX_TEMPFAIL))
+    parser.add_argument("--retries", type=int,
+                        help="Number of times a failed pull is retried, "
+                             "after a random delay that doubles after each "
+                             "attempt. Processes that wait for a pull of the "
+                             "same image that fails do not retry it "
+                             "themselves, but fail as well. Uses the "
+                             "SINGULARITY_PERMANENTCACHE_RETRIES environment "
+                             "variable or {0} by default."
+                             "".format(DEFAULT_RETRIES))
+    parser.add_argument("--socket",
+                        help="Socket of a cache server started with 'serve'. "
+                             "The server is used when the socket exists. It "
+                             "pulls images with the --max-size, --check-hits "
+                             "and --retries of this command, and its own "
+                             "other options. Images are only pulled without "
+                             "the server when no server is running on the "
+                             "socket. "
+                             "Only sockets of servers of the same user are "
+                             "used. Uses the "
+                             "SINGULARITY_PERMANENTCACHE_SOCKET environment "
+                             "variable or a socket that is "
+                             "specific to the cache dir in a private dir of "
+                             "the user by default.")
     parser.add_argument("--which-cache", action=_WhichCacheAction)
-    parser.add_argument("-v", "--verbose", action="count", default=0,
-                        help="Increase log verbosity. Can be used multiple "
-                             "times.")
-    parser.add_argument("-q", "--quiet", action="count", default=0,
-                        help="Decrease log verbosity. Can be used multiple "
-                             "times."
-                        )
+    return parser
+
+
+def command_parser() -> argparse.ArgumentParser:
+    """Parser for the commands that manage the cache."""
+    parser = argparse.ArgumentParser(
+        description="Commands to manage the permanent cache.")
+    subparsers = parser.add_subparsers(dest="command", metavar="<command>")
+    common = common_argument_parser()
+    list_parser = subparsers.add_parser(
+        "list", parents=[common], help="List the images in the cache.",
+        description="List the images in the cache index. Prints the URI, "
+                    "size in bytes, last access time and location of each "
+                    "image.")
+    list_parser.add_argument("--output-format", choices=["tsv", "json"],
+                             default="tsv", help="Default: tsv.")
+    list_parser.set_defaults(func=list_command)
+    info = subparsers.add_parser(
+        "info", parents=[common], help="Show information about an image.",
+        description="Show the cache index entry of an image as JSON.")
+    info.add_argument("uri", metavar="<IMAGE>",
+                      help="The singularity URI to the image.")
+    info.set_defaults(func=info_command)
+    gc = subparsers.add_parser(
+        "gc", parents=[common],
+        help="Remove the least recently used images.",
+        description="Remove the least recently used images until the cache "
+                    "is not larger than the maximum size. Pinned images and "
+                    "images that were used in the last {0:.0f} minutes are "
+                    "kept. Prints the URIs of the removed images."
+                    "".format(EVICTION_MIN_AGE / 60))
+    gc.add_argument("--max-size", type=parse_size,
+                    help="Maximum size of the cache, for example '500G'. "
+                         "Uses the SINGULARITY_PERMANENTCACHE_MAX_SIZE "
+                         "environment variable by default.")
+    gc.set_defaults(func=gc_command)
+    for name, func, description in (
+            ("pin", pin_command, "Protect images from removal by gc."),
+            ("unpin", unpin_command, "Allow removal of images by gc.")):
+        pin = subparsers.add_parser(name, parents=[common], help=description,
+                                    description=description)
+        pin.add_argument("uris", metavar="<IMAGE>", nargs="+",
+                         help="The singularity URI to the image.")
+        pin.set_defaults(func=func)
+    migrate = subparsers.add_parser(
+        "migrate", parents=[common],
+        help="Migrate images stored by older versions.",
+        description="Move images that were stored as plain files by older "
+                    "versions into the content-addressed store and rename "
+                    "images that have filenames of older versions. "
+                    "Identical images are stored only once. No images are "
+                    "pulled.")
+    migrate.set_defaults(func=migrate_command)
+    export = subparsers.add_parser(
+        "export", parents=[common],
+        help="Write images to a bundle for another cache.",
+        description="Write images from the cache with their URIs and "
+                    "checksums to a bundle, which can be imported in a "
+                    "cache that cannot pull them. The bundle is a tar "
+                    "stream, so it can be written to a pipe.")
+    export.add_argument("uris", metavar="<IMAGE>", nargs="+",
+                        help="The singularity URI to the image.")
+    export.add_argument("-o", "--output", required=True, metavar="BUNDLE",
+                        help="File to write the bundle to. Use '-' for "
+                             "stdout.")
+    export.set_defaults(func=export_command)
+    import_parser = subparsers.add_parser(
+        "import", parents=[common], help="Add the images in a bundle.",
+        description="Add the images in a bundle that was written by "
+                    "export to the cache. Images are added in the same way "
+                    "as pulled images, so the cache can be used meanwhile. "
+                    "Images that are in the cache already are skipped. "
+                    "Prints the URI and location of each image.")
+    import_parser.add_argument("bundle", metavar="BUNDLE",
+                               help="The bundle. Use '-' for stdin.")
+    import_parser.add_argument("--lock-timeout", type=float,
+                               metavar="SECONDS",
+                               help="Maximum time to wait for the lock of "
+                                    "each image. See --lock-timeout of the "
+                                    "main program.")
+    import_parser.set_defaults(func=import_command)
+    verify = subparsers.add_parser(
+        "verify", parents=[common],
+        help="Check the checksums of all images.",
+        description="Check the sha256 checksums of all images in the "
+                    "cache. Corrupt images are moved to the '{0}' dir of "
+                    "the cache and pulled again when they are used. Prints "
+                    "the URIs of the corrupt images and exits with status 1 "
+                    "when there are any.".format(QUARANTINE_DIR))
+    verify.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                        help="Number of images that are read at the same "
+                             "time. Default: {0}.".format(DEFAULT_JOBS))
+    verify.set_defaults(func=verify_command)
+    resolve = subparsers.add_parser(
+        "resolve", parents=[common_argument_parser(tiers=True)],
+        help="Pull images and write a manifest of their locations.",
+        description="Make sure images are in the cache and write a "
+                    "manifest with the location and digest of each image. "
+                    "The jobs of a workflow can then find the images with "
+                    "'lookup', which only reads the manifest. The images "
+                    "are pinned, so they are not removed by gc while the "
+                    "workflow runs.")
+    resolve.add_argument("uris", metavar="<IMAGE>", nargs="+",
+                         help="The singularity URI to the image.")
+    resolve.add_argument("--manifest", required=True, metavar="FILE",
+                         help="File to write the manifest to.")
+    resolve.add_argument("-s", "--singularity-exe", type=str,
+                         default=DEFAULT_SINGULARITY_EXE,
+                         help="Path to singularity executable.")
+    resolve.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                         help="Maximum number of images that are pulled at "
+                              "the same time. Default: {0}."
+                              "".format(DEFAULT_JOBS))
+    resolve.add_argument("--pin-for", type=parse_duration,
+                         default=DEFAULT_MANIFEST_PIN, metavar="DURATION",
+                         help="How long the images are pinned, for example "
+                              "'12h' or '3d'. Use 0 to not pin them. "
+                              "Default: {0:.0f}d."
+                              "".format(DEFAULT_MANIFEST_PIN / 86400))
+    resolve.set_defaults(func=resolve_command)
+    lookup = subparsers.add_parser(
+        "lookup", help="Look up images in a manifest.",
+        description="Print the location of images in a manifest that was "
+                    "written by 'resolve'. Only the manifest is read. A "
+                    "single image prints only its location, multiple images "
+                    "print the URI and location of each image.")
+    lookup.add_argument("uris", metavar="<IMAGE>", nargs="+",
+                        help="The singularity URI to the image.")
+    lookup.add_argument("--manifest", required=True, metavar="FILE",
+                        help="The manifest file.")
+    # No cache is used, so none of the common arguments apply.
+    lookup.set_defaults(func=lookup_command, verbose=0, quiet=0)
+    serve_parser = subparsers.add_parser(
+        "serve", parents=[common_argument_parser(tiers=True)],
+        help="Run a cache server.",
+        description="Run a cache server for this machine. The server keeps "
+                    "the image locations in memory and pulls each image "
+                    "only once for concurrent requests. "
+                    "singularity-permanent-cache uses the server when its "
+                    "socket exists and pulls images itself otherwise. Stop "
+                    "the server with SIGINT or SIGTERM.")
+    serve_parser.add_argument("--socket",
+                              help="Socket to listen on. Only the user "
+                                   "that runs the server can use it. Uses "
+                                   "the SINGULARITY_PERMANENTCACHE_SOCKET "
+                                   "environment variable or a socket that is "
+                                   "specific to the cache dir in a private "
+                                   "dir of the user by default.")
+    serve_parser.add_argument("-s", "--singularity-exe", type=str,
+                              default=DEFAULT_SINGULARITY_EXE,
+                              help="Path to singularity executable.")
+    serve_parser.add_argument("--max-size", type=parse_size,
+                              help="Maximum size of the cache. See "
+                                   "--max-size of the main program.")
+    serve_parser.add_argument("--local-max-size", type=parse_size,
+                              help="Maximum size of each cache tier except "
+                                   "the last. See --local-max-size of the "
+                                   "main program.")
+    serve_parser.add_argument("--metrics", metavar="FILE",
+                              help="Append metrics for each pull to this "
+                                   "file. See --metrics of the main program.")
+    serve_parser.set_defaults(func=serve_command)
     return parser
 
 
@@ -113,6 +485,54 @@ class _WhichCacheAction(argparse.Action):
         parser.exit(status)
 
 
+class LockTimeoutError(TimeoutError):
+    """
+    Raised when a lock could not be acquired within its timeout. The holder
+    attribute describes the process that held the lock, if known.
+    """
+    def __init__(self, file: str, holder: Optional[Dict] = None):
+        super().__init__("Could not acquire the lock on {0}. It is held by "
+                         "{1}.".format(file, _describe_holder(holder)))
+        self.file = file
+        self.holder = holder
+
+
+def _describe_holder(holder: Optional[Dict]) -> str:
+    if not holder:
+        return "an unknown process"
+    return "process {0} on {1} for {2} since {3}".format(
+        holder.get("pid"), holder.get("host"), holder.get("uri") or "-",
+        _format_time(holder.get("started")))
+
+
+def _lock_holder(content: bytes) -> Optional[Dict]:
+    try:
+        holder = json.loads(content.decode())
+    except ValueError:  # Empty, or still being written.
+        return None
+    return holder if isinstance(holder, dict) else None
+
+
+def _poll_intervals(timeout: Optional[float],
+                    max_interval: float = LOCK_MAX_POLL_INTERVAL
+                    ) -> Iterator[float]:
+    """
+    Intervals to wait between attempts to acquire a lock. The intervals
+    grow exponentially and end when the timeout expires.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    interval = min(LOCK_POLL_INTERVAL, max_interval)
+    while True:
+        if deadline is None:
+            yield interval
+        else:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            yield min(interval, remaining)
+        interval = min(interval * 2, max_interval)
+
+
 class SimpleUnixFileLock:
     """
     Simple UNIX filelock. Uses fnctl.flock for locking a file. Implementation
@@ -120,113 +540,3173 @@ class SimpleUnixFileLock:
     is simpler and does not have all the features. Huge thanks to
     @benediktschmitt & contributors for this filelock example which they made
     Public Domain.
+
+    Without a timeout the lock waits until it is acquired. With a timeout,
+    acquiring the lock is retried with exponentially growing intervals and
+    LockTimeoutError is raised when it expires. A timeout of 0 tries to
+    acquire the lock only once.
+
+    The holder writes its hostname, PID, the URI it works on and the time
+    it acquired the lock into the lock file, so waiting processes can tell
+    who they are waiting for.
     """
-    def __init__(self, file: str):
+    def __init__(self, file: str, timeout: Optional[float] = None,
+                 uri: Optional[str] = None):
         self._file = file
-        self._fd = None
-        # Open mode is a combination of RDWR CREATE and TRUNC. By using bitwise
-        # or symbol (|).
-        self.open_mode = os.O_RDWR | os.O_CREAT | os.O_TRUNC
+        self._fd = None  # type: Optional[int]
+        self.timeout = timeout
+        self.uri = uri
+        # The lock file is not truncated on opening, as it contains the
+        # information about the current holder.
+        self.open_mode = os.O_RDWR | os.O_CREAT
         self.log = logging.getLogger()
 
+    def _lock(self, blocking: bool = True) -> bool:
+        try:
+            # Exclusive lock
+            fcntl.flock(cast(int, self._fd), fcntl.LOCK_EX |
+                        (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return False
+        return True
+
+    def _unlock(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def holder(self) -> Optional[Dict]:
+        """
+        Information about the process that holds or last held the lock, or
+        None if it is not known.
+        """
+        try:
+            with open(self._file, "rb") as file_h:
+                return _lock_holder(file_h.read(4096))
+        except OSError:
+            return None
+
+    def _attempts(self, timeout: Optional[float]) -> Iterator[float]:
+        # Tries to acquire the lock. Yields the time to wait before each next
+        # attempt, so the caller decides how to wait.
+        if self._lock(blocking=False):
+            return
+        self.log.info("Lock {0} is held by {1}.".format(
+            self._file, _describe_holder(self.holder())))
+        for interval in _poll_intervals(timeout):
+            yield interval
+            if self._lock(blocking=False):
+                return
+        raise LockTimeoutError(self._file, self.holder())
+
+    def _acquire(self, timeout: Optional[float]):
+        for interval in self._attempts(timeout):
+            if timeout is None:
+                # Without a timeout the kernel does the waiting.
+                self._lock()
+                return
+            time.sleep(interval)
+
     def __enter__(self):
+        self._enter(self.timeout)
+
+    def _enter(self, timeout: Optional[float]):
+        self._open()
+        try:
+            self._acquire(timeout)
+        except BaseException:
+            os.close(cast(int, self._fd))
+            raise
+        self._acquired()
+
+    def _entering(self, timeout: Optional[float]) -> Iterator[float]:
+        # Acquires the lock like __enter__, but yields the time to wait
+        # between attempts instead of sleeping. Used to wait for the lock in
+        # an event loop.
+        self._open()
+        try:
+            yield from self._attempts(timeout)
+        except BaseException:
+            os.close(cast(int, self._fd))
+            raise
+        self._acquired()
+
+    def _open(self):
         # Use os.open because it is much faster than python open.  It also only
         # returns a file descriptor. Which is all that we need for locking.
         self._fd = os.open(self._file, self.open_mode)
         self.log.info("Waiting for file lock on: {0}".format(self._file))
-        fcntl.flock(self._fd, fcntl.LOCK_EX)  # Exclusive lock, blocking
+
+    def _acquired(self) -> Dict:
+        holder = dict(host=socket.gethostname(), pid=os.getpid(),
+                      uri=self.uri, started=time.time())
+        fd = cast(int, self._fd)
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, json.dumps(holder).encode(), 0)
         self.log.debug("Lock acquired: {0}".format(self._file))
+        return holder
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.ftruncate(self._fd, 0)
+        self._unlock()
         os.close(self._fd)
         self.log.debug("Lock released: {0}".format(self._file))
 
 
+class PosixFileLock(SimpleUnixFileLock):
+    """
+    UNIX filelock that uses POSIX byte-range locks (fcntl.lockf). Unlike
+    flock, these locks are forwarded to the server by NFS clients, so they
+    also work between machines that share a network filesystem, provided the
+    filesystem supports them.
+
+    POSIX locks are owned by a process rather than a file descriptor, so
+    threads in the same process are serialized with a thread lock first.
+    Closing any file descriptor of the lock file releases the locks of the
+    whole process. A thread that waits for the thread lock therefore never
+    opens the lock file. It gets the holder from the lock holders in this
+    process instead.
+    """
+    _thread_locks = {}  # type: Dict[str, threading.Lock]
+    _holders = {}  # type: Dict[str, Dict]
+    _thread_locks_lock = threading.Lock()
+
+    def __init__(self, file: str, timeout: Optional[float] = None,
+                 uri: Optional[str] = None):
+        super().__init__(file, timeout, uri)
+        self._path = os.path.abspath(file)
+        with self._thread_locks_lock:
+            self._thread_lock = self._thread_locks.setdefault(
+                self._path, threading.Lock())
+
+    def _lock(self, blocking: bool = True) -> bool:
+        try:
+            # Exclusive lock
+            fcntl.lockf(cast(int, self._fd), fcntl.LOCK_EX |
+                        (0 if blocking else fcntl.LOCK_NB))
+        except OSError as error:
+            if error.errno in (errno.EACCES, errno.EAGAIN):
+                return False
+            raise
+        return True
+
+    def _unlock(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _thread_lock_timeout(self) -> LockTimeoutError:
+        with self._thread_locks_lock:
+            return LockTimeoutError(self._file, self._holders.get(self._path))
+
+    def _acquired(self) -> Dict:
+        holder = super()._acquired()
+        with self._thread_locks_lock:
+            self._holders[self._path] = holder
+        return holder
+
+    def __enter__(self):
+        start = time.monotonic()
+        if not self._thread_lock.acquire(
+                timeout=-1 if self.timeout is None else self.timeout):
+            raise self._thread_lock_timeout()
+        try:
+            # Only the remainder of the timeout is left for the file lock.
+            self._enter(None if self.timeout is None else
+                        max(self.timeout - (time.monotonic() - start), 0))
+        except BaseException:
+            self._thread_lock.release()
+            raise
+
+    def _entering(self, timeout: Optional[float]) -> Iterator[float]:
+        start = time.monotonic()
+        intervals = _poll_intervals(timeout)
+        while not self._thread_lock.acquire(blocking=False):
+            interval = next(intervals, None)
+            if interval is None:
+                raise self._thread_lock_timeout()
+            yield interval
+        try:
+            yield from super()._entering(
+                None if timeout is None else
+                max(timeout - (time.monotonic() - start), 0))
+        except BaseException:
+            self._thread_lock.release()
+            raise
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._thread_locks_lock:
+            self._holders.pop(self._path, None)
+        try:
+            super().__exit__(exc_type, exc_val, exc_tb)
+        finally:
+            self._thread_lock.release()
+
+
+class LeaseFileLock:
+    """
+    Lock based on a lease file that is created with O_EXCL. This works on
+    any shared filesystem, including those that do not support locking
+    (properly). The lease file contains the hostname, PID, a unique token,
+    the URI and the start time of the holder. The holder refreshes the
+    modification time of the lease file regularly (the heartbeat).
+
+    A lease is stale and may be taken over when its holder is a process on
+    this machine that no longer exists, or when the lease has not changed
+    for ``stale_after`` seconds. The latter is measured on the local clock,
+    so clock differences between machines do not matter.
+
+    Waiting for the lease and the timeout work as in SimpleUnixFileLock.
+    The interval between attempts grows up to ``poll_interval``.
+    """
+    def __init__(self, file: str, timeout: Optional[float] = None,
+                 uri: Optional[str] = None,
+                 stale_after: float = DEFAULT_LEASE_STALE_AFTER,
+                 poll_interval: float = 1.0,
+                 hostname: Optional[str] = None):
+        self._file = file
+        self.timeout = timeout
+        self.uri = uri
+        self._break_file = file + ".break"
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self.hostname = hostname or socket.gethostname()
+        self._token = None  # type: Optional[str]
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread = None  # type: Optional[threading.Thread]
+        # Last seen state of the lease and break files, with the local
+        # time at which that state was first seen.
+        self._observed = {}  # type: Dict[str, Tuple[bytes, float, float]]
+        self.log = logging.getLogger()
+
+    def _try_create(self, file: str) -> bool:
+        try:
+            fd = os.open(file, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            return False
+        try:
+            os.write(fd, json.dumps(dict(
+                host=self.hostname, pid=os.getpid(), token=self._token,
+                uri=self.uri, started=time.time())).encode())
+        finally:
+            os.close(fd)
+        return True
+
+    def _read(self, file: str) -> Optional[Tuple[bytes, float]]:
+        # Reading through an opened file descriptor makes NFS clients
+        # revalidate their attribute cache (close-to-open consistency).
+        try:
+            fd = os.open(file, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            return os.read(fd, 4096), os.fstat(fd).st_mtime
+        finally:
+            os.close(fd)
+
+    def holder(self) -> Optional[Dict]:
+        """
+        Information about the process that holds the lease, or None if the
+        lease is not held.
+        """
+        state = self._read(self._file)
+        return _lock_holder(state[0]) if state is not None else None
+
+    def _is_stale(self, file: str, state: Tuple[bytes, float]) -> bool:
+        content, mtime = state
+        holder = _lock_holder(content) or {}
+        if holder.get("host") == self.hostname and holder.get("pid"):
+            try:
+                os.kill(holder["pid"], 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                pass
+        now = time.monotonic()
+        observed = self._observed.get(file)
+        if observed is None or observed[:2] != state:
+            self._observed[file] = (content, mtime, now)
+            return False
+        return now - observed[2] > self.stale_after
+
+    def _break_stale_lease(self, state: Tuple[bytes, float]):
+        # Breaking a lease is done under a second lease, so two processes
+        # can not both decide that a lease is stale and one of them remove
+        # the fresh lease that the other has created in the meantime.
+        if not self._try_create(self._break_file):
+            break_state = self._read(self._break_file)
+            if (break_state is not None and
+                    self._is_stale(self._break_file, break_state)):
+                self.log.warning("Removing stale lease breaker: {0}".format(
+                    self._break_file))
+                os.unlink(self._break_file)
+            return
+        try:
+            if self._read(self._file) == state:
+                self.log.warning("Taking over stale lease: {0} held by {1}"
+                                 "".format(self._file, state[0].decode()))
+                os.unlink(self._file)
+        finally:
+            os.unlink(self._break_file)
+
+    def _heartbeat(self):
+        interval = self.stale_after / 4
+        while not self._heartbeat_stop.wait(interval):
+            try:
+                os.utime(self._file)
+            except OSError as error:
+                self.log.warning("Could not refresh lease {0}: {1}".format(
+                    self._file, error))
+
+    def __enter__(self):
+        for interval in self._entering(self.timeout):
+            time.sleep(interval)
+
+    def _entering(self, timeout: Optional[float]) -> Iterator[float]:
+        # Yields the time to wait between attempts. See SimpleUnixFileLock.
+        self._token = uuid.uuid4().hex
+        self.log.info("Waiting for file lock on: {0}".format(self._file))
+        intervals = _poll_intervals(timeout, self.poll_interval)
+        holder = None
+        try:
+            while not self._try_create(self._file):
+                state = self._read(self._file)
+                if state is None:  # Lease was released in the meantime.
+                    continue
+                if self._is_stale(self._file, state):
+                    self._break_stale_lease(state)
+                    continue
+                if holder != _lock_holder(state[0]):
+                    holder = _lock_holder(state[0])
+                    self.log.info("Lock {0} is held by {1}.".format(
+                        self._file, _describe_holder(holder)))
+                interval = next(intervals, None)
+                if interval is None:
+                    raise LockTimeoutError(self._file, holder)
+                yield interval
+        finally:
+            self._observed.clear()
+        self._heartbeat_stop.clear()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat,
+                                                  daemon=True)
+        self._heartbeat_thread.start()
+        self.log.debug("Lock acquired: {0}".format(self._file))
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._heartbeat_stop.set()
+        self._heartbeat_thread.join()
+        state = self._read(self._file)
+        if state is not None and self._token in state[0].decode():
+            os.unlink(self._file)
+        else:
+            self.log.warning("Lease {0} was taken over by another process "
+                             "while it was held.".format(self._file))
+        self.log.debug("Lock released: {0}".format(self._file))
+
+
+LOCK_BACKENDS = OrderedDict([
+    ("flock", SimpleUnixFileLock),
+    ("lockf", PosixFileLock),
+    ("lease", LeaseFileLock),
+])
+
+
+def get_lock_backend(name: Optional[str] = None):
+    """
+    Get the lock class to use for the cache.
+    :param name: name of the lock backend. If not given the
+                 SINGULARITY_PERMANENTCACHE_LOCK_BACKEND environment variable
+                 is used, or 'flock' if it is not set.
+    :return: a lock class which takes the lock file path as argument.
+    """
+    if name is None:
+        name = os.environ.get("SINGULARITY_PERMANENTCACHE_LOCK_BACKEND",
+                              DEFAULT_LOCK_BACKEND)
+    try:
+        return LOCK_BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown lock backend: '{0}'. Choose one of: {1}."
+                         "".format(name, ", ".join(LOCK_BACKENDS)))
+
+
+def _output_lines(fd: int) -> Iterator[str]:
+    buffer = b""
+    while True:
+        data = os.read(fd, 65536)
+        lines, buffer = _split_output(buffer, data)
+        yield from lines
+        if not data:
+            break
+
+
+def _split_output(buffer: bytes, data: bytes) -> Tuple[List[str], bytes]:
+    # Split output in lines on newlines and carriage returns, which are
+    # used by progress bars. Very long lines are split as well, so memory
+    # use is bounded. Returns the lines and the incomplete last line, which
+    # is the buffer for the next data. Empty data is the end of the output.
+    lines = re.split(b"[\r\n]", buffer + data)
+    # Keep the incomplete last line, unless the output has ended.
+    buffer = lines.pop() if data else b""
+    if len(buffer) > MAX_OUTPUT_LINE_LENGTH:
+        lines.append(buffer)
+        buffer = b""
+    parts = []  # type: List[str]
+    for line in lines:
+        for start in range(0, len(line), MAX_OUTPUT_LINE_LENGTH):
+            part = line[start:start + MAX_OUTPUT_LINE_LENGTH]
+            if part.strip():
+                parts.append(part.decode(errors="replace"))
+    return parts, buffer
+
+
 def singularity_command(
         singularity_exe, *args, **kwargs
                         ) -> subprocess.CompletedProcess:
     """
     Execute a singularity command. Fails if singularity command fails.
+    The output (stdout and stderr) is logged line by line while the command
+    runs. Only the last OUTPUT_TAIL_LINES lines are kept.
     :param singularity_exe: Path to singularity executable.
     :param args: additional args for singularity.
-    :param kwargs: kwargs for subprocess.run
-    :return: a completed process.
+    :param kwargs: kwargs for subprocess.Popen
+    :return: a completed process. stdout contains the last lines of output.
     """
-    result = subprocess.run([singularity_exe] + list(args),
-                            stderr=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            check=True,
-                            **kwargs)
-    return result
+    log = logging.getLogger()
+    command = [singularity_exe] + list(args)
+    name = os.path.basename(singularity_exe)
+    tail = deque(maxlen=OUTPUT_TAIL_LINES)  # type: deque
+    with subprocess.Popen(command, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, **kwargs) as process:
+        assert process.stdout is not None
+        for line in _output_lines(process.stdout.fileno()):
+            log.info("{0}: {1}".format(name, line))
+            tail.append(line)
+    output = "\n".join(tail)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command,
+                                            output=output)
+    return subprocess.CompletedProcess(command, process.returncode,
+                                       stdout=output)
+
+
+async def singularity_command_async(
+        singularity_exe, *args, **kwargs) -> subprocess.CompletedProcess:
+    """
+    Execute a singularity command in an asyncio event loop. Works like
+    singularity_command. The command is killed when the coroutine is
+    cancelled.
+    :param singularity_exe: Path to singularity executable.
+    :param args: additional args for singularity.
+    :param kwargs: kwargs for asyncio.create_subprocess_exec
+    :return: a completed process. stdout contains the last lines of output.
+    """
+    log = logging.getLogger()
+    command = [singularity_exe] + list(args)
+    name = os.path.basename(singularity_exe)
+    tail = deque(maxlen=OUTPUT_TAIL_LINES)  # type: deque
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+    assert process.stdout is not None
+    try:
+        buffer = b""
+        while True:
+            data = await process.stdout.read(65536)
+            lines, buffer = _split_output(buffer, data)
+            for line in lines:
+                log.info("{0}: {1}".format(name, line))
+                tail.append(line)
+            if not data:
+                break
+        returncode = await process.wait()
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+        raise
+    output = "\n".join(tail)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command,
+                                            output=output)
+    return subprocess.CompletedProcess(command, returncode, stdout=output)
 
 
 def uri_to_filename(uri: str) -> str:
     """
-    Replace characters that are forbidden on filesystems with underscores.
-    In URIs for singularity/docker images these are ':' and '/'.
+    Get the filename of an image in the cache, without the .sif suffix.
+    Characters that are forbidden or unsafe in filenames, such as ':' and
+    '/', are escaped as in URLs: '%' followed by the hexadecimal code of
+    each of their UTF-8 bytes. Different URIs therefore have different
+    filenames and the URI can be recovered with filename_to_uri. Filenames
+    longer than MAX_FILENAME_LENGTH are replaced by the sha256 checksum of
+    the URI. The cache index records the URI of these.
     :param uri: the uri for which characters are replaced.
     :return: a valid filename.
     """
+    filename = "".join(
+        character if character in FILENAME_SAFE_CHARACTERS else
+        "".join("%{0:02X}".format(byte) for byte in character.encode())
+        for character in uri)
+    # Filenames that start with a dot are hidden.
+    if filename.startswith("."):
+        filename = "%2E" + filename[1:]
+    if len(filename) > MAX_FILENAME_LENGTH:
+        return (HASHED_FILENAME_PREFIX +
+                hashlib.sha256(uri.encode()).hexdigest())
+    return filename
+
+
+def filename_to_uri(filename: str) -> Optional[str]:
+    """
+    Get the URI of an image from its filename in the cache.
+    :param filename: a filename created by uri_to_filename, with or without
+                     the .sif suffix.
+    :return: the uri, or None for filenames that were replaced by a
+             checksum and filenames that were not created by
+             uri_to_filename. Use the cache index for these.
+    """
+    name = filename[:-len(".sif")] if filename.endswith(".sif") else filename
+    try:
+        uri = urllib.parse.unquote(name, errors="strict")
+    except UnicodeDecodeError:
+        return None
+    return uri if uri_to_filename(uri) == name else None
+
+
+def _legacy_filename(uri: str) -> str:
+    # The filename of an image in versions before 1.0.0. Different URIs
+    # could get the same filename.
     return uri.replace("://", "_").replace("/", "_").replace(":", "_")
 
 
-def pull_image_to_cache(uri: str, cache_location: Optional[Path] = None,
-                        singularity_exe=DEFAULT_SINGULARITY_EXE) -> Path:
+def image_digest(uri: str) -> Optional[str]:
+    """
+    Get the image digest from a URI that refers to an image by digest.
+    :param uri: the uri, or a filename created by uri_to_filename.
+    :return: the digest as a hexadecimal string, or None if the uri refers to
+             the image by tag.
+    """
+    match = IMAGE_DIGEST_PATTERN.search(uri)
+    return match.group(1) if match else None
+
+
+def sha256_file(file: Path) -> str:
+    """
+    Calculate the sha256 checksum of a file.
+    :param file: the file to calculate the checksum for.
+    :return: the checksum as a hexadecimal string.
+    """
+    checksum = hashlib.sha256()
+    # Reading into the same buffer avoids allocating memory for each block.
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with file.open("rb", buffering=0) as file_h:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(file_h.fileno(), 0, 0,
+                             os.POSIX_FADV_SEQUENTIAL)
+        for size in iter(lambda: file_h.readinto(buffer), 0):
+            checksum.update(view[:size])
+    return checksum.hexdigest()
+
+
+def blob_path(cache: Path, digest: str, by_image_digest: bool) -> Path:
+    """
+    Get the location of an image in the content-addressed store of the cache.
+    :param cache: the cache dir.
+    :param digest: a hexadecimal sha256 digest.
+    :param by_image_digest: whether the digest is the digest of the image
+                            in the registry rather than the checksum of the
+                            image file.
+    :return: the path to the image in the store.
+    """
+    store = "image-sha256" if by_image_digest else "sha256"
+    return Path(cache, "blobs", store, digest + ".sif")
+
+
+def copy_file(source: Path, destination: Path):
+    """
+    Copy a file as efficiently as the filesystems allow. A reflink, which
+    shares the data of the file, is tried first. Otherwise the data is
+    copied by the kernel with copy_file_range or sendfile, without passing
+    it through this process. If none of these work, the file is copied
+    normally.
+    :param source: the file to copy.
+    :param destination: the new file.
+    """
+    with source.open("rb") as source_h, destination.open("wb") as dest_h:
+        source_fd = source_h.fileno()
+        dest_fd = dest_h.fileno()
+        try:
+            fcntl.ioctl(dest_fd, FICLONE, source_fd)
+            return
+        except OSError:
+            pass
+        size = os.fstat(source_fd).st_size
+        # Each method continues where the previous one stopped.
+        offset = 0
+        for method in ("copy_file_range", "sendfile"):
+            if not hasattr(os, method):  # Python < 3.8 or not Linux.
+                continue
+            try:
+                # sendfile writes at the file position of the destination.
+                dest_h.seek(offset)
+                while offset < size:
+                    if method == "copy_file_range":
+                        copied = os.copy_file_range(
+                            source_fd, dest_fd, size - offset, offset, offset)
+                    else:
+                        copied = os.sendfile(dest_fd, source_fd, offset,
+                                             size - offset)
+                    if copied == 0:  # The file was truncated.
+                        break
+                    offset += copied
+                return
+            except OSError as error:
+                if error.errno not in COPY_UNSUPPORTED_ERRORS:
+                    raise
+        source_h.seek(offset)
+        dest_h.seek(offset)
+        shutil.copyfileobj(source_h, dest_h, COPY_BUFFER_SIZE)
+
+
+class FetchError(RuntimeError):
+    """
+    Raised by fetch backends when an image cannot be fetched. Failed
+    fetches are retried, like failed singularity pulls, unless retryable is
+    False. For instance when the image does not exist.
+    """
+    def __init__(self, message: str, output: str = "",
+                 retryable: bool = True):
+        super().__init__(message)
+        self.output = output
+        self.retryable = retryable
+
+
+def fetch_with_singularity(uri: str, destination: Path,
+                           singularity_exe: str = DEFAULT_SINGULARITY_EXE):
+    """
+    Fetch an image with 'singularity pull'. Apptainer is used with
+    singularity_exe='apptainer'. This is the backend for all URIs that
+    other backends do not handle.
+    :param uri: the uri of the image.
+    :param destination: the file to write the image to.
+    :param singularity_exe: path to singularity.
+    """
+    singularity_command(singularity_exe, "pull", str(destination), uri)
+
+
+def fetch_file(uri: str, destination: Path,
+               singularity_exe: str = DEFAULT_SINGULARITY_EXE):
+    """
+    Fetch a SIF image from a file:// URI, such as an image in the cache of
+    another site, by copying it. See copy_file.
+    :param uri: the uri of the image.
+    :param destination: the file to write the image to.
+    :param singularity_exe: not used.
+    """
+    parsed = urllib.parse.urlparse(uri)
+    if parsed.netloc not in ("", "localhost"):
+        raise ValueError("Only local files can be fetched: {0}".format(uri))
+    copy_file(Path(urllib.parse.unquote(parsed.path)), destination)
+
+
+def fetch_http(uri: str, destination: Path,
+               singularity_exe: str = DEFAULT_SINGULARITY_EXE):
+    """
+    Download a SIF image from an HTTP(S) URI. Interrupted downloads are
+    resumed with range requests when the server supports them, and started
+    over otherwise.
+    :param uri: the uri of the image.
+    :param destination: the file to write the image to.
+    :param singularity_exe: not used.
+    """
+    log = logging.getLogger()
+    resumes = 0
+    with destination.open("ab") as destination_h:
+        while True:
+            offset = destination_h.tell()
+            request = urllib.request.Request(uri)
+            if offset:
+                request.add_header("Range", "bytes={0}-".format(offset))
+            try:
+                with urllib.request.urlopen(request,
+                                            timeout=HTTP_TIMEOUT) as response:
+                    if offset and response.status != 206:
+                        log.info("Server does not support resuming, "
+                                 "downloading {0} again.".format(uri))
+                        destination_h.seek(0)
+                        destination_h.truncate()
+                    start = destination_h.tell()
+                    shutil.copyfileobj(response, destination_h,
+                                       COPY_BUFFER_SIZE)
+                    # Reads in blocks end quietly when the connection is
+                    # closed early.
+                    length = response.headers.get("Content-Length")
+                    received = destination_h.tell() - start
+                    if length is not None and received < int(length):
+                        raise http.client.IncompleteRead(
+                            b"", int(length) - received)
+                return
+            except urllib.error.HTTPError as error:
+                # Server errors are retried.
+                raise FetchError(
+                    "Downloading {0} failed: {1}".format(uri, error),
+                    retryable=(error.code >= 500 or
+                               error.code in HTTP_RETRYABLE_CLIENT_ERRORS))
+            except (urllib.error.URLError, http.client.HTTPException,
+                    ConnectionError, socket.timeout) as error:
+                # Only resume downloads that make progress.
+                if (destination_h.tell() == offset or
+                        resumes >= HTTP_MAX_RESUMES):
+                    raise FetchError("Downloading {0} failed: {1}".format(
+                        uri, error))
+                resumes += 1
+                log.warning("Download of {0} interrupted after {1} bytes: "
+                            "{2}. Resuming.".format(uri, destination_h.tell(),
+                                                    error))
+
+
+# A fetch backend writes the image with the uri to the destination file.
+FetchBackend = Callable[[str, Path, str], None]
+# Fetch backends by URI scheme. Other schemes use fetch_with_singularity.
+FETCH_BACKENDS = OrderedDict([
+    ("file", fetch_file),
+    ("http", fetch_http),
+    ("https", fetch_http),
+])  # type: Dict[str, FetchBackend]
+
+
+def get_fetch_backend(uri: str) -> FetchBackend:
+    """
+    Get the fetch backend for a uri from FETCH_BACKENDS. Add a function to
+    FETCH_BACKENDS to fetch images with another scheme.
+    :param uri: the uri of the image.
+    :return: a function that takes the uri, the file to write the image to
+             and the path to singularity.
+    """
+    scheme = uri.split("://", 1)[0].lower() if "://" in uri else ""
+    return FETCH_BACKENDS.get(scheme, fetch_with_singularity)
+
+
+def _link_image(image_path: Path, blob: Path):
+    # Replace the image entry with a relative symlink to the blob. The link is
+    # created under a unique name first and then renamed, so other processes
+    # never see a missing or half created entry.
+    link_tmp = image_path.with_name(
+        "{0}.{1}.link".format(image_path.name, uuid.uuid4().hex))
+    os.symlink(os.path.relpath(str(blob), str(image_path.parent)),
+               str(link_tmp))
+    link_tmp.rename(image_path)
+
+
+class CacheIndex:
+    """
+    Index of the images in the cache. The index is an SQLite database in the
+    cache dir which records for each URI the image location, size, digest,
+    sha256 checksum and modification time of the image file, pull time and
+    last access time. This allows listing the cache without scanning the
+    cache dir.
+
+    The WAL journal is the fastest with many concurrent readers, but it
+    needs shared memory and does not work when the cache is used from
+    multiple machines. The journal mode is set when the index is created.
+    """
+    # Each item upgrades the index database by one version.
+    SCHEMA_UPGRADES = [
+        """
+        CREATE TABLE IF NOT EXISTS images (
+            uri TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            blob TEXT,
+            size INTEGER,
+            digest TEXT,
+            pulled REAL,
+            accessed REAL
+        )""",
+        "ALTER TABLE images ADD COLUMN pinned_until REAL",
+        "ALTER TABLE images ADD COLUMN sha256 TEXT",
+        "ALTER TABLE images ADD COLUMN mtime REAL",
+    ]
+
+    def __init__(self, cache: Path, wal: bool = True,
+                 timeout: float = INDEX_TIMEOUT):
+        self.cache = cache
+        self.path = Path(cache, INDEX_FILE)
+        self.wal = wal
+        self.timeout = timeout
+        self._connection = None  # type: Optional[sqlite3.Connection]
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            # Autocommit mode. Statements that belong together are run in
+            # an explicit transaction.
+            connection = sqlite3.connect(str(self.path),
+                                         timeout=self.timeout,
+                                         isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version == 0 and self.wal:
+                connection.execute("PRAGMA journal_mode=WAL")
+            if version < len(self.SCHEMA_UPGRADES):
+                self._upgrade(connection)
+            self._connection = connection
+        return self._connection
+
+    def _upgrade(self, connection: sqlite3.Connection):
+        # BEGIN IMMEDIATE takes the write lock, so only one process upgrades
+        # the index. The version is read again inside the transaction.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            version = connection.execute(
+                "PRAGMA user_version").fetchone()[0]
+            for statement in self.SCHEMA_UPGRADES[version:]:
+                connection.execute(statement)
+            connection.execute("PRAGMA user_version = {0:d}".format(
+                len(self.SCHEMA_UPGRADES)))
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def record(self, uri: str, image_path: Path, blob: Optional[Path],
+               pulled: Optional[float] = None,
+               checksum: Optional[str] = None):
+        """
+        Add or update the index entry for an image. The pin of the image is
+        kept.
+        :param uri: the uri of the image.
+        :param image_path: the image entry in the cache.
+        :param blob: the location of the image in the content-addressed
+                     store, or None if the image is stored as a plain file.
+        :param pulled: the time at which the image was pulled.
+        :param checksum: the sha256 checksum of the image file, if known.
+                         Images in the store by checksum and images that
+                         share a blob with an image with a checksum get
+                         theirs from the store or the other image.
+        """
+        image_file = image_path if blob is None else blob
+        stat = image_file.stat()
+        blob_name = None
+        digest = None
+        if blob is not None:
+            blob_name = os.path.relpath(str(blob), str(self.cache))
+            digest = "sha256:" + blob.stem
+            if checksum is None and blob.parent.name == "sha256":
+                checksum = blob.stem
+        self.connection.execute(
+            "INSERT OR REPLACE INTO images "
+            "(uri, path, blob, size, digest, pulled, accessed, pinned_until, "
+            "sha256, mtime) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, "
+            "(SELECT pinned_until FROM images WHERE uri = ?), "
+            "COALESCE(?, (SELECT sha256 FROM images "
+            "WHERE blob = ? AND sha256 IS NOT NULL LIMIT 1)), ?)",
+            (uri, image_path.name, blob_name, stat.st_size, digest, pulled,
+             time.time(), uri, checksum, blob_name, stat.st_mtime))
+
+    def check_image(self, uri: str, image_path: Path) -> bool:
+        """
+        Check that the size and modification time of an image are the same
+        as when it was recorded. This is cheap and finds images that were
+        truncated or replaced, but not images whose data was damaged. Use
+        verify_cache for that.
+        :param uri: the uri of the image.
+        :param image_path: the image entry in the cache.
+        :return: whether the image matches its entry. Images without an
+                 entry, or without a recorded modification time, match.
+        """
+        entry = self.get(uri)
+        if (entry is None or entry["mtime"] is None or
+                entry["path"] != image_path.name):
+            return True
+        try:
+            stat = image_path.stat()
+        except FileNotFoundError:
+            return True
+        return (stat.st_size == entry["size"] and
+                stat.st_mtime == entry["mtime"])
+
+    def set_checksum(self, file: str, checksum: str):
+        """
+        Record the sha256 checksum of an image file for the entries that use
+        it and do not have a checksum yet.
+        :param file: the blob, or the image entry for images that are stored
+                     as a plain file, relative to the cache dir.
+        :param checksum: the sha256 checksum of the file.
+        """
+        self.connection.execute(
+            "UPDATE images SET sha256 = ? "
+            "WHERE COALESCE(blob, path) = ? AND sha256 IS NULL",
+            (checksum, file))
+
+    def record_access(self, uri: str, image_path: Path):
+        """
+        Record that an image was used. To keep cache hits fast, the access
+        time is only written when the stored time is older than
+        ACCESS_TIME_RESOLUTION. Images that are not in the index yet, for
+        instance from caches created by older versions, are added.
+        :param uri: the uri of the image.
+        :param image_path: the image entry in the cache.
+        """
+        entry = self.get(uri)
+        now = time.time()
+        if entry is None or entry["path"] != image_path.name:
+            blob = None
+            if image_path.is_symlink():
+                blob = Path(image_path.parent,
+                            os.readlink(str(image_path)))
+            self.record(uri, image_path, blob, None)
+        elif (entry["accessed"] or 0) < now - ACCESS_TIME_RESOLUTION:
+            self.connection.execute(
+                "UPDATE images SET accessed = ? WHERE uri = ?", (now, uri))
+
+    def get(self, uri: str) -> Optional[Dict]:
+        """Get the index entry for a URI, or None if it is not indexed."""
+        row = self.connection.execute(
+            "SELECT * FROM images WHERE uri = ?", (uri,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def entries(self) -> List[Dict]:
+        """Get all index entries, sorted by URI."""
+        return [dict(row) for row in self.connection.execute(
+            "SELECT * FROM images ORDER BY uri")]
+
+    def remove(self, uri: str):
+        """Remove the index entry for a URI."""
+        self.connection.execute("DELETE FROM images WHERE uri = ?", (uri,))
+
+    def set_times(self, uri: str, pulled: Optional[float],
+                  accessed: Optional[float]):
+        """
+        Set the pull and access times of an image, for instance to keep them
+        when the image is recorded again after it was moved.
+        """
+        self.connection.execute(
+            "UPDATE images SET pulled = ?, accessed = ? WHERE uri = ?",
+            (pulled, accessed, uri))
+
+    def move(self, uri: str, image_path: Path):
+        """Record that the image entry of a URI was renamed."""
+        self.connection.execute("UPDATE images SET path = ? WHERE uri = ?",
+                                (image_path.name, uri))
+
+    def uris_with_path(self, path: str) -> List[str]:
+        """Get the URIs of the entries with the given image entry."""
+        return [row[0] for row in self.connection.execute(
+            "SELECT uri FROM images WHERE path = ?", (path,))]
+
+    def pin(self, uri: str, until: float = float("inf"),
+            extend: bool = False) -> bool:
+        """
+        Protect an image from eviction.
+        :param uri: the uri of the image.
+        :param until: the time until which the image is pinned. Forever by
+                      default.
+        :param extend: only change the pin when it ends before until, so
+                       a longer pin is kept.
+        :return: whether the image is in the index.
+        """
+        if extend:
+            return self.connection.execute(
+                "UPDATE images SET pinned_until = "
+                "MAX(COALESCE(pinned_until, 0), ?) WHERE uri = ?",
+                (until, uri)).rowcount > 0
+        return self.connection.execute(
+            "UPDATE images SET pinned_until = ? WHERE uri = ?",
+            (until, uri)).rowcount > 0
+
+    def unpin(self, uri: str) -> bool:
+        """
+        Allow eviction of a pinned image again.
+        :param uri: the uri of the image.
+        :return: whether the image is in the index.
+        """
+        return self.connection.execute(
+            "UPDATE images SET pinned_until = NULL WHERE uri = ?",
+            (uri,)).rowcount > 0
+
+    def total_size(self) -> int:
+        """Total size of the images in the index in bytes."""
+        # Images that share a blob use the disk space only once.
+        return self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM "
+            "(SELECT MAX(size) AS size FROM images "
+            "GROUP BY COALESCE(blob, path))").fetchone()[0]
+
+    def least_recently_used(self) -> List[Dict]:
+        """
+        Get the entries that are not pinned, least recently used first.
+        """
+        return [dict(row) for row in self.connection.execute(
+            "SELECT * FROM images "
+            "WHERE pinned_until IS NULL OR pinned_until < ? "
+            "ORDER BY COALESCE(accessed, pulled, 0)", (time.time(),))]
+
+    def blob_in_use(self, blob: str) -> bool:
+        """Whether any entry in the index uses the given blob."""
+        return self.connection.execute(
+            "SELECT 1 FROM images WHERE blob = ? LIMIT 1",
+            (blob,)).fetchone() is not None
+
+
+def open_index(cache: Path, lock_backend: Optional[str] = None,
+               timeout: float = INDEX_TIMEOUT) -> CacheIndex:
+    """
+    Open the index of a cache.
+    :param cache: the cache dir.
+    :param lock_backend: name of the lock backend. The WAL journal is only
+                         used with the flock backend, as the other backends
+                         are meant for caches shared between machines.
+    :param timeout: seconds to wait when another process has locked the
+                    index.
+    :return: the cache index.
+    """
+    return CacheIndex(
+        cache, wal=get_lock_backend(lock_backend) is SimpleUnixFileLock,
+        timeout=timeout)
+
+
+def _add_image(index: Optional[CacheIndex], uri: Optional[str],
+               image_path: Path, blob: Path, checksum: Optional[str] = None):
+    # Must be called with the blob lock held. The index entry is written
+    # before the link, so the blob is never without an index entry while it
+    # is in use. See evict_images.
+    if index is not None and uri is not None:
+        index.record(uri, image_path, blob, time.time(), checksum)
+    _link_image(image_path, blob)
+
+
+def store_image(image_path: Path, image_file: Path,
+                digest: Optional[str] = None,
+                index: Optional[CacheIndex] = None,
+                uri: Optional[str] = None,
+                lock_backend: Optional[str] = None,
+                checksum: Optional[str] = None) -> Path:
+    """
+    Move an image file into the content-addressed store and link the image
+    entry in the cache to it. If the store already contains the same image,
+    the image file is removed instead. Must be called while the lock for
+    image_path is held.
+    :param image_path: location of the image entry in the cache.
+    :param image_file: image file on the same filesystem as the cache.
+    :param digest: image digest in the registry, if known. Otherwise the
+                   image is stored by the sha256 checksum of the file.
+    :param index: the cache index in which the image is recorded.
+    :param uri: the uri of the image. Required when index is given.
+    :param lock_backend: name of the lock backend. See get_lock_backend.
+    :param checksum: sha256 checksum of the image file, if known. It is
+                     calculated when no digest is given.
+    :return: the location of the image in the store.
+    """
+    if digest is None:
+        checksum = checksum or sha256_file(image_file)
+        blob = blob_path(image_path.parent, checksum, False)
+    else:
+        blob = blob_path(image_path.parent, digest, True)
+    blob.parent.mkdir(parents=True, exist_ok=True)
+    lock_class = get_lock_backend(lock_backend)
+    with lock_class(str(blob) + ".lock"):
+        if blob.exists():
+            logging.getLogger().info(
+                "Identical image already stored at: {0}".format(blob))
+            image_file.unlink()
+        else:
+            image_file.rename(blob)
+        _add_image(index, uri, image_path, blob, checksum)
+    return blob
+
+
+def parse_size(size: str) -> int:
+    """
+    Parse a size such as '500M' or '1.5T' into bytes. The suffixes K, M, G
+    and T are powers of 1024. A number without suffix is in bytes.
+    :param size: the size string.
+    :return: the size in bytes.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*",
+                         size, re.IGNORECASE)
+    if match is None:
+        raise ValueError("Invalid size: '{0}'. Use a number of bytes or a "
+                         "number followed by K, M, G or T.".format(size))
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** " KMGT".index(unit.upper() or " "))
+
+
+def parse_duration(duration: str) -> float:
+    """
+    Parse a duration such as '90m', '12h' or '7d' into seconds. The suffixes
+    are s, m, h and d. A number without suffix is in seconds.
+    :param duration: the duration string.
+    :return: the duration in seconds.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*", duration,
+                         re.IGNORECASE)
+    if match is None:
+        raise ValueError("Invalid duration: '{0}'. Use a number of seconds or "
+                         "a number followed by s, m, h or d."
+                         "".format(duration))
+    number, unit = match.groups()
+    return float(number) * {"": 1, "s": 1, "m": 60, "h": 3600,
+                            "d": 86400}[unit.lower()]
+
+
+def get_max_size_from_env() -> Optional[int]:
+    """
+    Get the maximum cache size from the SINGULARITY_PERMANENTCACHE_MAX_SIZE
+    environment variable.
+    :return: the size in bytes, or None when no maximum is set.
+    """
+    max_size = os.environ.get("SINGULARITY_PERMANENTCACHE_MAX_SIZE")
+    return parse_size(max_size) if max_size else None
+
+
+def get_local_max_size_from_env() -> Optional[int]:
+    """
+    Get the maximum size of the faster cache tiers from the
+    SINGULARITY_PERMANENTCACHE_LOCAL_MAX_SIZE environment variable.
+    :return: the size in bytes, or None when no maximum is set.
+    """
+    max_size = os.environ.get("SINGULARITY_PERMANENTCACHE_LOCAL_MAX_SIZE")
+    return parse_size(max_size) if max_size else None
+
+
+def get_lock_timeout_from_env() -> Optional[float]:
+    """
+    Get the lock timeout from the SINGULARITY_PERMANENTCACHE_LOCK_TIMEOUT
+    environment variable.
+    :return: the timeout in seconds, or None when no timeout is set.
+    """
+    lock_timeout = os.environ.get("SINGULARITY_PERMANENTCACHE_LOCK_TIMEOUT")
+    return float(lock_timeout) if lock_timeout else None
+
+
+def evict_images(cache_location: Optional[Path] = None,
+                 max_size: Optional[int] = None,
+                 lock_backend: Optional[str] = None,
+                 min_age: Optional[float] = None) -> List[str]:
+    """
+    Remove the least recently used images until the cache is not larger
+    than max_size. Pinned images and images that were used less than
+    min_age seconds ago are never removed. The size of the cache is the size
+    of the images in the cache index.
+    :param cache_location: the cache dir. If not given tries to get the
+                           location from the environment.
+    :param max_size: the maximum size of the cache in bytes. If not given
+                     the SINGULARITY_PERMANENTCACHE_MAX_SIZE environment
+                     variable is used.
+    :param lock_backend: name of the lock backend. See get_lock_backend.
+    :param min_age: minimum number of seconds since the last use of an image
+                    before it may be removed. EVICTION_MIN_AGE by default.
+    :return: the uris of the removed images.
+    """
+    log = logging.getLogger()
+    cache = cache_location or get_cache_dir_from_env()
+    if max_size is None:
+        max_size = get_max_size_from_env()
+    if max_size is None:
+        raise ValueError("No maximum cache size given. Please set "
+                         "'SINGULARITY_PERMANENTCACHE_MAX_SIZE'.")
+    if min_age is None:
+        min_age = EVICTION_MIN_AGE
+    lock_class = get_lock_backend(lock_backend)
+    evicted = []  # type: List[str]
+
+    def recently_used(entry: Optional[Dict]) -> bool:
+        return (entry is not None and
+                (entry["accessed"] or 0) > time.time() - min_age)
+
+    with open_index(cache, lock_backend) as index:
+        for entry in index.least_recently_used():
+            if index.total_size() <= max_size:
+                break
+            if recently_used(entry):
+                log.warning("Cache is larger than {0} bytes, but all images "
+                            "that are not pinned were recently used."
+                            "".format(max_size))
+                break
+            uri = entry["uri"]
+            image_path = Path(cache, entry["path"])
+            # The image lock ensures the image is not being pulled.
+            with lock_class(str(image_path) + ".lock"):
+                entry = index.get(uri)
+                if (entry is None or recently_used(entry) or
+                        (entry["pinned_until"] or 0) > time.time()):
+                    continue
+                # Cache hits do not take the lock. They record the access
+                # before they check that the image still exists. So first
+                # hide the image, then check the access time once more.
+                evicting = image_path.with_name(image_path.name +
+                                                ".evicting")
+                hidden = image_path.is_symlink() or image_path.exists()
+                if hidden:
+                    image_path.rename(evicting)
+                if recently_used(index.get(uri)):
+                    if hidden:
+                        evicting.rename(image_path)
+                    continue
+                log.info("Evicting image {0}".format(uri))
+                index.remove(uri)
+                if hidden:
+                    evicting.unlink()
+                evicted.append(uri)
+            if entry["blob"] is not None:
+                blob = Path(cache, entry["blob"])
+                with lock_class(str(blob) + ".lock"):
+                    if not index.blob_in_use(entry["blob"]):
+                        log.info("Removing image file {0}".format(blob))
+                        try:
+                            blob.unlink()
+                        except FileNotFoundError:
+                            pass
+    return evicted
+
+
+def pin_images(uris: Iterable[str], cache_location: Optional[Path] = None,
+               until: float = float("inf"),
+               lock_backend: Optional[str] = None,
+               extend: bool = False):
+    """
+    Pin images so they are never evicted from the cache.
+    :param uris: the uris of the images.
+    :param cache_location: the cache dir. If not given tries to get the
+                           location from the environment.
+    :param until: the time until which the images are pinned. Forever by
+                  default.
+    :param lock_backend: name of the lock backend. See get_lock_backend.
+    :param extend: keep pins that end after until.
+    """
+    cache = cache_location or get_cache_dir_from_env()
+    with open_index(cache, lock_backend) as index:
+        for uri in uris:
+            if not index.pin(uri, until, extend):
+                raise ValueError("Image is not in the cache: {0}".format(uri))
+
+
+def unpin_images(uris: Iterable[str], cache_location: Optional[Path] = None,
+                 lock_backend: Optional[str] = None):
+    """
+    Allow eviction of pinned images again.
+    :param uris: the uris of the images.
+    :param cache_location: the cache dir. If not given tries to get the
+                           location from the environment.
+    :param lock_backend: name of the lock backend. See get_lock_backend.
+    """
+    cache = cache_location or get_cache_dir_from_env()
+    with open_index(cache, lock_backend) as index:
+        for uri in uris:
+            if not index.unpin(uri):
+                raise ValueError("Image is not in the cache: {0}".format(uri))
+
+
+def write_metrics(target: str, record: Dict):
+    """
+    Append a metrics record to a file as a line of JSON. The line is written
+    with a single write to a file opened in append mode, so lines from
+    concurrent processes do not mix.
+    :param target: the file to write to. Use /dev/fd/<N> to write to an
+                   open file descriptor.
+    :param record: the metrics.
+    """
+    line = (json.dumps(record) + "\n").encode()
+    try:
+        fd = os.open(target, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError as error:
+        logging.getLogger().warning(
+            "Could not write metrics to {0}: {1}".format(target, error))
+
+
+def pull_image_to_cache(uri: str,
+                        cache_location: Optional[CacheLocation] = None,
+                        singularity_exe=DEFAULT_SINGULARITY_EXE,
+                        lock_backend: Optional[str] = None,
+                        max_size: Optional[int] = None,
+                        metrics: Optional[str] = None,
+                        lock_timeout: Optional[float] = None,
+                        retries: Optional[int] = None,
+                        local_max_size: Optional[int] = None,
+                        check_hits: Optional[bool] = None) -> Path:
     """
     Pull image to the cache.
     :param uri: Valid singularity image uri.
     :param cache_location: Location to pull the image to. If not given tries
-                           to get the location from the environment.
+                           to get the location from the environment. Can
+                           also be a list of cache dirs (tiers), fastest
+                           first, such as a cache on a local disk in front
+                           of a cache on a shared filesystem. A tier that
+                           does not have the image copies it from the next
+                           tier that has it, and only the last tier pulls
+                           images. The image is always returned from the
+                           first tier.
     :param singularity_exe: path to singularity, only necessary if singularity
                             is not in PATH.
+    :param lock_backend: name of the lock backend. See get_lock_backend.
+    :param max_size: maximum size of the cache in bytes. When the cache
+                     becomes larger after a pull, the least recently used
+                     images are evicted. If not given, the
+                     SINGULARITY_PERMANENTCACHE_MAX_SIZE environment variable
+                     is used. With tiers, this is the size of the last tier.
+    :param metrics: file to which metrics of this call are appended as a line
+                    of JSON: whether it was a cache hit, the tier in which
+                    the image was found, the time spent waiting for locks and
+                    pulling, and the number of bytes pulled. If not given,
+                    the
+                    SINGULARITY_PERMANENTCACHE_METRICS environment variable
+                    is used.
+    :param lock_timeout: maximum number of seconds to wait for a lock that
+                         is held by another process pulling the image. 0
+                         fails right away when the lock is held.
+                         LockTimeoutError is raised when the timeout expires.
+                         If not given, the
+                         SINGULARITY_PERMANENTCACHE_LOCK_TIMEOUT environment
+                         variable is used, or no timeout when it is not set.
+    :param retries: number of times a failed pull is retried, after a
+                    random delay that grows exponentially. If not given, the
+                    SINGULARITY_PERMANENTCACHE_RETRIES environment variable
+                    is used, or DEFAULT_RETRIES when it is not set. Processes
+                    that waited for a pull that failed raise PullFailedError
+                    instead of pulling the image again.
+    :param local_max_size: maximum size in bytes of each tier except the
+                           last. If not given, the
+                           SINGULARITY_PERMANENTCACHE_LOCAL_MAX_SIZE
+                           environment variable is used.
+    :param check_hits: whether to check the size and modification time of
+                       an image in the cache against the cache index before
+                       it is returned. An image that does not match is moved
+                       to the quarantine dir of the cache and pulled again.
+                       If not given, the
+                       SINGULARITY_PERMANENTCACHE_CHECK_HITS environment
+                       variable is used.
     :return: path to the image location.
     """
-    log = logging.getLogger()
+    if metrics is None:
+        metrics = os.environ.get("SINGULARITY_PERMANENTCACHE_METRICS")
+    if lock_timeout is None:
+        lock_timeout = get_lock_timeout_from_env()
+    if retries is None:
+        retries = get_retries_from_env()
+    if max_size is None:
+        max_size = get_max_size_from_env()
+    if local_max_size is None:
+        local_max_size = get_local_max_size_from_env()
+    if check_hits is None:
+        check_hits = get_check_hits_from_env()
+    record = _metrics_record(uri)
+    start = time.monotonic()
+    try:
+        tiers = _cache_tiers(cache_location)
+        max_sizes = [local_max_size] * (len(tiers) - 1) + [max_size]
+        return _pull_image_to_cache(uri, tiers, 0, singularity_exe,
+                                    lock_backend, max_sizes, lock_timeout,
+                                    retries, check_hits, record)
+    except Exception as error:
+        record["error"] = "{0}: {1}".format(type(error).__name__, error)
+        raise
+    finally:
+        record["duration"] = time.monotonic() - start
+        if metrics:
+            write_metrics(metrics, record)
+
+
+def _metrics_record(uri: str) -> Dict:
+    return OrderedDict([
+        ("time", time.time()), ("host", socket.gethostname()),
+        ("pid", os.getpid()), ("uri", uri), ("hit", True), ("tier", None),
+        ("lock_wait", 0.0), ("pull_duration", None), ("attempts", 0),
+        ("bytes", 0)])
+
+
+def get_retries_from_env() -> int:
+    """
+    Get the number of retries of failed pulls from the
+    SINGULARITY_PERMANENTCACHE_RETRIES environment variable.
+    :return: the number of retries, or DEFAULT_RETRIES when it is not set.
+    """
+    retries = os.environ.get("SINGULARITY_PERMANENTCACHE_RETRIES")
+    return int(retries) if retries else DEFAULT_RETRIES
+
 
+def get_check_hits_from_env() -> bool:
+    """
+    Get whether cache hits are checked from the
+    SINGULARITY_PERMANENTCACHE_CHECK_HITS environment variable.
+    :return: True when the variable is set to 1, true, yes or on.
+    """
+    return os.environ.get("SINGULARITY_PERMANENTCACHE_CHECK_HITS",
+                          "").lower() in ("1", "true", "yes", "on")
+
+
+class PullFailedError(RuntimeError):
+    """
+    Raised when another process failed to pull an image while this process
+    was waiting for it.
+    """
+
+
+def _temporary_path(image_path: Path) -> Path:
+    # Unique for each attempt, so files that are left behind by aborted
+    # pulls never get in the way.
+    return image_path.with_name("{0}.{1}.tmp".format(image_path.name,
+                                                     uuid.uuid4().hex))
+
+
+def _remove_temporary_files(image_path: Path):
+    # Must be called while the lock for image_path is held. Any temporary
+    # file for the image is then left behind by an aborted pull.
+    stale = list(image_path.parent.glob(glob.escape(image_path.name) +
+                                        ".*.tmp"))
+    # Temporary files of older versions.
+    stale.append(image_path.with_suffix(".tmp"))
+    for file in stale:
+        try:
+            file.unlink()
+        except FileNotFoundError:
+            continue
+        logging.getLogger().info(
+            "Removed temporary file of an aborted pull: {0}".format(file))
+
+
+def _read_failed_pull(failed: Path) -> Optional[Dict]:
+    # The failure recorded by _record_failed_pull, or None if there is none.
+    try:
+        failure = json.loads(failed.read_text())
+    except FileNotFoundError:
+        return None
+    except ValueError:  # Written by an older version.
+        failure = {}
+    return failure if isinstance(failure, dict) else {}
+
+
+def _check_failed_pull(failed: Path, before: Optional[Dict]):
+    # Failures are recorded so that processes that waited for a pull do not
+    # all try again. A failure that was recorded already before this process
+    # started waiting is outdated, and the pull is tried again. Failures are
+    # compared by their id rather than by time, because the clocks of the
+    # machines that share a cache may differ.
+    failure = _read_failed_pull(failed)
+    if failure is None:
+        return
+    if before is not None and failure.get("id") == before.get("id"):
+        failed.unlink()
+        return
+    raise PullFailedError(
+        "Pulling {0} failed in process {1} on {2} while this process was "
+        "waiting for it: {3}\n{4}".format(
+            failure.get("uri"), failure.get("pid"), failure.get("host"),
+            failure.get("error"), failure.get("output") or ""))
+
+
+def _pull(singularity_exe: str, uri: str, image_path: Path, record: Dict,
+          retries: int) -> Path:
+    fetch = get_fetch_backend(uri)
+    start = time.monotonic()
+    for attempt in itertools.count(1):
+        image_tmp = _temporary_path(image_path)
+        record["attempts"] = attempt
+        try:
+            fetch(uri, image_tmp, singularity_exe)
+            break
+        except BaseException as error:
+            if image_tmp.exists():
+                image_tmp.unlink()
+            delay = _retry_delay(uri, error, attempt, retries)
+            if delay is None:
+                raise
+        time.sleep(delay)
+    _record_pull(record, start, image_tmp)
+    return image_tmp
+
+
+def _retry_delay(uri: str, error: BaseException, attempt: int,
+                 retries: int) -> Optional[float]:
+    # The time to wait before a failed pull is tried again, or None if it is
+    # not retried.
+    if (not isinstance(error, (subprocess.CalledProcessError, FetchError)) or
+            isinstance(error, FetchError) and not error.retryable or
+            attempt > retries):
+        return None
+    # Random delays spread the retries of many jobs that failed at the same
+    # time.
+    delay = random.uniform(0, RETRY_BACKOFF * 2 ** (attempt - 1))
+    logging.getLogger().warning(
+        "Pulling {0} failed. Retrying in {1:.1f} seconds ({2}/{3})."
+        "".format(uri, delay, attempt, retries))
+    return delay
+
+
+def _record_pull(record: Dict, start: float, image_tmp: Path):
+    record["hit"] = False
+    record["pull_duration"] = time.monotonic() - start
+    record["bytes"] = image_tmp.stat().st_size
+
+
+def _cache_tiers(cache_location: Optional[CacheLocation]) -> List[Path]:
     if cache_location is None:
         cache = get_cache_dir_from_env()
-        log.info("Cache dir from environment: {0}".format(cache))
-    else:
-        cache = cache_location
+        logging.getLogger().info(
+            "Cache dir from environment: {0}".format(cache))
+        return [cache]
+    if isinstance(cache_location, (Path, str)):
+        return [Path(cache_location)]
+    tiers = [Path(tier) for tier in cache_location]
+    if not tiers:
+        raise ValueError("No cache dirs given.")
+    return tiers
+
+
+def _fill_from_tier(uri: str, image_path: Path, index: CacheIndex,
+                    source_image: Path, lock_backend: Optional[str]):
+    # Must be called while the lock for image_path is held. The image is
+    # stored under the same name as in the other tier, so its checksum does
+    # not have to be calculated again.
+    source = source_image.resolve()
+    digest = checksum = None
+    if source.parent.name == "image-sha256":
+        digest = source.stem
+    elif source.parent.name == "sha256":
+        checksum = source.stem
+    logging.getLogger().info("Copying image {0} to {1}".format(
+        source, image_path))
+    image_tmp = _temporary_path(image_path)
+    try:
+        copy_file(source, image_tmp)
+    except BaseException:
+        if image_tmp.exists():
+            image_tmp.unlink()
+        raise
+    store_image(image_path, image_tmp, digest, index, uri, lock_backend,
+                checksum)
+
 
+def _cache_hit(uri: str, image_path: Path, lock_backend: Optional[str],
+               check_hits: bool) -> bool:
+    # Fast path for cache hits. Images are only added to the cache by an
+    # atomic rename, so an image that exists is always complete and no lock
+    # is needed to use it.
+    log = logging.getLogger()
+    if not image_path.exists():
+        return False
+    log.info("Image exists already at: {0}".format(str(image_path)))
+    intact = True
+    # A failure to update the index should never fail a cache hit. Neither
+    # should a cache hit wait for other processes that use the index. The
+    # access time is updated by a later hit in that case.
+    try:
+        with open_index(image_path.parent, lock_backend,
+                        CACHE_HIT_INDEX_TIMEOUT) as index:
+            # Images that fail the check are handled with the lock held.
+            intact = not check_hits or index.check_image(uri, image_path)
+            if intact:
+                index.record_access(uri, image_path)
+    except (sqlite3.Error, OSError) as error:
+        # A busy index is expected when many processes use the cache.
+        busy = (isinstance(error, TimeoutError) or
+                isinstance(error, sqlite3.OperationalError) and
+                "locked" in str(error))
+        (log.info if busy else log.warning)(
+            "Could not update the cache index: {0}".format(error))
+    # Check again after recording the access. If the image was evicted in
+    # the meantime it is pulled again.
+    return intact and image_path.exists()
+
+
+def _create_cache_dir(cache: Path):
     if not cache.exists():
-        log.warning("Cache dir does not yet exist. "
-                    "Creating cache dir: {0}".format(str(cache)))
+        logging.getLogger().warning(
+            "Cache dir does not yet exist. "
+            "Creating cache dir: {0}".format(str(cache)))
         # Use exist_ok=True, as the path might already be created by a
         # process running almost at the same time. Integrating a lock to
         # prevent race conditions will be difficult.
         cache.mkdir(parents=True, exist_ok=True)
 
+
+def _find_image(uri: str, image_path: Path, index: CacheIndex,
+                lock_backend: Optional[str], check_hits: bool, failed: Path,
+                failure_before: Optional[Dict]) -> bool:
+    # Must be called while the lock for image_path is held. Another process
+    # may have pulled the image while this process was waiting for the lock.
+    # If not, the cache is prepared for pulling the image.
+    log = logging.getLogger()
+    if not (image_path.is_symlink() or image_path.exists()):
+        _rename_image(uri, Path(image_path.parent,
+                                _legacy_filename(uri) + ".sif"),
+                      image_path, index, lock_backend)
+    if (check_hits and image_path.exists() and
+            not index.check_image(uri, image_path)):
+        log.warning("Image {0} does not have the size and modification "
+                    "time in the cache index.".format(image_path))
+        _quarantine(image_path.parent, index, uri, lock_backend)
+    if image_path.exists():
+        log.info("Image exists already at: {0}".format(str(image_path)))
+        index.record_access(uri, image_path)
+        return True
+    _check_failed_pull(failed, failure_before)
+    _remove_temporary_files(image_path)
+    return False
+
+
+def _rename_image(uri: str, old_path: Path, image_path: Path,
+                  index: CacheIndex, lock_backend: Optional[str]) -> bool:
+    # Must be called while the lock for image_path is held. Renames an image
+    # entry with a filename of an older version, so the image does not have
+    # to be pulled again. Older filenames were not unique, so the entry is
+    # only renamed when no other URI in the index uses it.
+    if (old_path == image_path or
+            not (old_path.is_symlink() or old_path.exists())):
+        return False
+    lock_class = get_lock_backend(lock_backend)
+    with lock_class(str(old_path) + ".lock", uri=uri):
+        # Check again now that the lock is held.
+        if (image_path.is_symlink() or image_path.exists() or
+                not (old_path.is_symlink() or old_path.exists()) or
+                set(index.uris_with_path(old_path.name)) - {uri}):
+            return False
+        logging.getLogger().info("Renaming image {0} to {1}".format(
+            old_path, image_path))
+        old_path.rename(image_path)
+        index.move(uri, image_path)
+    return True
+
+
+def _record_failed_pull(
+        failed: Path, uri: str,
+        error: Union[subprocess.CalledProcessError, FetchError]):
+    # Replaced atomically, so the failure is never read half written.
+    failed_tmp = _temporary_path(failed)
+    failed_tmp.write_text(json.dumps(dict(
+        id=uuid.uuid4().hex, host=socket.gethostname(), pid=os.getpid(),
+        uri=uri, error=str(error), output=error.output, time=time.time())))
+    failed_tmp.replace(failed)
+
+
+def _pull_image_to_cache(uri: str, tiers: List[Path], tier: int,
+                         singularity_exe: str, lock_backend: Optional[str],
+                         max_sizes: List[Optional[int]],
+                         lock_timeout: Optional[float], retries: int,
+                         check_hits: bool, record: Dict) -> Path:
+    cache = tiers[tier]
     image_path = Path(cache, uri_to_filename(uri) + ".sif")
-    lockfile_path = Path(cache, ".lock")
+    if _cache_hit(uri, image_path, lock_backend, check_hits):
+        record["tier"] = tier
+        return image_path
+    _create_cache_dir(cache)
 
-    # Place the lock before the checking of image existence to prevent race
-    # conditions.
-    with SimpleUnixFileLock(str(lockfile_path)):
-        if not image_path.exists():
+    # Each image has its own lock. This way pulls of different images can run
+    # in parallel and a long pull does not block cache hits on other images.
+    # No lock on the cache dir is needed: images are only ever added by an
+    # atomic rename.
+    lockfile_path = Path(cache, image_path.name + ".lock")
+    failed = Path(cache, image_path.name + ".failed")
+
+    # Check again after the lock is acquired. Another process may have pulled
+    # the image while this process was waiting for the lock.
+    lock_class = get_lock_backend(lock_backend)
+    lock_start = time.monotonic()
+    failure_before = _read_failed_pull(failed)
+    with lock_class(str(lockfile_path), lock_timeout, uri), \
+            open_index(cache, lock_backend) as index:
+        record["lock_wait"] += time.monotonic() - lock_start
+        if _find_image(uri, image_path, index, lock_backend, check_hits,
+                       failed, failure_before):
+            record["tier"] = tier
+        else:
+            try:
+                if tier + 1 < len(tiers):
+                    # Faster tiers are filled from the next tier, which
+                    # gets the image from the one after it, and so on. The
+                    # last tier pulls it.
+                    _fill_from_tier(uri, image_path, index,
+                                    _pull_image_to_cache(
+                                        uri, tiers, tier + 1, singularity_exe,
+                                        lock_backend, max_sizes,
+                                        lock_timeout, retries, check_hits,
+                                        record),
+                                    lock_backend)
+                else:
+                    _pull_and_store(uri, image_path, image_digest(uri),
+                                    index, singularity_exe, lock_backend,
+                                    lock_timeout, retries, record)
+            except (subprocess.CalledProcessError, FetchError) as error:
+                _record_failed_pull(failed, uri, error)
+                raise
+            if failed.exists():
+                failed.unlink()
+    # Evict after the image lock is released. Evicting takes the locks of
+    # other images, which could otherwise deadlock with another process that
+    # does the same.
+    if max_sizes[tier] is not None:
+        evict_images(cache, max_sizes[tier], lock_backend)
+    return image_path
+
+
+def _pull_and_store(uri: str, image_path: Path, digest: Optional[str],
+                    index: CacheIndex, singularity_exe: str,
+                    lock_backend: Optional[str],
+                    lock_timeout: Optional[float], retries: int,
+                    record: Dict):
+    # Must be called while the lock for image_path is held. Images are
+    # pulled to a temporary file first to prevent corruptions when the
+    # singularity command exits with errors.
+    log = logging.getLogger()
+    if digest is None:
+        log.info("Start pulling image {0} to location {1}"
+                 "".format(uri, str(image_path)))
+        image_tmp = _pull(singularity_exe, uri, image_path, record, retries)
+        store_image(image_path, image_tmp, None, index, uri, lock_backend)
+        return
+    # Images with a digest are pulled while the blob lock is held, so the
+    # same image is pulled only once, also from mirrors.
+    blob = blob_path(image_path.parent, digest, True)
+    blob.parent.mkdir(parents=True, exist_ok=True)
+    lock_class = get_lock_backend(lock_backend)
+    lock_start = time.monotonic()
+    with lock_class(str(blob) + ".lock", lock_timeout, uri):
+        record["lock_wait"] += time.monotonic() - lock_start
+        checksum = None
+        if blob.exists():
+            log.info("Image with digest {0} exists already in the "
+                     "cache.".format(digest))
+        else:
             log.info("Start pulling image {0} to location {1}"
                      "".format(uri, str(image_path)))
-            # Pull to a temporary image first to prevent corruptions when the
-            # singularity command exits with errors.
-            image_tmp = image_path.with_suffix(".tmp")
-            singularity_command(singularity_exe, "pull", str(image_tmp), uri)
-            image_tmp.rename(image_path)
+            image_tmp = _pull(singularity_exe, uri, image_path, record,
+                              retries)
+            # The image is stored by digest, so its checksum is calculated
+            # only to be able to verify it later.
+            checksum = sha256_file(image_tmp)
+            image_tmp.rename(blob)
+        _add_image(index, uri, image_path, blob, checksum)
+
+
+def pull_images_to_cache(uris: Iterable[str],
+                         cache_location: Optional[CacheLocation] = None,
+                         singularity_exe=DEFAULT_SINGULARITY_EXE,
+                         jobs: int = DEFAULT_JOBS,
+                         lock_backend: Optional[str] = None,
+                         max_size: Optional[int] = None,
+                         metrics: Optional[str] = None,
+                         lock_timeout: Optional[float] = None,
+                         retries: Optional[int] = None,
+                         local_max_size: Optional[int] = None,
+                         check_hits: Optional[bool] = None
+                         ) -> Dict[str, Path]:
+    """
+    Pull multiple images to the cache. Images that are not in the cache yet
+    are pulled at the same time.
+    :param uris: Valid singularity image uris.
+    :param cache_location: Location to pull the images to. If not given tries
+                           to get the location from the environment. See
+                           pull_image_to_cache for tiers.
+    :param singularity_exe: path to singularity, only necessary if singularity
+                            is not in PATH.
+    :param jobs: the maximum number of images that are pulled at the same
+                 time.
+    :param lock_backend: name of the lock backend. See get_lock_backend.
+    :param max_size: maximum size of the cache in bytes. See
+                     pull_image_to_cache.
+    :param metrics: file to which metrics are appended. See
+                    pull_image_to_cache.
+    :param lock_timeout: maximum number of seconds to wait for each lock.
+                         See pull_image_to_cache.
+    :param retries: number of times a failed pull is retried. See
+                    pull_image_to_cache.
+    :param local_max_size: maximum size in bytes of each tier except the
+                           last. See pull_image_to_cache.
+    :param check_hits: whether to check images in the cache before they are
+                       returned. See pull_image_to_cache.
+    :return: an ordered mapping of each uri to its image location.
+    """
+    tiers = _cache_tiers(cache_location)
+    # Pulls of different images use different locks, so threads are enough to
+    # run them at the same time.
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = OrderedDict(
+            (uri, executor.submit(pull_image_to_cache, uri, tiers,
+                                  singularity_exe, lock_backend, max_size,
+                                  metrics, lock_timeout, retries,
+                                  local_max_size, check_hits))
+            for uri in OrderedDict.fromkeys(uris))
+    return OrderedDict((uri, future.result())
+                       for uri, future in futures.items())
+
+
+class _AsyncLock:
+    """
+    Async context manager for a lock of one of the LOCK_BACKENDS. Attempts
+    to acquire the lock are spaced out with asyncio.sleep, so waiting for
+    the lock does not block the event loop.
+    """
+    def __init__(self, lock):
+        self.lock = lock
+
+    async def __aenter__(self):
+        attempts = self.lock._entering(self.lock.timeout)
+        try:
+            for interval in attempts:
+                await asyncio.sleep(interval)
+        finally:
+            # Gives up the attempt when the waiting task is cancelled.
+            attempts.close()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.lock.__exit__(exc_type, exc_val, exc_tb)
+
+
+# Pulls that are in progress in each event loop by uri and cache tiers, so
+# concurrent calls for the same image share them.
+_async_pulls = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary
+
+
+async def pull_image_to_cache_async(
+        uri: str, cache_location: Optional[CacheLocation] = None,
+        singularity_exe=DEFAULT_SINGULARITY_EXE,
+        lock_backend: Optional[str] = None,
+        max_size: Optional[int] = None,
+        metrics: Optional[str] = None,
+        lock_timeout: Optional[float] = None,
+        retries: Optional[int] = None,
+        local_max_size: Optional[int] = None,
+        check_hits: Optional[bool] = None) -> Path:
+    """
+    Pull image to the cache from an asyncio event loop, such as the one of a
+    workflow engine. Works like pull_image_to_cache, without blocking the
+    event loop: singularity runs as an asyncio subprocess, locks are polled
+    with asyncio.sleep and the cache index and image files are handled in
+    the default executor of the loop.
+
+    Concurrent calls for the same image and cache in the same event loop
+    share one pull, which uses the arguments of the first call and writes
+    one metrics record. Cancelling a call does not cancel the pull for the
+    other calls.
+    :param uri: Valid singularity image uri.
+    :param cache_location: Location to pull the image to. See
+                           pull_image_to_cache.
+    :param singularity_exe: path to singularity, only necessary if singularity
+                            is not in PATH.
+    :param lock_backend: name of the lock backend. See get_lock_backend.
+    :param max_size: maximum size of the cache in bytes. See
+                     pull_image_to_cache.
+    :param metrics: file to which metrics are appended. See
+                    pull_image_to_cache.
+    :param lock_timeout: maximum number of seconds to wait for each lock.
+                         See pull_image_to_cache.
+    :param retries: number of times a failed pull is retried. See
+                    pull_image_to_cache.
+    :param local_max_size: maximum size in bytes of each tier except the
+                           last. See pull_image_to_cache.
+    :param check_hits: whether to check the image in the cache before it is
+                       returned. See pull_image_to_cache.
+    :return: path to the image location.
+    """
+    tiers = _cache_tiers(cache_location)
+    pulls = _async_pulls.setdefault(asyncio.get_event_loop(), {})
+    key = (uri, tuple(tiers))
+    pull = pulls.get(key)
+    if pull is None:
+        pull = asyncio.ensure_future(_pull_with_metrics_async(
+            uri, tiers, singularity_exe, lock_backend, max_size, metrics,
+            lock_timeout, retries, local_max_size, check_hits))
+        pulls[key] = pull
+        pull.add_done_callback(lambda _: pulls.pop(key, None))
+    return await asyncio.shield(pull)
+
+
+async def _pull_with_metrics_async(
+        uri: str, tiers: List[Path], singularity_exe: str,
+        lock_backend: Optional[str], max_size: Optional[int],
+        metrics: Optional[str], lock_timeout: Optional[float],
+        retries: Optional[int], local_max_size: Optional[int],
+        check_hits: Optional[bool]) -> Path:
+    if metrics is None:
+        metrics = os.environ.get("SINGULARITY_PERMANENTCACHE_METRICS")
+    if lock_timeout is None:
+        lock_timeout = get_lock_timeout_from_env()
+    if retries is None:
+        retries = get_retries_from_env()
+    if max_size is None:
+        max_size = get_max_size_from_env()
+    if local_max_size is None:
+        local_max_size = get_local_max_size_from_env()
+    if check_hits is None:
+        check_hits = get_check_hits_from_env()
+    record = _metrics_record(uri)
+    start = time.monotonic()
+    try:
+        max_sizes = [local_max_size] * (len(tiers) - 1) + [max_size]
+        return await _pull_image_to_cache_async(
+            uri, tiers, 0, singularity_exe, lock_backend, max_sizes,
+            lock_timeout, retries, check_hits, record)
+    except Exception as error:
+        record["error"] = "{0}: {1}".format(type(error).__name__, error)
+        raise
+    finally:
+        record["duration"] = time.monotonic() - start
+        if metrics:
+            write_metrics(metrics, record)
+
+
+async def _pull_image_to_cache_async(
+        uri: str, tiers: List[Path], tier: int, singularity_exe: str,
+        lock_backend: Optional[str], max_sizes: List[Optional[int]],
+        lock_timeout: Optional[float], retries: int, check_hits: bool,
+        record: Dict) -> Path:
+    # The same steps as _pull_image_to_cache. Steps that use the cache index
+    # run in the executor and open the index themselves, because an SQLite
+    # connection can only be used in the thread that opened it.
+    loop = asyncio.get_event_loop()
+    cache = tiers[tier]
+    image_path = Path(cache, uri_to_filename(uri) + ".sif")
+    if await loop.run_in_executor(None, _cache_hit, uri, image_path,
+                                  lock_backend, check_hits):
+        record["tier"] = tier
+        return image_path
+    _create_cache_dir(cache)
+    lockfile_path = Path(cache, image_path.name + ".lock")
+    failed = Path(cache, image_path.name + ".failed")
+
+    def find_image() -> bool:
+        with open_index(cache, lock_backend) as index:
+            return _find_image(uri, image_path, index, lock_backend,
+                               check_hits, failed, failure_before)
+
+    def fill_from_tier(source_image: Path):
+        with open_index(cache, lock_backend) as index:
+            _fill_from_tier(uri, image_path, index, source_image,
+                            lock_backend)
+
+    lock_class = get_lock_backend(lock_backend)
+    lock_start = time.monotonic()
+    failure_before = _read_failed_pull(failed)
+    async with _AsyncLock(lock_class(str(lockfile_path), lock_timeout, uri)):
+        record["lock_wait"] += time.monotonic() - lock_start
+        if await loop.run_in_executor(None, find_image):
+            record["tier"] = tier
         else:
-            log.info("Image exists already at: {0}".format(str(image_path)))
+            try:
+                if tier + 1 < len(tiers):
+                    source_image = await _pull_image_to_cache_async(
+                        uri, tiers, tier + 1, singularity_exe, lock_backend,
+                        max_sizes, lock_timeout, retries, check_hits, record)
+                    await loop.run_in_executor(None, fill_from_tier,
+                                               source_image)
+                else:
+                    await _pull_and_store_async(
+                        uri, image_path, image_digest(uri), singularity_exe,
+                        lock_backend, lock_timeout, retries, record)
+            except (subprocess.CalledProcessError, FetchError) as error:
+                _record_failed_pull(failed, uri, error)
+                raise
+            if failed.exists():
+                failed.unlink()
+    if max_sizes[tier] is not None:
+        await loop.run_in_executor(None, evict_images, cache,
+                                   max_sizes[tier], lock_backend)
     return image_path
 
 
-def main():
-    args = argument_parser().parse_args()
+async def _pull_and_store_async(uri: str, image_path: Path,
+                                digest: Optional[str], singularity_exe: str,
+                                lock_backend: Optional[str],
+                                lock_timeout: Optional[float], retries: int,
+                                record: Dict):
+    # The same steps as _pull_and_store.
+    log = logging.getLogger()
+    loop = asyncio.get_event_loop()
+    cache = image_path.parent
+    log.info("Start pulling image {0} to location {1}"
+             "".format(uri, str(image_path)))
+
+    def store(image_tmp: Path):
+        with open_index(cache, lock_backend) as index:
+            store_image(image_path, image_tmp, None, index, uri,
+                        lock_backend)
+
+    def add_image(blob: Path, checksum: Optional[str]):
+        with open_index(cache, lock_backend) as index:
+            _add_image(index, uri, image_path, blob, checksum)
+
+    if digest is None:
+        image_tmp = await _pull_async(singularity_exe, uri, image_path,
+                                      record, retries)
+        await loop.run_in_executor(None, store, image_tmp)
+        return
+    blob = blob_path(cache, digest, True)
+    blob.parent.mkdir(parents=True, exist_ok=True)
+    lock_class = get_lock_backend(lock_backend)
+    lock_start = time.monotonic()
+    async with _AsyncLock(lock_class(str(blob) + ".lock", lock_timeout, uri)):
+        record["lock_wait"] += time.monotonic() - lock_start
+        checksum = None
+        if blob.exists():
+            log.info("Image with digest {0} exists already in the "
+                     "cache.".format(digest))
+        else:
+            image_tmp = await _pull_async(singularity_exe, uri, image_path,
+                                          record, retries)
+            checksum = await loop.run_in_executor(None, sha256_file,
+                                                  image_tmp)
+            image_tmp.rename(blob)
+        await loop.run_in_executor(None, add_image, blob, checksum)
+
+
+async def _pull_async(singularity_exe: str, uri: str, image_path: Path,
+                      record: Dict, retries: int) -> Path:
+    # Singularity runs as an asyncio subprocess. The other fetch backends
+    # run in the executor.
+    loop = asyncio.get_event_loop()
+    fetch = get_fetch_backend(uri)
+    start = time.monotonic()
+    for attempt in itertools.count(1):
+        image_tmp = _temporary_path(image_path)
+        record["attempts"] = attempt
+        try:
+            if fetch is fetch_with_singularity:
+                await singularity_command_async(singularity_exe, "pull",
+                                                str(image_tmp), uri)
+            else:
+                await loop.run_in_executor(None, fetch, uri, image_tmp,
+                                           singularity_exe)
+            break
+        except BaseException as error:
+            if image_tmp.exists():
+                image_tmp.unlink()
+            delay = _retry_delay(uri, error, attempt, retries)
+            if delay is None:
+                raise
+        await asyncio.sleep(delay)
+    _record_pull(record, start, image_tmp)
+    return image_tmp
+
+
+async def pull_images_to_cache_async(
+        uris: Iterable[str],
+        cache_location: Optional[CacheLocation] = None,
+        singularity_exe=DEFAULT_SINGULARITY_EXE,
+        jobs: int = DEFAULT_JOBS,
+        lock_backend: Optional[str] = None,
+        max_size: Optional[int] = None,
+        metrics: Optional[str] = None,
+        lock_timeout: Optional[float] = None,
+        retries: Optional[int] = None,
+        local_max_size: Optional[int] = None,
+        check_hits: Optional[bool] = None) -> Dict[str, Path]:
+    """
+    Pull multiple images to the cache from an asyncio event loop. Works like
+    pull_images_to_cache. See pull_image_to_cache_async.
+    :param uris: Valid singularity image uris.
+    :param cache_location: Location to pull the images to. See
+                           pull_image_to_cache.
+    :param singularity_exe: path to singularity, only necessary if singularity
+                            is not in PATH.
+    :param jobs: the maximum number of images that this call pulls at the
+                 same time.
+    :param lock_backend: name of the lock backend. See get_lock_backend.
+    :param max_size: maximum size of the cache in bytes. See
+                     pull_image_to_cache.
+    :param metrics: file to which metrics are appended. See
+                    pull_image_to_cache.
+    :param lock_timeout: maximum number of seconds to wait for each lock.
+                         See pull_image_to_cache.
+    :param retries: number of times a failed pull is retried. See
+                    pull_image_to_cache.
+    :param local_max_size: maximum size in bytes of each tier except the
+                           last. See pull_image_to_cache.
+    :param check_hits: whether to check images in the cache before they are
+                       returned. See pull_image_to_cache.
+    :return: an ordered mapping of each uri to its image location.
+    """
+    tiers = _cache_tiers(cache_location)
+    semaphore = asyncio.Semaphore(jobs)
+
+    async def pull(uri: str) -> Path:
+        async with semaphore:
+            return await pull_image_to_cache_async(
+                uri, tiers, singularity_exe, lock_backend, max_size, metrics,
+                lock_timeout, retries, local_max_size, check_hits)
+
+    unique_uris = list(OrderedDict.fromkeys(uris))
+    # Like pull_images_to_cache, all pulls finish before an error is raised.
+    results = await asyncio.gather(*[pull(uri) for uri in unique_uris],
+                                   return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return OrderedDict(zip(unique_uris, cast(List[Path], results)))
+
+
+def resolve_images(uris: Iterable[str], manifest: Path,
+                   cache_location: Optional[CacheLocation] = None,
+                   singularity_exe=DEFAULT_SINGULARITY_EXE,
+                   jobs: int = DEFAULT_JOBS,
+                   lock_backend: Optional[str] = None,
+                   pin_for: float = DEFAULT_MANIFEST_PIN) -> Dict[str, Dict]:
+    """
+    Make sure images are in the cache and write a manifest with their
+    locations, so the jobs of a workflow can look them up with
+    lookup_images without using the cache. The images are pulled at the
+    same time and are pinned, so they are not evicted while the workflow
+    runs. The manifest is a JSON file with the uri, absolute path and
+    digest of each image. It is replaced atomically.
+    :param uris: Valid singularity image uris.
+    :param manifest: the file to write the manifest to.
+    :param cache_location: Location to pull the images to. If not given tries
+                           to get the location from the environment. See
+                           pull_image_to_cache for tiers.
+    :param singularity_exe: path to singularity, only necessary if singularity
+                            is not in PATH.
+    :param jobs: the maximum number of images that are pulled at the same
+                 time.
+    :param lock_backend: name of the lock backend. See get_lock_backend.
+    :param pin_for: the number of seconds for which the images are pinned.
+                    Longer pins, for instance by other workflows, are kept.
+                    Use 0 to not pin the images.
+    :return: the images in the manifest.
+    """
+    tiers = _cache_tiers(cache_location)
+    image_paths = pull_images_to_cache(uris, tiers, singularity_exe, jobs,
+                                       lock_backend)
+    # Image paths are in the first tier, so that is where they are pinned.
+    cache = tiers[0]
+    pinned_until = None
+    if pin_for > 0:
+        pinned_until = time.time() + pin_for
+        pin_images(image_paths, cache, pinned_until, lock_backend,
+                   extend=True)
+    images = OrderedDict()  # type: Dict[str, Dict]
+    with open_index(cache, lock_backend) as index:
+        for uri, image_path in image_paths.items():
+            entry = index.get(uri)
+            images[uri] = OrderedDict([
+                ("path", str(image_path.absolute())),
+                ("digest", entry["digest"] if entry is not None else None)])
+    manifest_tmp = manifest.with_name(
+        "{0}.{1}.tmp".format(manifest.name, uuid.uuid4().hex))
+    manifest_tmp.write_text(json.dumps(OrderedDict([
+        ("created", time.time()), ("pinned_until", pinned_until),
+        ("images", images)]), indent=2))
+    manifest_tmp.rename(manifest)
+    return images
+
+
+def lookup_images(uris: Iterable[str], manifest: Path) -> Dict[str, Path]:
+    """
+    Look up the locations of images in a manifest that was written by
+    resolve_images. Only the manifest is read.
+    :param uris: the uris of the images.
+    :param manifest: the manifest file.
+    :return: an ordered mapping of each uri to its image location.
+    """
+    images = json.loads(manifest.read_text())["images"]
+    image_paths = OrderedDict()  # type: Dict[str, Path]
+    for uri in uris:
+        if uri not in images:
+            raise ValueError("Image is not in the manifest {0}: {1}".format(
+                manifest, uri))
+        image_paths[uri] = Path(images[uri]["path"])
+    return image_paths
+
+
+def default_socket_path(cache: Path) -> Path:
+    """
+    Get the default socket path of the cache server for a cache. The socket
+    is on this machine, because sockets only work between processes on the
+    same machine, also when the cache is shared. It is in a dir of the user
+    in XDG_RUNTIME_DIR, or in the temporary directory when that is not set,
+    so other users cannot create it.
+    :param cache: the cache dir.
+    :return: the socket path.
+    """
+    cache_hash = hashlib.sha256(
+        str(cache.absolute()).encode()).hexdigest()[:16]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return Path(runtime_dir, "spc-{0}".format(os.getuid()),
+                "{0}.sock".format(cache_hash))
+
+
+def _make_private_dir(directory: Path):
+    # Creates a dir that only the user can use, or checks that an existing
+    # dir is. Other users could otherwise replace the sockets in it.
+    try:
+        directory.mkdir(mode=0o700)
+    except FileExistsError:
+        pass
+    status = os.lstat(str(directory))
+    if (not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or
+            status.st_mode & 0o077):
+        raise PermissionError("Not a private dir of this user: {0}".format(
+            directory))
+
+
+def _trusted_socket(socket_path: Path) -> bool:
+    # Only sockets of the same user are used. Otherwise any user on the
+    # machine could provide the images.
+    try:
+        status = os.lstat(str(socket_path))
+    except OSError:
+        return False
+    return stat.S_ISSOCK(status.st_mode) and status.st_uid == os.getuid()
+
+
+def _peer_uid(connection: socket.socket) -> Optional[int]:
+    # The user of the process on the other end of a Unix domain socket, or
+    # None on systems without SO_PEERCRED.
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    credentials = connection.getsockopt(
+        socket.SOL_SOCKET, getattr(socket, "SO_PEERCRED"),
+        struct.calcsize("iII"))
+    _, uid, _ = struct.unpack("iII", credentials)
+    return uid
+
+
+def get_socket_path(cache_location: Optional[Path] = None) -> Optional[Path]:
+    """
+    Get the socket path of the cache server from the
+    SINGULARITY_PERMANENTCACHE_SOCKET environment variable, or the default
+    socket path for the cache.
+    :param cache_location: the cache dir. If not given tries to get the
+                           location from the environment.
+    :return: the socket path or None if no cache dir is known.
+    """
+    socket_path = os.environ.get("SINGULARITY_PERMANENTCACHE_SOCKET")
+    if socket_path:
+        return Path(socket_path)
+    cache = cache_location or which_cache()
+    return default_socket_path(cache) if cache is not None else None
+
+
+class _CacheRequestHandler(socketserver.StreamRequestHandler):
+    # Each request is a line of JSON with a "uri" and optionally a
+    # "timeout", "max_size", "check_hits" and "retries". Each response is a
+    # line of JSON with either the image "path" or an "error", and whether
+    # the error is a "timeout".
+    def handle(self):
+        server = cast(CacheServer, self.server)
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode())
+                response = {"path": str(server.resolve(
+                    request["uri"], request.get("timeout"),
+                    request.get("max_size"), request.get("check_hits"),
+                    request.get("retries")))}
+            except Exception as error:
+                response = {"error": "{0}: {1}".format(
+                    type(error).__name__, error),
+                    "timeout": isinstance(error, TimeoutError)}
+            self.wfile.write((json.dumps(response) + "\n").encode())
+
+
+class CacheServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Server that provides images from the cache to processes on the same
+    machine over a Unix domain socket. Known image locations are kept in
+    memory, so a cache hit does not need the cache index or a lock.
+    Concurrent requests for the same image are served by a single pull.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path: Path, cache: CacheLocation,
+                 singularity_exe=DEFAULT_SINGULARITY_EXE,
+                 lock_backend: Optional[str] = None,
+                 max_size: Optional[int] = None,
+                 metrics: Optional[str] = None,
+                 local_max_size: Optional[int] = None):
+        self.socket_path = socket_path
+        self.tiers = _cache_tiers(cache)
+        # Images are returned from the first tier.
+        cache = self.cache = self.tiers[0]
+        self.singularity_exe = singularity_exe
+        self.lock_backend = lock_backend
+        self.max_size = max_size
+        self.metrics = metrics
+        self.local_max_size = local_max_size
+        # URI -> (image path, time of the last access recorded in the index)
+        self._images = {}  # type: Dict[str, Tuple[Path, float]]
+        self._pulls = {}  # type: Dict[str, Future]
+        self._pulls_lock = threading.Lock()
+        # Images that are in the cache already are served right away. Their
+        # access is recorded with the first request.
+        if Path(cache, INDEX_FILE).exists():
+            with open_index(cache, lock_backend) as index:
+                for entry in index.entries():
+                    self._images[entry["uri"]] = (
+                        Path(cache, entry["path"]), float("-inf"))
+        super().__init__(str(socket_path), _CacheRequestHandler)
+
+    def resolve(self, uri: str, timeout: Optional[float] = None,
+                max_size: Optional[int] = None,
+                check_hits: Optional[bool] = None,
+                retries: Optional[int] = None) -> Path:
+        """
+        Get the location of an image, pulling it to the cache if needed.
+        :param uri: Valid singularity image uri.
+        :param timeout: maximum number of seconds to wait for the image to
+                        be pulled. The pull continues when TimeoutError is
+                        raised. No timeout by default.
+        :param max_size: maximum size of the cache in bytes. The maximum
+                         size of the server by default. See
+                         pull_image_to_cache.
+        :param check_hits: whether the image is checked against the cache
+                           index. See pull_image_to_cache.
+        :param retries: number of times a failed pull is retried. See
+                        pull_image_to_cache.
+        :return: path to the image location.
+        """
+        image_path, _ = self._images.get(uri, (None, 0.0))
+        # Checked hits need the index, so they are handled as a pull.
+        if (not check_hits and image_path is not None and
+                image_path.exists()):
+            # The access time must be recorded in the index regularly, so
+            # the image is not evicted while it is in use. This happens in
+            # the background, so a hit does not wait for the index.
+            with self._pulls_lock:
+                recorded = self._images[uri][1]
+                outdated = recorded <= (time.monotonic() -
+                                        ACCESS_TIME_RESOLUTION)
+                if outdated:
+                    self._images[uri] = (image_path, time.monotonic())
+            if outdated:
+                threading.Thread(target=self._record_access,
+                                 args=(uri, image_path), daemon=True).start()
+            return image_path
+        # Pulls run in their own thread, so requests can stop waiting for
+        # them.
+        with self._pulls_lock:
+            future = self._pulls.get(uri)
+            if future is None:
+                future = Future()
+                self._pulls[uri] = future
+                # Requests that arrive during the pull share it, with the
+                # options of the first request.
+                threading.Thread(target=self._pull,
+                                 args=(uri, future, max_size, check_hits,
+                                       retries),
+                                 daemon=True).start()
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            raise TimeoutError("The image is still being pulled: {0}".format(
+                uri))
+
+    def _pull(self, uri: str, future: Future, max_size: Optional[int],
+              check_hits: Optional[bool], retries: Optional[int]):
+        try:
+            image_path = pull_image_to_cache(
+                uri, self.tiers, self.singularity_exe, self.lock_backend,
+                max_size if max_size is not None else self.max_size,
+                self.metrics, retries=retries,
+                local_max_size=self.local_max_size, check_hits=check_hits)
+            self._images[uri] = (image_path, time.monotonic())
+            future.set_result(image_path)
+        except Exception as error:
+            future.set_exception(error)
+        finally:
+            with self._pulls_lock:
+                del self._pulls[uri]
+
+    def server_bind(self):
+        super().server_bind()
+        # Only the user that runs the server can connect.
+        os.chmod(str(self.socket_path), 0o600)
+
+    def _record_access(self, uri: str, image_path: Path):
+        try:
+            with open_index(self.cache, self.lock_backend) as index:
+                index.record_access(uri, image_path)
+        except (sqlite3.Error, OSError) as error:
+            # The access is recorded again after ACCESS_TIME_RESOLUTION.
+            logging.getLogger().warning(
+                "Could not update the cache index: {0}".format(error))
+
+    def server_close(self):
+        super().server_close()
+        try:
+            self.socket_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class CacheServerError(RuntimeError):
+    """Raised when a cache server could not provide an image."""
+
+
+def request_image(uri: str, socket_path: Path,
+                  timeout: Optional[float] = None,
+                  lock_timeout: Optional[float] = None,
+                  max_size: Optional[int] = None,
+                  check_hits: Optional[bool] = None,
+                  retries: Optional[int] = None) -> Optional[Path]:
+    """
+    Get the location of an image from a cache server.
+    :param uri: Valid singularity image uri.
+    :param socket_path: the socket of the cache server.
+    :param timeout: seconds to wait for the server. No timeout by default,
+                    as the server may need to pull the image.
+    :param lock_timeout: maximum number of seconds the server waits for a
+                         pull of the image. No timeout by default.
+    :param max_size: maximum size of the cache in bytes. The maximum size of
+                     the server by default. See pull_image_to_cache.
+    :param check_hits: whether the server checks the image against the
+                       cache index. See pull_image_to_cache.
+    :param retries: number of times the server retries a failed pull. See
+                    pull_image_to_cache.
+    :return: path to the image location, or None if no server of this user
+             is running on the socket.
+    :raises TimeoutError: when either timeout expired.
+    :raises CacheServerError: when the server could not provide the image.
+    """
+    request = {"uri": uri}  # type: Dict
+    for key, value in (("timeout", lock_timeout), ("max_size", max_size),
+                       ("check_hits", check_hits), ("retries", retries)):
+        if value is not None:
+            request[key] = value
+    log = logging.getLogger()
+    if not _trusted_socket(socket_path):
+        log.warning("Not using {0}, because it is not a socket of this "
+                    "user.".format(socket_path))
+        return None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        try:
+            client.connect(str(socket_path))
+        except OSError as error:
+            # Only then the caller can pull the image itself. Otherwise the
+            # server may be pulling it already.
+            log.info("Cache server at {0} is not available: {1}".format(
+                socket_path, error))
+            return None
+        # The socket may have been replaced after it was checked.
+        peer_uid = _peer_uid(client)
+        if peer_uid is not None and peer_uid != os.getuid():
+            log.warning("Not using the cache server at {0}, because it is "
+                        "run by another user.".format(socket_path))
+            return None
+        try:
+            client.sendall((json.dumps(request) + "\n").encode())
+            response = client.makefile("rb").readline()
+        except socket.timeout:
+            raise TimeoutError("The cache server at {0} did not provide {1} "
+                               "within {2} seconds.".format(
+                                   socket_path, uri, timeout))
+        except OSError as error:
+            raise CacheServerError("Lost the connection to the cache server "
+                                   "at {0}: {1}".format(socket_path, error))
+    try:
+        reply = json.loads(response.decode())
+    except ValueError:
+        raise CacheServerError("Invalid response from the cache server at "
+                               "{0}: {1!r}".format(socket_path, response))
+    if "path" not in reply:
+        message = "Cache server could not provide {0}: {1}".format(
+            uri, reply.get("error"))
+        if reply.get("timeout"):
+            raise TimeoutError(message)
+        raise CacheServerError(message)
+    return Path(reply["path"])
+
+
+def serve(cache_location: Optional[CacheLocation] = None,
+          socket_path: Optional[Path] = None,
+          singularity_exe=DEFAULT_SINGULARITY_EXE,
+          lock_backend: Optional[str] = None,
+          max_size: Optional[int] = None,
+          metrics: Optional[str] = None,
+          local_max_size: Optional[int] = None):
+    """
+    Run a cache server until it is interrupted.
+    :param cache_location: the cache dir, or the cache dirs of each tier. If
+                           not given tries to get the location from the
+                           environment.
+    :param socket_path: the socket to listen on. See get_socket_path for the
+                        default.
+    :param singularity_exe: path to singularity, only necessary if singularity
+                            is not in PATH.
+    :param lock_backend: name of the lock backend. See get_lock_backend.
+    :param max_size: maximum size of the cache in bytes. See
+                     pull_image_to_cache.
+    :param metrics: file to which metrics are appended. See
+                    pull_image_to_cache.
+    :param local_max_size: maximum size in bytes of each tier except the
+                           last. See pull_image_to_cache.
+    """
+    log = logging.getLogger()
+    tiers = _cache_tiers(cache_location)
+    cache = tiers[0]
+    cache.mkdir(parents=True, exist_ok=True)
+    socket_path = socket_path or get_socket_path(cache)
+    assert socket_path is not None
+    if socket_path == default_socket_path(cache):
+        _make_private_dir(socket_path.parent)
+    if socket_path.exists():
+        # Remove the socket of a server that did not shut down properly.
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            try:
+                client.connect(str(socket_path))
+            except ConnectionRefusedError:
+                socket_path.unlink()
+            else:
+                raise OSError("A cache server is already running on: "
+                              "{0}".format(socket_path))
+    server = CacheServer(socket_path, tiers, singularity_exe, lock_backend,
+                         max_size, metrics, local_max_size)
+    log.warning("Serving cache {0} on {1}".format(cache, socket_path))
+    # Make sure the socket is removed when the server is terminated.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def read_uris(file: str) -> List[str]:
+    """
+    Read URIs from a file with one URI per line. Empty lines and lines
+    starting with '#' are skipped.
+    :param file: the file to read. '-' reads from stdin.
+    :return: a list of URIs.
+    """
+    if file == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        lines = Path(file).read_text().splitlines()
+    return [line.strip() for line in lines
+            if line.strip() and not line.strip().startswith("#")]
+
+
+def migrate_cache(cache_location: Optional[Path] = None,
+                  lock_backend: Optional[str] = None) -> List[Path]:
+    """
+    Move images that are stored as plain files in the cache, as done by older
+    versions, into the content-addressed store. Then rename the image
+    entries in the index that have a filename of an older version (see
+    uri_to_filename). The images are not pulled again. Images are renamed
+    when they are used as well, so this is optional. Images that are not in
+    the index keep their filename of an older version, because it does not
+    give their URI. A warning is logged for each of them.
+    :param cache_location: the cache dir. If not given tries to get the
+                           location from the environment.
+    :param lock_backend: name of the lock backend. See get_lock_backend.
+    :return: the image entries that were migrated.
+    """
+    log = logging.getLogger()
+    cache = cache_location or get_cache_dir_from_env()
+    lock_class = get_lock_backend(lock_backend)
+    migrated = []
+    with open_index(cache, lock_backend) as index:
+        for image_path in sorted(cache.glob("*.sif")):
+            if image_path.is_symlink():
+                continue
+            with lock_class(str(image_path) + ".lock"):
+                # Check again now that the lock is held.
+                if image_path.is_symlink() or not image_path.exists():
+                    continue
+                log.info("Migrating image: {0}".format(image_path))
+                _migrate_image(image_path, index, lock_backend)
+                migrated.append(image_path)
+        for entry in index.entries():
+            uri = entry["uri"]
+            image_path = Path(cache, uri_to_filename(uri) + ".sif")
+            if entry["path"] == image_path.name:
+                continue
+            # The same lock order as for images that are renamed when they
+            # are used: first the new name, then the old one.
+            with lock_class(str(image_path) + ".lock", uri=uri):
+                old_path = Path(cache, entry["path"])
+                if _rename_image(uri, old_path, image_path, index,
+                                 lock_backend):
+                    if old_path in migrated:
+                        migrated.remove(old_path)
+                    migrated.append(image_path)
+        for image_path in sorted(cache.glob("*.sif")):
+            if _unknown_uri(image_path, index):
+                log.warning(
+                    "Not renaming {0}: its URI is not in the cache index. "
+                    "It is renamed when the image is used.".format(
+                        image_path))
+    return migrated
+
+
+def _unknown_uri(image_path: Path, index: CacheIndex) -> bool:
+    # Whether the URI of an image entry can not be found, which is the case
+    # for filenames of older versions that are not in the index.
+    if index.uris_with_path(image_path.name):
+        return False
+    uri = filename_to_uri(image_path.name)
+    return uri is None or "://" not in uri
+
+
+def _migrate_image(image_path: Path, index: CacheIndex,
+                   lock_backend: Optional[str]):
+    # Must be called while the lock for image_path is held. The blob is
+    # recorded for each URI of the image, so it is removed when the images
+    # are evicted.
+    entries = [index.get(uri) for uri in index.uris_with_path(
+        image_path.name)]
+    if not entries and not _unknown_uri(image_path, index):
+        # Images that are not in the index yet.
+        entries = [{"uri": filename_to_uri(image_path.name), "pulled": None,
+                    "accessed": None}]
+    uris = [cast(Dict, entry)["uri"] for entry in entries]
+    # Store a hard link, so the image entry stays valid until it is
+    # replaced by the symlink to the store.
+    _remove_temporary_files(image_path)
+    image_tmp = _temporary_path(image_path)
+    os.link(str(image_path), str(image_tmp))
+    blob = store_image(image_path, image_tmp, image_digest(image_path.name),
+                       index if uris else None, uris[0] if uris else None,
+                       lock_backend)
+    for entry in entries:
+        entry = cast(Dict, entry)
+        if entry["uri"] != uris[0]:
+            index.record(entry["uri"], image_path, blob)
+        # Moving the image is not a use of it.
+        index.set_times(entry["uri"], entry["pulled"], entry["accessed"])
+
+
+def _quarantine(cache: Path, index: CacheIndex, uri: str,
+                lock_backend: Optional[str]):
+    # Must be called while the lock for the image is held. The image file is
+    # moved out of the cache rather than removed, so it can be inspected.
+    # Other images that share the file are pulled again when they are used,
+    # because their entries no longer resolve.
+    log = logging.getLogger()
+    entry = index.get(uri)
+    if entry is None:
+        return
+    image_path = Path(cache, entry["path"])
+    quarantine = Path(cache, QUARANTINE_DIR)
+    quarantine.mkdir(exist_ok=True)
+    index.remove(uri)
+    if entry["blob"] is None:
+        if image_path.exists():
+            log.warning("Moving image {0} to {1}".format(image_path,
+                                                         quarantine))
+            image_path.rename(Path(quarantine, image_path.name))
+        return
+    blob = Path(cache, entry["blob"])
+    lock_class = get_lock_backend(lock_backend)
+    with lock_class(str(blob) + ".lock"):
+        if blob.exists():
+            log.warning("Moving image {0} to {1}".format(blob, quarantine))
+            blob.rename(Path(quarantine, blob.name))
+    if image_path.is_symlink():
+        image_path.unlink()
+
+
+def verify_cache(cache_location: Optional[Path] = None,
+                 jobs: int = DEFAULT_JOBS,
+                 lock_backend: Optional[str] = None) -> List[str]:
+    """
+    Check the sha256 checksums of all images in the cache index. Corrupt
+    images are moved to the quarantine dir of the cache and removed from the
+    index, so they are pulled again when they are used. Images that share a
+    file are read once. Images without a recorded checksum, such as images
+    that were added by older versions, get the calculated checksum recorded.
+    :param cache_location: the cache dir. If not given tries to get the
+                           location from the environment.
+    :param jobs: the number of images that are read at the same time, each
+                 in its own process.
+    :param lock_backend: name of the lock backend. See get_lock_backend.
+    :return: the uris of the corrupt images.
+    """
+    log = logging.getLogger()
+    cache = cache_location or get_cache_dir_from_env()
+    if not Path(cache, INDEX_FILE).exists():
+        return []
+    lock_class = get_lock_backend(lock_backend)
+    # The entries of each file.
+    files = OrderedDict()  # type: Dict[str, List[Dict]]
+    with open_index(cache, lock_backend) as index:
+        for entry in index.entries():
+            files.setdefault(entry["blob"] or entry["path"], []).append(entry)
+    corrupt = []  # type: List[str]
+    with ProcessPoolExecutor(max_workers=jobs) as executor, \
+            open_index(cache, lock_backend) as index:
+        futures = OrderedDict(
+            (file, executor.submit(sha256_file, Path(cache, file)))
+            for file in files)
+        for file, future in futures.items():
+            try:
+                checksum = future.result()
+            except FileNotFoundError:
+                # Evicted while the cache was verified.
+                log.info("Image file was removed: {0}".format(file))
+                continue
+            expected = next((entry["sha256"] for entry in files[file]
+                             if entry["sha256"] is not None), None)
+            if expected is None:
+                log.info("Recording checksum of {0}".format(file))
+                index.set_checksum(file, checksum)
+                continue
+            if checksum == expected:
+                continue
+            log.warning("Checksum of {0} is {1} instead of {2}.".format(
+                file, checksum, expected))
+            for entry in files[file]:
+                image_path = Path(cache, entry["path"])
+                with lock_class(str(image_path) + ".lock"):
+                    # The image may have been pulled again meanwhile.
+                    current = index.get(entry["uri"])
+                    if (current is None or
+                            (current["blob"] or current["path"]) != file):
+                        continue
+                    _quarantine(cache, index, entry["uri"], lock_backend)
+                    corrupt.append(entry["uri"])
+    return corrupt
+
+
+class _HashingReader:
+    # Calculates the sha256 checksum of the data that is read from a file.
+    def __init__(self, file_h: BinaryIO):
+        self.file_h = file_h
+        self.checksum = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file_h.read(size)
+        self.checksum.update(data)
+        return data
+
+
+def export_images(uris: Iterable[str], bundle: BinaryIO,
+                  cache_location: Optional[Path] = None):
+    """
+    Write images from the cache to a bundle, so they can be imported in a
+    cache that cannot pull them. The bundle is a tar stream with for each
+    image the image file, followed by a JSON file with the uri and sha256
+    checksum of the image. The images are written while they are read, so
+    the bundle can be written to a pipe.
+    :param uris: the uris of the images.
+    :param bundle: a binary file to write the bundle to.
+    :param cache_location: the cache dir. If not given tries to get the
+                           location from the environment.
+    """
+    cache = cache_location or get_cache_dir_from_env()
+    images = OrderedDict(
+        (uri, Path(cache, uri_to_filename(uri) + ".sif"))
+        for uri in uris)
+    # Check all images before anything is written.
+    for uri, image_path in images.items():
+        if not image_path.exists():
+            raise ValueError("Image is not in the cache: {0}".format(uri))
+    with tarfile.open(fileobj=bundle, mode="w|",
+                      format=tarfile.PAX_FORMAT) as tar:
+        for uri, image_path in images.items():
+            # An image that is open stays readable when it is evicted.
+            with image_path.open("rb") as image_h:
+                info = tar.gettarinfo(arcname=image_path.name,
+                                      fileobj=image_h)
+                reader = _HashingReader(image_h)
+                tar.addfile(info, reader)
+            metadata = json.dumps(OrderedDict(
+                [("uri", uri), ("sha256", reader.checksum.hexdigest())]),
+                indent=2).encode()
+            info = tarfile.TarInfo(image_path.name + ".json")
+            info.size = len(metadata)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(metadata))
+
+
+def import_images(bundle: BinaryIO, cache_location: Optional[Path] = None,
+                  lock_backend: Optional[str] = None,
+                  lock_timeout: Optional[float] = None
+                  ) -> Dict[str, Path]:
+    """
+    Add the images in a bundle that was written by export_images to the
+    cache. The images are added with the same locks and atomic renames as
+    pulled images, so the cache can be used while they are imported. Images
+    that are in the cache already are skipped. The bundle is read as a
+    stream and each image is written to the cache directly, so the bundle
+    can be read from a pipe.
+    :param bundle: a binary file to read the bundle from.
+    :param cache_location: the cache dir. If not given tries to get the
+                           location from the environment.
+    :param lock_backend: name of the lock backend. See get_lock_backend.
+    :param lock_timeout: maximum number of seconds to wait for the lock of
+                         each image. See pull_image_to_cache.
+    :return: an ordered mapping of the uri of each image in the bundle to
+             its location in the cache.
+    """
+    cache = cache_location or get_cache_dir_from_env()
+    cache.mkdir(parents=True, exist_ok=True)
+    images = OrderedDict()  # type: Dict[str, Path]
+    with tarfile.open(fileobj=bundle, mode="r|") as tar:
+        # Iterating over the tar file does not work here, because the
+        # metadata of each image is read with tar.next() as well.
+        for member in iter(tar.next, None):
+            if (not member.isfile() or not member.name.endswith(".sif") or
+                    Path(member.name).name != member.name):
+                raise ValueError("Unexpected file in bundle: {0}".format(
+                    member.name))
+            uri, image_path = _import_image(tar, member, cache, lock_backend,
+                                            lock_timeout)
+            images[uri] = image_path
+    return images
+
+
+def _import_image(tar: tarfile.TarFile, member: tarfile.TarInfo,
+                  cache: Path, lock_backend: Optional[str],
+                  lock_timeout: Optional[float]) -> Tuple[str, Path]:
+    log = logging.getLogger()
+    member_path = Path(cache, member.name)
+    lock_class = get_lock_backend(lock_backend)
+    # The uri is only known after the image, which is read while the lock
+    # is held. The name of the image in the bundle gives the lock.
+    with lock_class(str(Path(cache, member.name + ".lock")), lock_timeout):
+        image_tmp = None
+        checksum = hashlib.sha256()
+        if not member_path.exists():
+            _remove_temporary_files(member_path)
+            image_tmp = _temporary_path(member_path)
+            log.info("Importing image from bundle: {0}".format(member.name))
+            source = cast(BinaryIO, tar.extractfile(member))
+            with image_tmp.open("wb") as tmp_h:
+                for block in iter(lambda: source.read(COPY_BUFFER_SIZE),
+                                  b""):
+                    checksum.update(block)
+                    tmp_h.write(block)
+        try:
+            metadata_member = tar.next()
+            if (metadata_member is None or
+                    metadata_member.name != member.name + ".json"):
+                raise ValueError("No metadata in bundle for: {0}".format(
+                    member.name))
+            metadata = json.loads(cast(
+                BinaryIO, tar.extractfile(metadata_member)).read().decode())
+            uri = metadata["uri"]
+            image_path = Path(cache, uri_to_filename(uri) + ".sif")
+            # Bundles of older versions use the filenames of those.
+            if member.name not in (image_path.name,
+                                   _legacy_filename(uri) + ".sif"):
+                raise ValueError("Image {0} in bundle does not match its uri: "
+                                 "{1}".format(member.name, uri))
+            if (image_tmp is not None and
+                    checksum.hexdigest() != metadata["sha256"]):
+                raise ValueError("Checksum of image {0} in bundle does not "
+                                 "match. The bundle is corrupt."
+                                 "".format(uri))
+            if image_path == member_path:
+                _store_imported_image(uri, image_path, image_tmp,
+                                      checksum.hexdigest(), lock_backend)
+                return uri, image_path
+            if image_tmp is not None:
+                # Otherwise the temporary file would be removed as a stale
+                # file by the next import of the image in the bundle.
+                moved_tmp = _temporary_path(image_path)
+                image_tmp.rename(moved_tmp)
+                image_tmp = moved_tmp
+        except BaseException:
+            if image_tmp is not None and image_tmp.exists():
+                image_tmp.unlink()
+            raise
+    # The image of an older bundle is stored under the filename of its uri,
+    # with the lock of that filename. The locks are not nested, because
+    # images are renamed with the lock of the new filename held first.
+    try:
+        with lock_class(str(Path(cache, image_path.name + ".lock")),
+                        lock_timeout):
+            _store_imported_image(uri, image_path, image_tmp,
+                                  checksum.hexdigest(), lock_backend)
+    except BaseException:
+        if image_tmp is not None and image_tmp.exists():
+            image_tmp.unlink()
+        raise
+    return uri, image_path
+
+
+def _store_imported_image(uri: str, image_path: Path,
+                          image_tmp: Optional[Path], checksum: str,
+                          lock_backend: Optional[str]):
+    # Must be called while the lock for image_path is held.
+    log = logging.getLogger()
+    with open_index(image_path.parent, lock_backend) as index:
+        if not (image_path.is_symlink() or image_path.exists()):
+            _rename_image(uri, Path(image_path.parent,
+                                    _legacy_filename(uri) + ".sif"),
+                          image_path, index, lock_backend)
+        if image_path.exists():
+            log.info("Image exists already at: {0}".format(image_path))
+            index.record_access(uri, image_path)
+            if image_tmp is not None and image_tmp.exists():
+                image_tmp.unlink()
+        elif image_tmp is None:
+            # An image with the filename of the older version is in the
+            # cache, so the image was not read from the bundle. It is not
+            # renamed because other images have that filename as well.
+            raise ValueError("Image {0} was not imported, because another "
+                             "image in the cache has its filename of an "
+                             "older version.".format(uri))
+        else:
+            store_image(image_path, image_tmp, image_digest(uri), index, uri,
+                        lock_backend, checksum)
+
+
+def _format_time(timestamp: Optional[float]) -> str:
+    if timestamp is None:
+        return "-"
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+def _index_entry_output(cache: Path, entry: Dict) -> Dict:
+    output = OrderedDict(entry)
+    output["path"] = str(Path(cache, entry["path"]))
+    if entry["blob"] is not None:
+        output["blob"] = str(Path(cache, entry["blob"]))
+    return output
+
+
+def list_command(args: argparse.Namespace):
+    cache = _cache_dir(args) or get_cache_dir_from_env()
+    entries = []  # type: List[Dict]
+    if Path(cache, INDEX_FILE).exists():
+        with open_index(cache, args.lock_backend) as index:
+            entries = index.entries()
+    if args.output_format == "json":
+        print(json.dumps([_index_entry_output(cache, entry)
+                          for entry in entries], indent=2))
+        return
+    for entry in entries:
+        print(entry["uri"], entry["size"], _format_time(entry["accessed"]),
+              Path(cache, entry["path"]), sep="\t")
+
+
+def info_command(args: argparse.Namespace):
+    cache = _cache_dir(args) or get_cache_dir_from_env()
+    entry = None
+    if Path(cache, INDEX_FILE).exists():
+        with open_index(cache, args.lock_backend) as index:
+            entry = index.get(args.uri)
+    if entry is None:
+        sys.exit("Image is not in the cache: {0}".format(args.uri))
+    print(json.dumps(_index_entry_output(cache, entry), indent=2))
+
+
+def gc_command(args: argparse.Namespace):
+    max_size = args.max_size
+    if max_size is None:
+        max_size = get_max_size_from_env()
+    if max_size is None:
+        sys.exit("No maximum cache size given. Please use --max-size or set "
+                 "'SINGULARITY_PERMANENTCACHE_MAX_SIZE'.")
+    for uri in evict_images(_cache_dir(args), max_size, args.lock_backend):
+        print(uri)
+
+
+def pin_command(args: argparse.Namespace):
+    try:
+        pin_images(args.uris, _cache_dir(args),
+                   lock_backend=args.lock_backend)
+    except ValueError as error:
+        sys.exit(str(error))
+
+
+def unpin_command(args: argparse.Namespace):
+    try:
+        unpin_images(args.uris, _cache_dir(args), args.lock_backend)
+    except ValueError as error:
+        sys.exit(str(error))
+
+
+def migrate_command(args: argparse.Namespace):
+    migrated = migrate_cache(_cache_dir(args), args.lock_backend)
+    print("Migrated {0} images.".format(len(migrated)))
+
+
+def export_command(args: argparse.Namespace):
+    bundle = (sys.stdout.buffer if args.output == "-"
+              else open(args.output, "wb"))
+    try:
+        export_images(args.uris, cast(BinaryIO, bundle), _cache_dir(args))
+    except ValueError as error:
+        sys.exit(str(error))
+    finally:
+        if bundle is not sys.stdout.buffer:
+            bundle.close()
+
+
+def import_command(args: argparse.Namespace):
+    lock_timeout = args.lock_timeout
+    if lock_timeout is None:
+        lock_timeout = get_lock_timeout_from_env()
+    bundle = (sys.stdin.buffer if args.bundle == "-"
+              else open(args.bundle, "rb"))
+    try:
+        images = import_images(cast(BinaryIO, bundle), _cache_dir(args),
+                               args.lock_backend, lock_timeout)
+    except (ValueError, KeyError, tarfile.TarError) as error:
+        sys.exit("Could not import {0}: {1}".format(args.bundle, error))
+    except LockTimeoutError as error:
+        logging.getLogger().error(str(error))
+        sys.exit(os.EX_TEMPFAIL)
+    finally:
+        if bundle is not sys.stdin.buffer:
+            bundle.close()
+    for uri, path in images.items():
+        print(uri, path, sep="\t")
+
+
+def resolve_command(args: argparse.Namespace):
+    if args.jobs < 1:
+        sys.exit("--jobs must be at least 1.")
+    images = resolve_images(args.uris, Path(args.manifest),
+                            _cache_tiers_from_args(args),
+                            args.singularity_exe, args.jobs,
+                            args.lock_backend, args.pin_for)
+    for uri, image in images.items():
+        print(uri, image["path"], sep="\t")
+
+
+def lookup_command(args: argparse.Namespace):
+    try:
+        image_paths = lookup_images(args.uris, Path(args.manifest))
+    except (OSError, ValueError, KeyError) as error:
+        sys.exit(str(error))
+    if len(args.uris) == 1:
+        print(image_paths[args.uris[0]], end="")
+        return
+    for uri, path in image_paths.items():
+        print(uri, path, sep="\t")
+
+
+def verify_command(args: argparse.Namespace):
+    if args.jobs < 1:
+        sys.exit("--jobs must be at least 1.")
+    corrupt = verify_cache(_cache_dir(args), args.jobs, args.lock_backend)
+    for uri in corrupt:
+        print(uri)
+    if corrupt:
+        sys.exit(1)
+
+
+def serve_command(args: argparse.Namespace):
+    serve(_cache_tiers_from_args(args),
+          Path(args.socket) if args.socket is not None else None,
+          args.singularity_exe, args.lock_backend, args.max_size,
+          args.metrics, args.local_max_size)
+
+
+def _cache_dir(args: argparse.Namespace) -> Optional[Path]:
+    return Path(args.cache_dir) if args.cache_dir is not None else None
+
+
+def _cache_tiers_from_args(args: argparse.Namespace) -> Optional[List[Path]]:
+    return ([Path(cache_dir) for cache_dir in args.cache_dir]
+            if args.cache_dir else None)
+
+
+def setup_logging(args: argparse.Namespace):
     log_level = max(logging.WARNING + (args.quiet - args.verbose) * 10, 0)
     log = logging.getLogger()  # gets the root logger.
     logging.basicConfig()  # This adds the default handler to the root logger.
     log.setLevel(log_level)
-    cache_dir = Path(args.cache_dir) if args.cache_dir is not None else None
-    image_path = pull_image_to_cache(args.uri, cache_dir,
-                                     args.singularity_exe)
-    print(image_path, end="")
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        args = command_parser().parse_args()
+        setup_logging(args)
+        args.func(args)
+        return
+
+    parser = argument_parser()
+    # Commands after the options, as in 'spc -d DIR list', would otherwise
+    # be pulled as images, or fail on the options of the command.
+    args, unknown = parser.parse_known_args()
+    if args.uris and args.uris[0] in COMMANDS:
+        parser.error("'{0}' is a command. Commands must be given before "
+                     "their options: {1} {0} [OPTIONS]"
+                     "".format(args.uris[0], parser.prog))
+    if unknown:
+        parser.error("unrecognized arguments: {0}".format(" ".join(unknown)))
+    setup_logging(args)
+    uris = list(args.uris)
+    if args.from_file is not None:
+        uris.extend(read_uris(args.from_file))
+    if not uris:
+        parser.error("No images given. Provide one or more <IMAGE> arguments "
+                     "or use --from-file.")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+    lock_timeout = args.lock_timeout
+    if lock_timeout is None:
+        lock_timeout = get_lock_timeout_from_env()
+    try:
+        _pull_command(args, uris, lock_timeout)
+    except TimeoutError as error:
+        # A distinct exit status, so schedulers can retry the job later. This
+        # includes timeouts of a cache server.
+        logging.getLogger().error(str(error))
+        sys.exit(os.EX_TEMPFAIL)
+    except CacheServerError as error:
+        logging.getLogger().error(str(error))
+        sys.exit(1)
+
+
+def _pull_command(args: argparse.Namespace, uris: List[str],
+                  lock_timeout: Optional[float]):
+    tiers = _cache_tiers_from_args(args)
+
+    # Use a cache server on this machine if there is one.
+    socket_path = (Path(args.socket) if args.socket is not None
+                   else get_socket_path(tiers[0] if tiers else None))
+    use_server = socket_path is not None and socket_path.exists()
+
+    def server_request(uri: str) -> Optional[Path]:
+        # The server pulls with the options of this command.
+        return request_image(
+            uri, cast(Path, socket_path), lock_timeout=lock_timeout,
+            max_size=(args.max_size if args.max_size is not None
+                      else get_max_size_from_env()),
+            check_hits=(args.check_hits if args.check_hits is not None
+                        else get_check_hits_from_env()),
+            retries=(args.retries if args.retries is not None
+                     else get_retries_from_env()))
+
+    # A single image on the command line only prints its location. This
+    # keeps the output usable in scripts: IMAGE=$(spc docker://...)
+    if len(args.uris) == 1 and args.from_file is None:
+        image_path = None
+        if use_server:
+            image_path = server_request(uris[0])
+        if image_path is None:
+            image_path = pull_image_to_cache(uris[0], tiers,
+                                             args.singularity_exe,
+                                             args.lock_backend, args.max_size,
+                                             args.metrics, lock_timeout,
+                                             args.retries, args.local_max_size,
+                                             args.check_hits)
+        print(image_path, end="")
+        return
+
+    uris = list(OrderedDict.fromkeys(uris))
+    image_paths = OrderedDict.fromkeys(uris)
+    if use_server:
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            image_paths.update(zip(uris, executor.map(server_request,
+                                                      uris)))
+    missing = [uri for uri, path in image_paths.items() if path is None]
+    if missing:
+        image_paths.update(pull_images_to_cache(
+            missing, tiers, args.singularity_exe, args.jobs,
+            args.lock_backend, args.max_size, args.metrics, lock_timeout,
+            args.retries, args.local_max_size, args.check_hits))
+    if args.output_format == "json":
+        print(json.dumps(OrderedDict((uri, str(path)) for uri, path
+                                     in image_paths.items()), indent=2))
+    else:
+        for uri, path in image_paths.items():
+            print(uri, path, sep="\t")
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -17,20 +17,71 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import asyncio
+import functools
+import hashlib
+import http.server
+import io
+import json
+import logging
+import multiprocessing
+import multiprocessing.pool
 import os
+import socket
+import socketserver
+import sqlite3
+import subprocess
 import sys
+import tarfile
 import tempfile
 import threading
 import time
 from pathlib import Path
+from typing import List, Optional
 
 import pytest
 
-from singularity_permanent_cache import (SimpleUnixFileLock,
+import singularity_permanent_cache
+from singularity_permanent_cache import (CacheIndex,
+                                         CacheServer,
+                                         CacheServerError,
+                                         FetchError,
+                                         LeaseFileLock,
+                                         LockTimeoutError,
+                                         PosixFileLock,
+                                         SimpleUnixFileLock,
+                                         copy_file,
+                                         default_socket_path,
+                                         evict_images,
+                                         export_images,
+                                         fetch_file,
+                                         fetch_http,
+                                         fetch_with_singularity,
+                                         filename_to_uri,
                                          get_cache_dir_from_env,
+                                         get_fetch_backend,
+                                         get_lock_backend,
+                                         image_digest,
+                                         import_images,
+                                         lookup_images,
                                          main,
+                                         migrate_cache,
+                                         parse_duration,
+                                         parse_size,
+                                         pin_images,
                                          pull_image_to_cache,
-                                         uri_to_filename)
+                                         pull_image_to_cache_async,
+                                         pull_images_to_cache,
+                                         pull_images_to_cache_async,
+                                         request_image,
+                                         resolve_images,
+                                         sha256_file,
+                                         singularity_command,
+                                         singularity_command_async,
+                                         store_image,
+                                         uri_to_filename,
+                                         verify_cache)
+from singularity_permanent_cache import cli
 
 
 def test_get_cache_dir_from_env_sing_cachedir_set(monkeypatch):
@@ -58,24 +109,45 @@ def test_get_cache_dir_from_env_no_env(monkeypatch):
 
 URIS = [
     ("docker://quay.io/biocontainers/bedtools:2.23.0--hdbcaa40_3",
-     "docker_quay.io_biocontainers_bedtools_2.23.0--hdbcaa40_3"),
+     "docker%3A%2F%2Fquay.io%2Fbiocontainers%2Fbedtools%3A"
+     "2.23.0--hdbcaa40_3"),
     ("docker://quay.io/biocontainers/"
      "mulled-v2-002f51ea92721407ef440b921fb5940f424be842:"
      "43ec6124f9f4f875515f9548733b8b4e5fed9aa6-0",
-     "docker_quay.io_biocontainers_mulled-v2-"
-     "002f51ea92721407ef440b921fb5940f424be842_"
+     "docker%3A%2F%2Fquay.io%2Fbiocontainers%2Fmulled-v2-"
+     "002f51ea92721407ef440b921fb5940f424be842%3A"
      "43ec6124f9f4f875515f9548733b8b4e5fed9aa6-0"),
     ("docker://debian@sha256:"
      "f05c05a218b7a4a5fe979045b1c8e2a9ec3524e5611ebfdd0ef5b8040f9008fa",
-     "docker_debian@sha256_"
-     "f05c05a218b7a4a5fe979045b1c8e2a9ec3524e5611ebfdd0ef5b8040f9008fa"
-     )
+     "docker%3A%2F%2Fdebian@sha256%3A"
+     "f05c05a218b7a4a5fe979045b1c8e2a9ec3524e5611ebfdd0ef5b8040f9008fa"),
+    # Names that were the same in older versions.
+    ("docker://a/b:c", "docker%3A%2F%2Fa%2Fb%3Ac"),
+    ("docker://a_b:c", "docker%3A%2F%2Fa_b%3Ac"),
+    ("library://.hidden/ümlaut image",
+     "library%3A%2F%2F.hidden%2F%C3%BCmlaut%20image"),
+    (".hidden", "%2Ehidden"),
+    ("docker://quay.io/biocontainers/" + "x" * 200,
+     "sha256~" + hashlib.sha256(
+         ("docker://quay.io/biocontainers/" + "x" * 200).encode()
+     ).hexdigest()),
 ]
 
 
 @pytest.mark.parametrize(["uri", "result"], URIS)
 def test_uri_to_filename(uri, result):
     assert uri_to_filename(uri) == result
+    if result.startswith("sha256~"):
+        assert filename_to_uri(result + ".sif") is None
+    else:
+        assert filename_to_uri(result + ".sif") == uri
+        assert filename_to_uri(result) == uri
+
+
+@pytest.mark.parametrize("filename", [
+    "docker_debian%2.sif", "%FF.sif", "docker%3a%2f%2fdebian"])
+def test_filename_to_uri_not_created_by_uri_to_filename(filename):
+    assert filename_to_uri(filename) is None
 
 
 def test_filelock():
@@ -111,6 +183,175 @@ def test_filelock():
     assert len(execution_times) == count
 
 
+def _hold_lock(lock, times_file: str):
+    with lock:
+        start = time.time()
+        time.sleep(0.2)
+        with open(times_file, mode="at") as file_h:
+            file_h.write("{0}\t{1}\n".format(start, time.time()))
+
+
+@pytest.mark.parametrize("lock_factory", [
+    lambda file, host: PosixFileLock(file),
+    # Each process simulates a different machine.
+    lambda file, host: LeaseFileLock(file, poll_interval=0.01, hostname=host)
+], ids=["lockf", "lease"])
+def test_filelock_multiple_processes(tmp_path, lock_factory):
+    lockfile = str(tmp_path / "lock")
+    times_file = str(tmp_path / "times")
+    processes = [
+        multiprocessing.Process(
+            target=_hold_lock,
+            args=(lock_factory(lockfile, "node{0}".format(i)), times_file))
+        for i in range(5)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    times = sorted(tuple(float(time_) for time_ in line.split("\t"))
+                   for line in Path(times_file).read_text().splitlines())
+    assert len(times) == 5
+    for (_, end), (next_start, _) in zip(times, times[1:]):
+        assert end <= next_start
+
+
+def test_lease_lock_released(tmp_path):
+    lockfile = tmp_path / "lock"
+    with LeaseFileLock(str(lockfile)):
+        holder = json.loads(lockfile.read_text())
+        assert holder["pid"] == os.getpid()
+    assert not lockfile.exists()
+
+
+def test_lease_lock_dead_process_on_same_host(tmp_path):
+    lockfile = tmp_path / "lock"
+    process = multiprocessing.Process(target=time.sleep, args=(0,))
+    process.start()
+    process.join()
+    lock = LeaseFileLock(str(lockfile), poll_interval=0.01)
+    lockfile.write_text(json.dumps(dict(host=lock.hostname, pid=process.pid,
+                                        token="dead")))
+    start = time.monotonic()
+    with lock:
+        assert "dead" not in lockfile.read_text()
+    # No need to wait for the lease to time out.
+    assert time.monotonic() - start < 1
+
+
+def test_lease_lock_stale_other_host(tmp_path):
+    lockfile = tmp_path / "lock"
+    lockfile.write_text(json.dumps(dict(host="othernode", pid=1,
+                                        token="stale")))
+    start = time.monotonic()
+    with LeaseFileLock(str(lockfile), stale_after=0.5, poll_interval=0.01):
+        assert "stale" not in lockfile.read_text()
+    assert time.monotonic() - start >= 0.5
+
+
+def test_get_lock_backend(monkeypatch):
+    monkeypatch.delenv("SINGULARITY_PERMANENTCACHE_LOCK_BACKEND",
+                       raising=False)
+    assert get_lock_backend() is SimpleUnixFileLock
+    assert get_lock_backend("lockf") is PosixFileLock
+    monkeypatch.setenv("SINGULARITY_PERMANENTCACHE_LOCK_BACKEND", "lease")
+    assert get_lock_backend() is LeaseFileLock
+    with pytest.raises(ValueError) as error:
+        get_lock_backend("nfs")
+    error.match("Unknown lock backend: 'nfs'")
+
+
+def _hold_lock_until(lock_class, lockfile: str, acquired, release):
+    with lock_class(lockfile, uri="docker://debian:10"):
+        acquired.set()
+        release.wait(10)
+
+
+@pytest.mark.parametrize("lock_class", [
+    SimpleUnixFileLock, PosixFileLock,
+    functools.partial(LeaseFileLock, poll_interval=0.05)
+], ids=["flock", "lockf", "lease"])
+def test_lock_timeout(tmp_path, lock_class):
+    lockfile = str(tmp_path / "lock")
+    acquired = multiprocessing.Event()
+    release = multiprocessing.Event()
+    process = multiprocessing.Process(
+        target=_hold_lock_until, args=(lock_class, lockfile, acquired,
+                                       release))
+    process.start()
+    try:
+        assert acquired.wait(10)
+        # Try-lock mode.
+        with pytest.raises(LockTimeoutError) as error:
+            with lock_class(lockfile, timeout=0):
+                pass
+        assert error.value.holder["pid"] == process.pid
+        assert error.value.holder["uri"] == "docker://debian:10"
+        error.match("held by process {0} on .* for docker://debian:10"
+                    "".format(process.pid))
+        start = time.monotonic()
+        with pytest.raises(LockTimeoutError):
+            with lock_class(lockfile, timeout=0.3):
+                pass
+        assert time.monotonic() - start >= 0.3
+        threading.Timer(0.3, release.set).start()
+        with lock_class(lockfile, timeout=10):
+            pass
+    finally:
+        release.set()
+        process.join()
+    # The information about the holder is removed when the lock is released.
+    assert lock_class(lockfile).holder() is None
+
+
+LOCKF_PROBE = """
+import fcntl
+import sys
+with open(sys.argv[1], "r+b") as lock_h:
+    try:
+        fcntl.lockf(lock_h, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        sys.exit(1)
+"""
+
+
+def test_lockf_thread_timeout_keeps_lock(tmp_path):
+    # Closing any file descriptor of the lock file would release the lock
+    # of the thread that holds it.
+    lockfile = str(tmp_path / "lock")
+    acquired = threading.Event()
+    release = threading.Event()
+    holder = threading.Thread(target=_hold_lock_until,
+                              args=(PosixFileLock, lockfile, acquired,
+                                    release))
+    holder.start()
+    try:
+        assert acquired.wait(10)
+        with pytest.raises(LockTimeoutError) as error:
+            with PosixFileLock(lockfile, timeout=0.1):
+                pass
+        assert error.value.holder["pid"] == os.getpid()
+        assert error.value.holder["uri"] == "docker://debian:10"
+        probe = subprocess.run([sys.executable, "-c", LOCKF_PROBE, lockfile])
+        assert probe.returncode == 1
+    finally:
+        release.set()
+        holder.join()
+    probe = subprocess.run([sys.executable, "-c", LOCKF_PROBE, lockfile])
+    assert probe.returncode == 0
+
+
+def test_lock_timeout_main(fake_singularity, tmp_path, caplog):
+    uri = "docker://debian:buster-slim"
+    lockfile = str(tmp_path / (uri_to_filename(uri) + ".sif.lock"))
+    sys.argv = ["spc", "-d", str(tmp_path), "-s", str(fake_singularity()),
+                "--lock-timeout", "0", uri]
+    with SimpleUnixFileLock(lockfile, uri=uri):
+        with pytest.raises(SystemExit) as error:
+            main()
+    assert error.value.code == os.EX_TEMPFAIL
+    assert "held by process {0}".format(os.getpid()) in caplog.text
+
+
 def test_pull_image_to_cache(caplog, monkeypatch):
     caplog.set_level(0)
     cache_dir = Path(tempfile.mktemp())
@@ -118,8 +359,8 @@ def test_pull_image_to_cache(caplog, monkeypatch):
     assert not cache_dir.exists()
     pull_image_to_cache("docker://hello-world")
     assert cache_dir.exists()
-    assert (cache_dir / "docker_hello-world.sif").exists()
-    assert (cache_dir / ".lock").exists()
+    assert (cache_dir / "docker%3A%2F%2Fhello-world.sif").exists()
+    assert (cache_dir / "docker%3A%2F%2Fhello-world.sif.lock").exists()
     messages = "|".join(caplog.messages)  # Join to allow substring matching.
     assert "Cache dir from environment:" in messages
     assert "Cache dir does not yet exist" in messages
@@ -135,25 +376,272 @@ def test_pull_image_to_existing_cache(caplog, monkeypatch):
     cache_dir = Path(tempfile.mktemp())
     assert not cache_dir.exists()
     pull_image_to_cache("docker://hello-world", cache_dir)
-    os.remove(str(cache_dir / ".lock"))
-    assert (cache_dir / "docker_hello-world.sif").exists()
+    os.remove(str(cache_dir / "docker%3A%2F%2Fhello-world.sif.lock"))
+    assert (cache_dir / "docker%3A%2F%2Fhello-world.sif").exists()
 
     # Run again with clear log
     caplog.clear()
     pull_image_to_cache("docker://hello-world", cache_dir)
 
-    assert (cache_dir / "docker_hello-world.sif").exists()
-    assert (cache_dir / ".lock").exists()
+    assert (cache_dir / "docker%3A%2F%2Fhello-world.sif").exists()
+    # Cache hits do not use the lock.
+    assert not (cache_dir / "docker%3A%2F%2Fhello-world.sif.lock").exists()
     messages = "|".join(caplog.messages)  # Join to allow substring matching.
     assert "Cache dir from environment:" not in messages
     assert "Cache dir does not yet exist" not in messages
     assert "Start pulling image" not in messages
-    assert "Waiting for file lock" in messages
-    assert "Lock acquired" in messages
-    assert "Lock released" in messages
+    assert "Waiting for file lock" not in messages
+    assert "Lock acquired" not in messages
+    assert "Lock released" not in messages
     assert "Image exists already at" in messages
 
 
+FAKE_SINGULARITY = """#!{python}
+import sys
+import time
+from pathlib import Path
+
+# Mimics 'singularity pull <destination> <uri>'. Start and end times of each
+# pull are logged so tests can check which pulls ran in parallel.
+delay = float({delay!r})
+command, destination, uri = sys.argv[1:4]
+start = time.time()
+time.sleep(delay)
+Path(destination).write_text({content!r} or uri)
+with open({log!r}, "at") as log_h:
+    log_h.write("\\t".join([uri, str(start), str(time.time())]) + "\\n")
+"""
+
+
+@pytest.fixture()
+def fake_singularity(tmp_path):
+    """Returns a function that creates a fake singularity executable."""
+    def make_fake_singularity(delay: float = 0.0,
+                              content: Optional[str] = None) -> Path:
+        # The image contains its URI, unless content is given.
+        exe = tmp_path / "singularity"
+        exe.write_text(FAKE_SINGULARITY.format(
+            python=sys.executable, delay=delay, content=content,
+            log=str(tmp_path / "pulls.log")))
+        exe.chmod(0o755)
+        return exe
+    return make_fake_singularity
+
+
+def read_pull_log(fake_singularity_exe: Path):
+    log = fake_singularity_exe.parent / "pulls.log"
+    if not log.exists():
+        return []
+    return [(uri, float(start), float(end)) for uri, start, end in
+            (line.split("\t") for line in log.read_text().splitlines())]
+
+
+def test_pull_different_images_in_parallel(fake_singularity, tmp_path):
+    exe = fake_singularity(delay=1.0)
+    cache_dir = tmp_path / "cache"
+    uris = ["docker://debian:buster-slim", "docker://ubuntu:20.04"]
+    threads = [threading.Thread(target=pull_image_to_cache,
+                                args=(uri, cache_dir, str(exe)))
+               for uri in uris]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pulls = read_pull_log(exe)
+    assert sorted(uri for uri, _, _ in pulls) == sorted(uris)
+    (_, start1, end1), (_, start2, end2) = pulls
+    # The pulls overlap in time if each one starts before the other ends.
+    assert start1 < end2 and start2 < end1
+    for uri in uris:
+        assert Path(cache_dir, uri_to_filename(uri) + ".sif.lock").exists()
+    assert not Path(cache_dir, ".lock").exists()
+
+
+def test_pull_same_image_once(fake_singularity, tmp_path):
+    exe = fake_singularity(delay=0.5)
+    cache_dir = tmp_path / "cache"
+    threads = [threading.Thread(target=pull_image_to_cache,
+                                args=("docker://debian:buster-slim",
+                                      cache_dir, str(exe)))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(read_pull_log(exe)) == 1
+
+
+def _cache_hits(uri: str, cache_dir: str, count: int) -> List[str]:
+    return [str(pull_image_to_cache(uri, Path(cache_dir)))
+            for _ in range(count)]
+
+
+def test_cache_hit_does_not_wait_for_lock(tmp_path):
+    """
+    Cache hits of many concurrent processes finish while the image lock is
+    held, so they do not take the lock. benchmarks/benchmark.py measures
+    their latency.
+    """
+    processes = 8
+    hits = 20
+    uri = "docker://debian:buster-slim"
+    image_path = tmp_path / (uri_to_filename(uri) + ".sif")
+    image_path.write_text(uri)
+    with multiprocessing.Pool(processes) as pool:
+        with SimpleUnixFileLock(str(image_path) + ".lock"):
+            result = pool.starmap_async(
+                _cache_hits, [(uri, str(tmp_path), hits)] * processes)
+            images = result.get(timeout=30)
+    assert images == [[str(image_path)] * hits] * processes
+
+
+@pytest.mark.parametrize(["lock_backend", "transaction"], [
+    ("flock", "BEGIN IMMEDIATE"), ("lockf", "BEGIN EXCLUSIVE")])
+def test_cache_hit_does_not_wait_for_index(fake_singularity, tmp_path,
+                                           monkeypatch, caplog,
+                                           lock_backend, transaction):
+    exe = fake_singularity()
+    uri = "docker://debian:buster-slim"
+    image = pull_image_to_cache(uri, tmp_path, str(exe), lock_backend)
+    module = singularity_permanent_cache.singularity_permanent_cache
+    # Every hit updates the access time.
+    monkeypatch.setattr(module, "ACCESS_TIME_RESOLUTION", 0)
+    caplog.set_level(0)
+    connection = sqlite3.connect(str(tmp_path / ".index.sqlite"),
+                                 isolation_level=None)
+    connection.execute(transaction)
+    try:
+        start = time.monotonic()
+        assert pull_image_to_cache(uri, tmp_path, str(exe),
+                                   lock_backend) == image
+        assert time.monotonic() - start < 1
+    finally:
+        connection.execute("ROLLBACK")
+        connection.close()
+    # Only an info message, because a busy index is expected.
+    assert [record.levelname for record in caplog.records
+            if "Could not update the cache index" in record.getMessage()
+            ] == ["INFO"]
+
+
+FLAKY_SINGULARITY = """#!{python}
+import sys
+import time
+from pathlib import Path
+
+# Mimics 'singularity pull <destination> <uri>' that fails the first
+# attempts. Each attempt is counted in the attempts file.
+attempts = Path({attempts!r})
+attempt = len(attempts.read_text()) + 1 if attempts.exists() else 1
+with attempts.open("at") as attempts_h:
+    attempts_h.write("x")
+time.sleep({delay!r})
+if attempt <= {failures!r}:
+    print("FATAL: registry unavailable")
+    sys.exit(255)
+Path(sys.argv[2]).write_text(sys.argv[3])
+"""
+
+
+@pytest.fixture()
+def flaky_singularity(tmp_path, monkeypatch):
+    """
+    Returns a function that creates a fake singularity executable that
+    fails a number of times, and a function that counts the attempts.
+    """
+    module = singularity_permanent_cache.singularity_permanent_cache
+    monkeypatch.setattr(module, "RETRY_BACKOFF", 0.01)
+    attempts = tmp_path / "attempts"
+
+    def make_flaky_singularity(failures: int, delay: float = 0.0) -> Path:
+        exe = tmp_path / "flaky_singularity"
+        exe.write_text(FLAKY_SINGULARITY.format(
+            python=sys.executable, attempts=str(attempts), delay=delay,
+            failures=failures))
+        exe.chmod(0o755)
+        return exe
+    return make_flaky_singularity, lambda: len(
+        attempts.read_text()) if attempts.exists() else 0
+
+
+def test_pull_retries(flaky_singularity, tmp_path):
+    make_flaky_singularity, attempts = flaky_singularity
+    metrics = tmp_path / "metrics.jsonl"
+    uri = "docker://debian:buster-slim"
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    # Temporary files left behind by aborted pulls are removed.
+    image_name = uri_to_filename(uri) + ".sif"
+    stale = [cache_dir / (image_name + ".0123abcd.tmp"),
+             cache_dir / (uri_to_filename(uri) + ".tmp")]
+    for file in stale:
+        file.write_text("aborted")
+    image = pull_image_to_cache(uri, cache_dir, str(make_flaky_singularity(2)),
+                                retries=2, metrics=str(metrics))
+    assert image.read_text() == uri
+    assert attempts() == 3
+    assert json.loads(metrics.read_text())["attempts"] == 3
+    assert list(cache_dir.glob("*.tmp")) == []
+
+
+def test_pull_retries_exhausted(flaky_singularity, fake_singularity,
+                                tmp_path):
+    make_flaky_singularity, attempts = flaky_singularity
+    uri = "docker://debian:buster-slim"
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        pull_image_to_cache(uri, tmp_path, str(make_flaky_singularity(5)),
+                            retries=1)
+    assert "registry unavailable" in error.value.output
+    assert attempts() == 2
+    assert list(tmp_path.glob("*.tmp")) == []
+    failed = tmp_path / (uri_to_filename(uri) + ".sif.failed")
+    assert json.loads(failed.read_text())["pid"] == os.getpid()
+    # A failure from before this call started does not prevent a new pull.
+    pull_image_to_cache(uri, tmp_path, str(fake_singularity()))
+    assert not failed.exists()
+
+
+def test_pull_after_failure_from_clock_ahead(flaky_singularity,
+                                             fake_singularity, tmp_path):
+    # The failure was recorded on a machine whose clock runs ahead.
+    make_flaky_singularity, attempts = flaky_singularity
+    uri = "docker://debian:buster-slim"
+    with pytest.raises(subprocess.CalledProcessError):
+        pull_image_to_cache(uri, tmp_path, str(make_flaky_singularity(5)),
+                            retries=0)
+    failed = tmp_path / (uri_to_filename(uri) + ".sif.failed")
+    future = time.time() + 3600
+    os.utime(str(failed), (future, future))
+    pull_image_to_cache(uri, tmp_path, str(fake_singularity()))
+    assert not failed.exists()
+    assert list(tmp_path.glob("*.tmp")) == []
+
+
+def test_pull_failure_shared_with_waiters(flaky_singularity, tmp_path):
+    make_flaky_singularity, attempts = flaky_singularity
+    exe = make_flaky_singularity(failures=1, delay=0.5)
+    uri = "docker://debian:buster-slim"
+    errors = []
+
+    def pull():
+        try:
+            pull_image_to_cache(uri, tmp_path, str(exe), retries=0)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=pull) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.1)
+    for thread in threads:
+        thread.join()
+    # Only the first process pulled, the others got its failure.
+    assert attempts() == 1
+    assert sorted(type(error).__name__ for error in errors) == [
+        "CalledProcessError", "PullFailedError", "PullFailedError"]
+    assert "registry unavailable" in str(errors[-1])
+
+
 # Main program
 @pytest.fixture()
 def main_args():
@@ -171,8 +659,8 @@ def test_main(main_args):
     assert not cache_dir.exists()
     main()
     assert cache_dir.exists()
-    assert Path(cache_dir, ".lock").exists()
-    assert Path(cache_dir, "docker_hello-world.sif").exists()
+    assert Path(cache_dir, "docker%3A%2F%2Fhello-world.sif.lock").exists()
+    assert Path(cache_dir, "docker%3A%2F%2Fhello-world.sif").exists()
 
 
 def test_which_cache(monkeypatch, capsys):
@@ -192,3 +680,1447 @@ def test_which_cache_no_env(monkeypatch, capsys):
         main()
     captured = capsys.readouterr()
     assert "No cache could be determined from the environment." in captured.out
+
+
+def test_pull_images_to_cache(fake_singularity, tmp_path):
+    exe = fake_singularity(delay=0.5)
+    cache_dir = tmp_path / "cache"
+    uris = ["docker://debian:buster-slim", "docker://ubuntu:20.04",
+            "docker://debian:buster-slim", "docker://alpine:3.12"]
+    image_paths = pull_images_to_cache(uris, cache_dir, str(exe), jobs=2)
+    assert list(image_paths.keys()) == [
+        "docker://debian:buster-slim", "docker://ubuntu:20.04",
+        "docker://alpine:3.12"]
+    for uri, path in image_paths.items():
+        assert path == Path(cache_dir, uri_to_filename(uri) + ".sif")
+        assert path.read_text() == uri
+    pulls = read_pull_log(exe)
+    assert len(pulls) == 3
+    # With 2 jobs, at most 2 pulls run at the same time.
+    for _, start, _ in pulls:
+        assert sum(1 for _, other_start, other_end in pulls
+                   if other_start <= start < other_end) <= 2
+
+
+def test_main_multiple_uris(fake_singularity, tmp_path, capsys):
+    exe = fake_singularity()
+    cache_dir = tmp_path / "cache"
+    sys.argv = ["spc", "-d", str(cache_dir), "-s", str(exe),
+                "docker://debian:buster-slim", "docker://ubuntu:20.04"]
+    main()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines == [
+        "docker://debian:buster-slim\t" +
+        str(cache_dir / "docker%3A%2F%2Fdebian%3Abuster-slim.sif"),
+        "docker://ubuntu:20.04\t" +
+        str(cache_dir / "docker%3A%2F%2Fubuntu%3A20.04.sif")]
+
+
+def test_main_from_file_json(fake_singularity, tmp_path, capsys,
+                             monkeypatch):
+    exe = fake_singularity()
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setattr(sys, "stdin", io.StringIO(
+        "# Images for the pipeline\n"
+        "docker://debian:buster-slim\n"
+        "\n"
+        "docker://ubuntu:20.04\n"))
+    sys.argv = ["spc", "-d", str(cache_dir), "-s", str(exe),
+                "--from-file", "-", "--output-format", "json"]
+    main()
+    assert json.loads(capsys.readouterr().out) == {
+        "docker://debian:buster-slim":
+            str(cache_dir / "docker%3A%2F%2Fdebian%3Abuster-slim.sif"),
+        "docker://ubuntu:20.04":
+            str(cache_dir / "docker%3A%2F%2Fubuntu%3A20.04.sif")}
+
+
+def test_main_no_uris(capsys):
+    sys.argv = ["spc", "-d", "cache"]
+    with pytest.raises(SystemExit):
+        main()
+    assert "No images given." in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("argv", [
+    ["spc", "-d", "cache", "list"],
+    ["spc", "-v", "info", "docker://debian:10"],
+    ["spc", "--lock-backend", "lease", "gc", "--max-size", "1G"],
+])
+def test_main_command_after_options(argv, tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    sys.argv = argv
+    with pytest.raises(SystemExit) as error:
+        main()
+    assert error.value.code == 2
+    assert ("Commands must be given before their options"
+            in capsys.readouterr().err)
+    assert not (tmp_path / "cache").exists()
+
+
+def test_main_unrecognized_arguments(capsys):
+    sys.argv = ["spc", "-d", "cache", "--no-such-option", "docker://debian:10"]
+    with pytest.raises(SystemExit) as error:
+        main()
+    assert error.value.code == 2
+    assert ("unrecognized arguments: --no-such-option"
+            in capsys.readouterr().err)
+
+
+def test_pull_image_to_cache_lease_backend(fake_singularity, tmp_path,
+                                           monkeypatch):
+    monkeypatch.setenv("SINGULARITY_PERMANENTCACHE_LOCK_BACKEND", "lease")
+    exe = fake_singularity()
+    image = pull_image_to_cache("docker://debian:buster-slim", tmp_path,
+                                str(exe))
+    assert image.exists()
+    # The lease is removed when the lock is released.
+    assert not Path(str(image) + ".lock").exists()
+
+
+DIGEST = "f05c05a218b7a4a5fe979045b1c8e2a9ec3524e5611ebfdd0ef5b8040f9008fa"
+
+
+@pytest.mark.parametrize(["uri", "result"], [
+    ("docker://debian@sha256:" + DIGEST, DIGEST),
+    ("docker_debian@sha256_" + DIGEST + ".sif", DIGEST),
+    ("docker://debian:buster-slim", None)
+])
+def test_image_digest(uri, result):
+    assert image_digest(uri) == result
+
+
+def test_pull_image_by_digest_from_mirror(fake_singularity, tmp_path):
+    exe = fake_singularity()
+    uris = ["docker://debian@sha256:" + DIGEST,
+            "docker://mirror.example.com/library/debian@sha256:" + DIGEST]
+    images = [pull_image_to_cache(uri, tmp_path, str(exe)) for uri in uris]
+    assert len(read_pull_log(exe)) == 1
+    blob = tmp_path / "blobs" / "image-sha256" / (DIGEST + ".sif")
+    for image in images:
+        assert image.is_symlink()
+        assert image.resolve() == blob.resolve()
+    # The checksum of the file is recorded, for verification.
+    with CacheIndex(tmp_path) as index:
+        assert [index.get(uri)["sha256"] for uri in uris] == \
+            [sha256_file(blob)] * 2
+
+
+def test_identical_images_stored_once(fake_singularity, tmp_path):
+    exe = fake_singularity(content="identical")
+    images = pull_images_to_cache(
+        ["docker://debian:buster-slim", "docker://debian:10-slim"],
+        tmp_path, str(exe))
+    assert len(read_pull_log(exe)) == 2
+    blobs = list((tmp_path / "blobs" / "sha256").glob("*.sif"))
+    assert len(blobs) == 1
+    for image in images.values():
+        assert image.resolve() == blobs[0].resolve()
+        assert image.read_text() == "identical"
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_migrate(fake_singularity, tmp_path, capsys, caplog):
+    exe = fake_singularity()
+    # Images as stored by older versions.
+    Path(tmp_path, "docker_debian_buster-slim.sif").write_text("debian")
+    Path(tmp_path, "docker_debian_10-slim.sif").write_text("debian")
+    Path(tmp_path, "docker_debian@sha256_" + DIGEST + ".sif").write_text(
+        "debian digest")
+    sys.argv = ["spc", "migrate", "-d", str(tmp_path)]
+    main()
+    assert "Migrated 3 images" in capsys.readouterr().out
+    # They are not in the index, so their URIs are not known.
+    assert sorted(record.getMessage() for record in caplog.records
+                  if record.levelno == logging.WARNING) == [
+        "Not renaming {0}: its URI is not in the cache index. It is renamed "
+        "when the image is used.".format(Path(tmp_path, name))
+        for name in sorted(path.name for path in tmp_path.glob("*.sif"))]
+    images = list(tmp_path.glob("*.sif"))
+    assert len(images) == 3
+    assert all(image.is_symlink() for image in images)
+    assert len(list(tmp_path.glob("blobs/sha256/*.sif"))) == 1
+    assert Path(tmp_path, "docker_debian_10-slim.sif").read_text() == "debian"
+    # The migrated digest image is also found under another URI.
+    image = pull_image_to_cache(
+        "docker://mirror.example.com/debian@sha256:" + DIGEST, tmp_path,
+        str(exe))
+    assert image.read_text() == "debian digest"
+    assert read_pull_log(exe) == []
+
+
+def test_migrate_then_evict(fake_singularity, tmp_path, monkeypatch):
+    uri = "docker://debian:buster-slim"
+    image = Path(tmp_path, uri_to_filename(uri) + ".sif")
+    # Stored as a plain file, and added to the index by a cache hit.
+    image.write_text(uri)
+    pull_image_to_cache(uri, tmp_path, str(fake_singularity()))
+    with CacheIndex(tmp_path) as index:
+        accessed = index.get(uri)["accessed"]
+    assert migrate_cache(tmp_path) == [image]
+    assert image.is_symlink()
+    blob = image.resolve()
+    with CacheIndex(tmp_path) as index:
+        entry = index.get(uri)
+    assert Path(tmp_path, entry["blob"]) == blob
+    assert entry["accessed"] == accessed
+    module = singularity_permanent_cache.singularity_permanent_cache
+    monkeypatch.setattr(module, "EVICTION_MIN_AGE", 0)
+    assert evict_images(tmp_path, 0) == [uri]
+    assert not blob.exists()
+    assert not list(tmp_path.glob("blobs/*/*.sif"))
+
+
+def _store_legacy_image(cache: Path, uri: str,
+                        filename: Optional[str] = None) -> Path:
+    # An image as stored by versions that used the old filenames.
+    legacy_path = Path(cache, (filename or uri.replace("://", "_").replace(
+        "/", "_").replace(":", "_")) + ".sif")
+    image_tmp = Path(cache, "image.tmp")
+    image_tmp.write_text(uri)
+    with CacheIndex(cache) as index:
+        store_image(legacy_path, image_tmp, None, index, uri)
+    return legacy_path
+
+
+def test_legacy_image_renamed_when_used(fake_singularity, tmp_path):
+    exe = fake_singularity()
+    uri = "docker://debian:buster-slim"
+    legacy_path = _store_legacy_image(tmp_path, uri)
+    with CacheIndex(tmp_path) as index:
+        pulled = index.get(uri)["pulled"]
+    image = pull_image_to_cache(uri, tmp_path, str(exe))
+    assert image == Path(tmp_path, uri_to_filename(uri) + ".sif")
+    assert image.read_text() == uri
+    assert not legacy_path.is_symlink()
+    assert read_pull_log(exe) == []
+    with CacheIndex(tmp_path) as index:
+        entry = index.get(uri)
+    assert entry["path"] == image.name
+    assert entry["pulled"] == pulled
+
+
+def test_legacy_image_with_shared_filename_not_renamed(fake_singularity,
+                                                       tmp_path):
+    exe = fake_singularity()
+    uris = ["docker://a/b:c", "docker://a_b:c"]
+    # Both URIs had the same filename in older versions, so it is not known
+    # which image the file is.
+    for uri in uris:
+        legacy_path = _store_legacy_image(tmp_path, uri, "docker_a_b_c")
+    images = pull_images_to_cache(uris, tmp_path, str(exe))
+    assert sorted(uri for uri, _, _ in read_pull_log(exe)) == uris
+    assert len(set(images.values())) == 2
+    for uri, image in images.items():
+        assert image.read_text() == uri
+    assert legacy_path.is_symlink()
+
+
+def test_migrate_renames_legacy_images(fake_singularity, tmp_path, capsys):
+    exe = fake_singularity()
+    uris = ["docker://debian:buster-slim", "docker://ubuntu:20.04"]
+    legacy_paths = [_store_legacy_image(tmp_path, uri) for uri in uris]
+    # Stored as a plain file and indexed by an older version.
+    plain_uri = "docker://alpine:3"
+    plain_path = Path(tmp_path, "docker_alpine_3.sif")
+    plain_path.write_text(plain_uri)
+    with CacheIndex(tmp_path) as index:
+        index.record(plain_uri, plain_path, None)
+    sys.argv = ["spc", "migrate", "-d", str(tmp_path)]
+    main()
+    assert "Migrated 3 images" in capsys.readouterr().out
+    assert not any(path.exists() for path in legacy_paths + [plain_path])
+    with CacheIndex(tmp_path) as index:
+        for uri in uris + [plain_uri]:
+            image = Path(tmp_path, uri_to_filename(uri) + ".sif")
+            assert image.is_symlink()
+            assert image.read_text() == uri
+            assert index.get(uri)["path"] == image.name
+    sys.argv = ["spc", "migrate", "-d", str(tmp_path)]
+    main()
+    assert "Migrated 0 images" in capsys.readouterr().out
+    for uri in uris:
+        pull_image_to_cache(uri, tmp_path, str(exe))
+    assert read_pull_log(exe) == []
+
+
+def test_index(fake_singularity, tmp_path, monkeypatch):
+    exe = fake_singularity()
+    uri = "docker://debian:buster-slim"
+    image = pull_image_to_cache(uri, tmp_path, str(exe))
+    with CacheIndex(tmp_path) as index:
+        entry = index.get(uri)
+    assert entry is not None
+    assert entry["path"] == image.name
+    assert entry["size"] == len(uri)
+    assert entry["digest"] == "sha256:" + sha256_file(image)
+    assert entry["blob"] == os.path.join("blobs", "sha256",
+                                         entry["digest"][7:] + ".sif")
+    assert entry["pulled"] == pytest.approx(time.time(), abs=10)
+    assert entry["accessed"] >= entry["pulled"]
+    assert entry["sha256"] == entry["digest"][7:]
+    assert entry["mtime"] == image.stat().st_mtime
+
+    # Access times are only updated once per ACCESS_TIME_RESOLUTION.
+    pull_image_to_cache(uri, tmp_path, str(exe))
+    with CacheIndex(tmp_path) as index:
+        assert index.get(uri) == entry
+    module = singularity_permanent_cache.singularity_permanent_cache
+    monkeypatch.setattr(module, "ACCESS_TIME_RESOLUTION", 0)
+    pull_image_to_cache(uri, tmp_path, str(exe))
+    with CacheIndex(tmp_path) as index:
+        assert index.get(uri)["accessed"] > entry["accessed"]
+
+
+def test_index_records_existing_images(tmp_path):
+    # Images from caches created without an index are indexed when used.
+    uri = "docker://debian:buster-slim"
+    Path(tmp_path, uri_to_filename(uri) + ".sif").write_text("debian")
+    pull_image_to_cache(uri, tmp_path)
+    with CacheIndex(tmp_path) as index:
+        entry = index.get(uri)
+    assert entry["size"] == 6
+    assert entry["pulled"] is None
+
+
+def test_list_and_info(fake_singularity, tmp_path, capsys):
+    exe = fake_singularity()
+    uris = ["docker://ubuntu:20.04", "docker://debian:buster-slim"]
+    images = pull_images_to_cache(uris, tmp_path, str(exe))
+    sys.argv = ["spc", "list", "-d", str(tmp_path)]
+    main()
+    lines = [line.split("\t") for line in
+             capsys.readouterr().out.splitlines()]
+    assert [line[0] for line in lines] == sorted(uris)
+    assert [line[3] for line in lines] == [str(images[uri])
+                                           for uri in sorted(uris)]
+    sys.argv = ["spc", "info", "-d", str(tmp_path), uris[0]]
+    main()
+    info = json.loads(capsys.readouterr().out)
+    assert info["uri"] == uris[0]
+    assert info["path"] == str(images[uris[0]])
+    assert Path(info["blob"]).read_text() == uris[0]
+
+
+def test_info_not_in_cache(tmp_path):
+    sys.argv = ["spc", "info", "-d", str(tmp_path), "docker://debian:10"]
+    with pytest.raises(SystemExit) as error:
+        main()
+    error.match("Image is not in the cache: docker://debian:10")
+
+
+@pytest.mark.parametrize(["size", "result"], [
+    ("100", 100),
+    ("1k", 1024),
+    ("1.5M", 1536 * 1024),
+    ("2GiB", 2 * 1024 ** 3),
+    ("1 T", 1024 ** 4),
+])
+def test_parse_size(size, result):
+    assert parse_size(size) == result
+
+
+def test_parse_size_invalid():
+    with pytest.raises(ValueError) as error:
+        parse_size("lots")
+    error.match("Invalid size: 'lots'")
+
+
+@pytest.mark.parametrize(["duration", "result"], [
+    ("30", 30),
+    ("90m", 5400),
+    ("1.5h", 5400),
+    ("7D", 7 * 86400),
+])
+def test_parse_duration(duration, result):
+    assert parse_duration(duration) == result
+
+
+def test_parse_duration_invalid():
+    with pytest.raises(ValueError) as error:
+        parse_duration("a while")
+    error.match("Invalid duration: 'a while'")
+
+
+def _fill_cache(exe: Path, cache: Path, uris):
+    # Pull the images and make the first one the least recently used.
+    images = pull_images_to_cache(uris, cache, str(exe))
+    with CacheIndex(cache) as index:
+        for age, uri in enumerate(reversed(uris), start=1):
+            index.connection.execute(
+                "UPDATE images SET accessed = ? WHERE uri = ?",
+                (time.time() - age * 3600, uri))
+    return images
+
+
+EVICTION_URIS = ["docker://debian:buster-slim", "docker://ubuntu:20.04",
+                 "docker://alpine:3.12"]
+
+
+def test_evict_images(fake_singularity, tmp_path):
+    images = _fill_cache(fake_singularity(), tmp_path, EVICTION_URIS)
+    blob = images[EVICTION_URIS[0]].resolve()
+    max_size = sum(len(uri) for uri in EVICTION_URIS[1:])
+    assert evict_images(tmp_path, max_size) == EVICTION_URIS[:1]
+    assert not images[EVICTION_URIS[0]].exists()
+    assert not images[EVICTION_URIS[0]].is_symlink()
+    assert not blob.exists()
+    assert all(images[uri].exists() for uri in EVICTION_URIS[1:])
+    with CacheIndex(tmp_path) as index:
+        assert index.get(EVICTION_URIS[0]) is None
+        assert index.total_size() == max_size
+
+
+def test_evict_images_pinned_and_recent(fake_singularity, tmp_path):
+    images = _fill_cache(fake_singularity(), tmp_path, EVICTION_URIS)
+    pin_images(EVICTION_URIS[:1], tmp_path)
+    # Used in the last hour, so it is kept.
+    with CacheIndex(tmp_path) as index:
+        index.connection.execute(
+            "UPDATE images SET accessed = ? WHERE uri = ?",
+            (time.time(), EVICTION_URIS[2]))
+    assert evict_images(tmp_path, 0) == EVICTION_URIS[1:2]
+    assert images[EVICTION_URIS[0]].exists()
+    assert images[EVICTION_URIS[2]].exists()
+
+
+def test_evict_images_shared_blob(fake_singularity, tmp_path):
+    images = _fill_cache(fake_singularity(content="identical"), tmp_path,
+                         EVICTION_URIS[:2])
+    blob = images[EVICTION_URIS[0]].resolve()
+    assert evict_images(tmp_path, len("identical"), min_age=0) == []
+    assert evict_images(tmp_path, 0, min_age=0) == EVICTION_URIS[:2]
+    assert not blob.exists()
+
+
+def test_evict_images_waits_for_lock(fake_singularity, tmp_path):
+    images = _fill_cache(fake_singularity(), tmp_path, EVICTION_URIS[:1])
+    image = images[EVICTION_URIS[0]]
+    evicted = []
+    thread = threading.Thread(
+        target=lambda: evicted.extend(evict_images(tmp_path, 0)))
+    with SimpleUnixFileLock(str(image) + ".lock"):
+        thread.start()
+        time.sleep(0.3)
+        assert image.exists()
+    thread.join()
+    assert evicted == EVICTION_URIS[:1]
+    assert not image.exists()
+
+
+def test_pull_image_to_cache_max_size(fake_singularity, tmp_path,
+                                      monkeypatch):
+    module = singularity_permanent_cache.singularity_permanent_cache
+    monkeypatch.setattr(module, "EVICTION_MIN_AGE", 0)
+    exe = fake_singularity()
+    monkeypatch.setenv("SINGULARITY_PERMANENTCACHE_MAX_SIZE",
+                       str(len(EVICTION_URIS[0])))
+    first = pull_image_to_cache(EVICTION_URIS[0], tmp_path, str(exe))
+    time.sleep(0.01)
+    second = pull_image_to_cache(EVICTION_URIS[1], tmp_path, str(exe))
+    assert not first.exists()
+    assert second.exists()
+
+
+def test_copy_file(tmp_path):
+    source = tmp_path / "source"
+    # Larger than the buffer of a normal copy.
+    content = os.urandom(3 * 1024 * 1024)
+    source.write_bytes(content)
+    copy_file(source, tmp_path / "destination")
+    assert (tmp_path / "destination").read_bytes() == content
+
+
+def test_pull_image_to_cache_tiers(fake_singularity, tmp_path):
+    exe = fake_singularity()
+    metrics = tmp_path / "metrics.jsonl"
+    uri = "docker://debian:buster-slim"
+    shared = tmp_path / "shared"
+    tiers = [tmp_path / "local1", shared]
+    image = pull_image_to_cache(uri, tiers, str(exe), metrics=str(metrics))
+    assert image == tmp_path / "local1" / (uri_to_filename(uri) + ".sif")
+    assert image.read_text() == uri
+    assert (shared / image.name).read_text() == uri
+    # Another machine with its own local tier copies the image from the
+    # shared tier.
+    tiers = [tmp_path / "local2", shared]
+    image = pull_image_to_cache(uri, tiers, str(exe), metrics=str(metrics))
+    assert image.parent == tmp_path / "local2"
+    assert image.read_text() == uri
+    assert pull_image_to_cache(uri, tiers, str(exe),
+                               metrics=str(metrics)) == image
+    assert len(read_pull_log(exe)) == 1
+    assert [record["tier"] for record in map(
+        json.loads, metrics.read_text().splitlines())] == [None, 1, 0]
+    with CacheIndex(tmp_path / "local2") as index:
+        assert [entry["uri"] for entry in index.entries()] == [uri]
+
+
+def test_pull_image_to_cache_tiers_digest(fake_singularity, tmp_path):
+    exe = fake_singularity()
+    uri = "docker://debian@sha256:" + DIGEST
+    tiers = [tmp_path / "local", tmp_path / "shared"]
+    image = pull_image_to_cache(uri, tiers, str(exe))
+    assert image.resolve() == tmp_path / "local" / "blobs" / \
+        "image-sha256" / (DIGEST + ".sif")
+
+
+def test_pull_image_to_cache_local_max_size(fake_singularity, tmp_path,
+                                            monkeypatch):
+    module = singularity_permanent_cache.singularity_permanent_cache
+    monkeypatch.setattr(module, "EVICTION_MIN_AGE", 0)
+    exe = fake_singularity()
+    tiers = [tmp_path / "local", tmp_path / "shared"]
+    paths = []
+    for uri in EVICTION_URIS[:2]:
+        paths.append(pull_image_to_cache(
+            uri, tiers, str(exe), local_max_size=len(EVICTION_URIS[0])))
+        time.sleep(0.01)
+    # Only the local tier is limited.
+    assert not paths[0].exists()
+    assert paths[1].exists()
+    assert len(list((tmp_path / "shared").glob("*.sif"))) == 2
+
+
+def test_main_tiers(fake_singularity, tmp_path, capsys):
+    exe = fake_singularity()
+    uri = "docker://debian:buster-slim"
+    sys.argv = ["spc", "-s", str(exe), "-d", str(tmp_path / "local"),
+                "-d", str(tmp_path / "shared"), uri]
+    main()
+    image_name = uri_to_filename(uri) + ".sif"
+    assert capsys.readouterr().out == str(tmp_path / "local" / image_name)
+    assert (tmp_path / "shared" / image_name).exists()
+
+
+def test_gc_and_pin_commands(fake_singularity, tmp_path, capsys):
+    _fill_cache(fake_singularity(), tmp_path, EVICTION_URIS)
+    sys.argv = ["spc", "pin", "-d", str(tmp_path), EVICTION_URIS[0]]
+    main()
+    sys.argv = ["spc", "gc", "-d", str(tmp_path), "--max-size", "0"]
+    main()
+    assert capsys.readouterr().out.splitlines() == EVICTION_URIS[1:]
+    sys.argv = ["spc", "unpin", "-d", str(tmp_path), EVICTION_URIS[0]]
+    main()
+    sys.argv = ["spc", "gc", "-d", str(tmp_path), "--max-size", "0"]
+    main()
+    assert capsys.readouterr().out.splitlines() == EVICTION_URIS[:1]
+
+
+def test_pin_not_in_cache(tmp_path):
+    sys.argv = ["spc", "pin", "-d", str(tmp_path), "docker://debian:10"]
+    with pytest.raises(SystemExit) as error:
+        main()
+    error.match("Image is not in the cache: docker://debian:10")
+
+
+def test_export_import(fake_singularity, tmp_path):
+    uris = EVICTION_URIS[:2] + ["docker://debian@sha256:" + DIGEST]
+    _fill_cache(fake_singularity(), tmp_path / "source", uris)
+    bundle = io.BytesIO()
+    export_images(uris, bundle, tmp_path / "source")
+    bundle.seek(0)
+    images = import_images(bundle, tmp_path / "cache")
+    assert list(images) == uris
+    for uri, image in images.items():
+        assert image == tmp_path / "cache" / (uri_to_filename(uri) + ".sif")
+        assert image.read_text() == uri
+        assert image.is_symlink()
+    with CacheIndex(tmp_path / "cache") as index:
+        assert index.get(uris[0])["digest"] == \
+            "sha256:" + sha256_file(images[uris[0]])
+        assert index.get(uris[2])["digest"] == "sha256:" + DIGEST
+    # Images in the cache are skipped.
+    bundle.seek(0)
+    assert import_images(bundle, tmp_path / "cache") == images
+
+
+def test_export_not_in_cache(tmp_path):
+    with pytest.raises(ValueError) as error:
+        export_images(["docker://debian:10"], io.BytesIO(), tmp_path)
+    error.match("Image is not in the cache: docker://debian:10")
+
+
+def test_import_corrupt_bundle(fake_singularity, tmp_path):
+    uri = EVICTION_URIS[0]
+    _fill_cache(fake_singularity(), tmp_path / "source", [uri])
+    bundle = io.BytesIO()
+    export_images([uri], bundle, tmp_path / "source")
+    corrupt = bundle.getvalue().replace(uri.encode(), uri.upper().encode(), 1)
+    with pytest.raises(ValueError) as error:
+        import_images(io.BytesIO(corrupt), tmp_path / "cache")
+    error.match("Checksum of image .* does not match")
+    assert not list((tmp_path / "cache").glob("*.sif"))
+    assert not list((tmp_path / "cache").glob("*.tmp"))
+
+
+def _legacy_bundle(uris: List[str]) -> io.BytesIO:
+    # A bundle as written by versions that used the old filenames.
+    bundle = io.BytesIO()
+    with tarfile.open(fileobj=bundle, mode="w",
+                      format=tarfile.PAX_FORMAT) as tar:
+        for uri in uris:
+            name = uri.replace("://", "_").replace("/", "_").replace(
+                ":", "_") + ".sif"
+            metadata = json.dumps({"uri": uri, "sha256": hashlib.sha256(
+                uri.encode()).hexdigest()}).encode()
+            for member_name, content in ((name, uri.encode()),
+                                         (name + ".json", metadata)):
+                info = tarfile.TarInfo(member_name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+    bundle.seek(0)
+    return bundle
+
+
+def test_import_legacy_bundle(tmp_path):
+    # Both URIs had the same filename in older versions.
+    uris = ["docker://a/b:c", "docker://a_b:c", "docker://debian:10"]
+    images = import_images(_legacy_bundle(uris), tmp_path)
+    assert list(images) == uris
+    for uri, image in images.items():
+        assert image == tmp_path / (uri_to_filename(uri) + ".sif")
+        assert image.read_text() == uri
+    assert not list(tmp_path.glob("docker_*.sif"))
+    assert not list(tmp_path.glob("*.tmp"))
+    with CacheIndex(tmp_path) as index:
+        assert [index.get(uri)["path"] for uri in uris] == [
+            image.name for image in images.values()]
+
+
+def test_import_legacy_bundle_legacy_cache(tmp_path):
+    uri = "docker://debian:10"
+    legacy_path = _store_legacy_image(tmp_path, uri)
+    images = import_images(_legacy_bundle([uri]), tmp_path)
+    assert images[uri] == tmp_path / (uri_to_filename(uri) + ".sif")
+    assert images[uri].read_text() == uri
+    assert not legacy_path.is_symlink()
+
+
+def test_export_import_commands(fake_singularity, tmp_path, capsys):
+    _fill_cache(fake_singularity(), tmp_path / "source", EVICTION_URIS)
+    bundle = tmp_path / "bundle.tar"
+    sys.argv = ["spc", "export", "-d", str(tmp_path / "source"),
+                "-o", str(bundle)] + EVICTION_URIS
+    main()
+    sys.argv = ["spc", "import", "-d", str(tmp_path / "cache"), str(bundle)]
+    main()
+    assert capsys.readouterr().out.splitlines() == [
+        "{0}\t{1}".format(uri, tmp_path / "cache" /
+                          (uri_to_filename(uri) + ".sif"))
+        for uri in EVICTION_URIS]
+    not_a_bundle = tmp_path / "images.txt"
+    not_a_bundle.write_text("\n".join(EVICTION_URIS))
+    sys.argv = ["spc", "import", "-d", str(tmp_path / "cache"),
+                str(not_a_bundle)]
+    with pytest.raises(SystemExit) as error:
+        main()
+    error.match("Could not import")
+
+
+def test_export_import_pipe(fake_singularity, tmp_path):
+    _fill_cache(fake_singularity(), tmp_path / "source", EVICTION_URIS)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [str(Path(cli.__file__).parent.parent)] +
+        [path for path in [os.environ.get("PYTHONPATH")] if path]))
+    spc = [sys.executable, "-m", "singularity_permanent_cache"]
+    export = subprocess.Popen(
+        spc + ["export", "-d", str(tmp_path / "source"), "-o", "-"] +
+        EVICTION_URIS, env=env, stdout=subprocess.PIPE)
+    subprocess.run(spc + ["import", "-d", str(tmp_path / "cache"), "-"],
+                   env=env, stdin=export.stdout, check=True,
+                   stdout=subprocess.DEVNULL)
+    export.stdout.close()
+    assert export.wait() == 0
+    for uri in EVICTION_URIS:
+        assert Path(tmp_path, "cache",
+                    uri_to_filename(uri) + ".sif").read_text() == uri
+
+
+def test_check_hits(fake_singularity, tmp_path):
+    exe = fake_singularity()
+    uri = "docker://debian:buster-slim"
+    image = pull_image_to_cache(uri, tmp_path, str(exe))
+    blob = image.resolve()
+    # A truncated image.
+    blob.write_text(uri[:10])
+    assert pull_image_to_cache(uri, tmp_path, str(exe)) == image
+    assert len(read_pull_log(exe)) == 1
+    assert pull_image_to_cache(uri, tmp_path, str(exe),
+                               check_hits=True) == image
+    assert len(read_pull_log(exe)) == 2
+    assert image.read_text() == uri
+    assert (tmp_path / "quarantine" / blob.name).read_text() == uri[:10]
+
+
+def test_verify_cache(fake_singularity, tmp_path, capsys):
+    exe = fake_singularity()
+    images = pull_images_to_cache(EVICTION_URIS, tmp_path, str(exe))
+    uri = EVICTION_URIS[1]
+    blob = images[uri].resolve()
+    # Damaged data with the same size and modification time.
+    stat = blob.stat()
+    blob.write_text(uri.upper())
+    os.utime(str(blob), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert pull_image_to_cache(uri, tmp_path, str(exe),
+                               check_hits=True) == images[uri]
+    assert verify_cache(tmp_path) == [uri]
+    assert (tmp_path / "quarantine" / blob.name).read_text() == uri.upper()
+    with CacheIndex(tmp_path) as index:
+        assert [entry["uri"] for entry in index.entries()] == \
+            sorted(set(EVICTION_URIS) - {uri})
+    assert verify_cache(tmp_path) == []
+    assert pull_image_to_cache(uri, tmp_path, str(exe)).read_text() == uri
+
+    blob.write_text("corrupt")
+    sys.argv = ["spc", "verify", "-d", str(tmp_path), "--jobs", "2"]
+    with pytest.raises(SystemExit) as error:
+        main()
+    assert error.value.code == 1
+    assert capsys.readouterr().out == uri + "\n"
+
+
+def test_verify_cache_records_missing_checksums(fake_singularity, tmp_path):
+    uri = "docker://debian@sha256:" + DIGEST
+    image = pull_image_to_cache(uri, tmp_path, str(fake_singularity()))
+    # Images that were added by older versions have no checksum.
+    with CacheIndex(tmp_path) as index:
+        index.connection.execute("UPDATE images SET sha256 = NULL")
+    assert verify_cache(tmp_path) == []
+    with CacheIndex(tmp_path) as index:
+        assert index.get(uri)["sha256"] == sha256_file(image)
+
+
+class _ImageRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Serves server.image at any path. Supports range requests when
+    # server.ranges is set. The first response is cut off after
+    # server.interrupt_after bytes when it is set.
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get("Range"))
+        for name, status in (("missing.sif", 404), ("throttled.sif", 429),
+                             ("unavailable.sif", 503)):
+            if self.path.endswith(name):
+                self.send_error(status)
+                return
+        image = server.image
+        start = 0
+        if server.ranges and self.headers.get("Range"):
+            start = int(self.headers["Range"][len("bytes="):-1])
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(
+                start, len(image) - 1, len(image)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(image) - start))
+        self.end_headers()
+        data = image[start:]
+        if server.interrupt_after is not None:
+            data = data[:server.interrupt_after]
+            server.interrupt_after = None
+            self.close_connection = True
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ImageServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture()
+def image_server():
+    server = _ImageServer(("127.0.0.1", 0), _ImageRequestHandler)
+    server.image = os.urandom(1024 * 1024)
+    server.ranges = True
+    server.interrupt_after = None
+    server.requests = []
+    server.url = "http://127.0.0.1:{0}".format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.mark.parametrize(["uri", "backend"], [
+    ("docker://debian:10", fetch_with_singularity),
+    ("library://debian", fetch_with_singularity),
+    ("file:///images/debian.sif", fetch_file),
+    ("http://example.com/debian.sif", fetch_http),
+    ("HTTPS://example.com/debian.sif", fetch_http),
+])
+def test_get_fetch_backend(uri, backend):
+    assert get_fetch_backend(uri) is backend
+
+
+def test_pull_image_to_cache_http(image_server, tmp_path):
+    uri = image_server.url + "/debian.sif"
+    image = pull_image_to_cache(uri, tmp_path, "no_singularity")
+    assert image.read_bytes() == image_server.image
+    assert image_server.requests == [None]
+    with CacheIndex(tmp_path) as index:
+        assert index.get(uri)["sha256"] == sha256_file(image)
+
+
+@pytest.mark.parametrize("ranges", [True, False])
+def test_fetch_http_resume(image_server, tmp_path, ranges):
+    image_server.ranges = ranges
+    image_server.interrupt_after = 1000
+    fetch_http(image_server.url + "/debian.sif", tmp_path / "debian.sif")
+    assert (tmp_path / "debian.sif").read_bytes() == image_server.image
+    assert image_server.requests == [None, "bytes=1000-"]
+
+
+@pytest.mark.parametrize(["name", "status", "requests"], [
+    ("missing.sif", 404, 1),
+    ("throttled.sif", 429, 3),
+    ("unavailable.sif", 503, 3),
+])
+def test_fetch_http_error(image_server, tmp_path, monkeypatch, name, status,
+                          requests):
+    module = singularity_permanent_cache.singularity_permanent_cache
+    monkeypatch.setattr(module, "RETRY_BACKOFF", 0.01)
+    uri = image_server.url + "/" + name
+    with pytest.raises(FetchError) as error:
+        pull_image_to_cache(uri, tmp_path, retries=2)
+    error.match(str(status))
+    # Client errors other than Too Many Requests are not retried.
+    assert len(image_server.requests) == requests
+    assert not list(tmp_path.glob("*.sif*tmp"))
+
+
+def test_pull_image_to_cache_file(tmp_path):
+    source = tmp_path / "other site" / "debian.sif"
+    source.parent.mkdir()
+    source.write_text("debian")
+    uri = "file://" + str(source).replace(" ", "%20")
+    image = pull_image_to_cache(uri, tmp_path / "cache", "no_singularity")
+    assert image.read_text() == "debian"
+    assert source.exists()
+    with pytest.raises(ValueError):
+        fetch_file("file://example.com/debian.sif", tmp_path / "debian.sif")
+
+
+def test_resolve_images(fake_singularity, tmp_path):
+    exe = fake_singularity(delay=0.2)
+    manifest = tmp_path / "manifest.json"
+    uris = EVICTION_URIS[:2]
+    # A longer pin is kept.
+    pull_image_to_cache(uris[1], tmp_path, str(exe))
+    pin_images(uris[1:], tmp_path)
+    images = resolve_images(uris, manifest, tmp_path, str(exe),
+                            pin_for=3600)
+    # Images are pulled at the same time.
+    (_, start, end), = read_pull_log(exe)[1:]
+    assert end - start < 0.4
+    assert json.loads(manifest.read_text())["images"] == images
+    assert list(images) == uris
+    with CacheIndex(tmp_path) as index:
+        for uri in uris:
+            entry = index.get(uri)
+            assert images[uri] == {
+                "path": str(tmp_path / entry["path"]),
+                "digest": entry["digest"]}
+        assert index.get(uris[0])["pinned_until"] == pytest.approx(
+            time.time() + 3600, abs=10)
+        assert index.get(uris[1])["pinned_until"] == float("inf")
+    assert evict_images(tmp_path, 0, min_age=0) == []
+    assert list(lookup_images(reversed(uris), manifest).items()) == [
+        (uri, Path(images[uri]["path"])) for uri in reversed(uris)]
+    with pytest.raises(ValueError) as error:
+        lookup_images(EVICTION_URIS[2:], manifest)
+    error.match("Image is not in the manifest")
+
+
+def test_resolve_and_lookup_commands(fake_singularity, tmp_path, capsys):
+    exe = fake_singularity()
+    manifest = str(tmp_path / "manifest.json")
+    sys.argv = ["spc", "resolve", "--manifest", manifest, "-s", str(exe),
+                "-d", str(tmp_path / "cache"), "--pin-for", "0"] + \
+        EVICTION_URIS
+    main()
+    resolved = capsys.readouterr().out
+    images = lookup_images(EVICTION_URIS, Path(manifest))
+    assert resolved.splitlines() == [
+        "{0}\t{1}".format(uri, path) for uri, path in images.items()]
+    with CacheIndex(tmp_path / "cache") as index:
+        assert all(entry["pinned_until"] is None
+                   for entry in index.entries())
+    # Lookups are answered by the cli module, unless they fail.
+    for lookup_main in (main, cli.main):
+        sys.argv = ["spc", "lookup", "--manifest", manifest,
+                    EVICTION_URIS[0]]
+        lookup_main()
+        assert capsys.readouterr().out == str(images[EVICTION_URIS[0]])
+        sys.argv = ["spc", "lookup", "--manifest=" + manifest] + \
+            EVICTION_URIS
+        lookup_main()
+        assert capsys.readouterr().out == resolved
+    sys.argv = ["spc", "lookup", "--manifest", manifest, "docker://debian:10"]
+    with pytest.raises(SystemExit) as error:
+        cli.main()
+    error.match("Image is not in the manifest")
+
+
+def test_singularity_command_streams_output(caplog):
+    caplog.set_level(0)
+    result = singularity_command(
+        sys.executable, "-c",
+        "import sys\n"
+        "print('Getting image source signatures', flush=True)\n"
+        "sys.stderr.write('Copying blob 1%\\rCopying blob 100%\\n')\n")
+    assert result.returncode == 0
+    assert "Copying blob 100%" in caplog.messages[-1]
+    assert result.stdout.splitlines() == [
+        "Getting image source signatures", "Copying blob 1%",
+        "Copying blob 100%"]
+
+
+def test_singularity_command_output_is_bounded():
+    result = singularity_command(
+        sys.executable, "-c",
+        "print('\\n'.join(str(i) for i in range(1000)))\n"
+        "print('#' * 100000)")
+    lines = result.stdout.splitlines()
+    assert len(lines) == 100
+    assert max(len(line) for line in lines) == 4096
+
+
+def test_singularity_command_fails():
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        singularity_command(
+            sys.executable, "-c",
+            "import sys; sys.exit('FATAL: Unable to pull image')")
+    assert error.value.returncode == 1
+    assert "FATAL: Unable to pull image" in error.value.output
+
+
+def test_metrics(fake_singularity, tmp_path):
+    exe = fake_singularity(delay=0.2)
+    metrics = tmp_path / "metrics.jsonl"
+    uri = "docker://debian:buster-slim"
+    for _ in range(2):
+        pull_image_to_cache(uri, tmp_path / "cache", str(exe),
+                            metrics=str(metrics))
+    miss, hit = [json.loads(line)
+                 for line in metrics.read_text().splitlines()]
+    assert miss["uri"] == uri
+    assert miss["hit"] is False
+    assert miss["pull_duration"] >= 0.2
+    assert miss["duration"] >= miss["pull_duration"]
+    assert miss["bytes"] == len(uri)
+    assert miss["pid"] == os.getpid()
+    assert hit["hit"] is True
+    assert hit["pull_duration"] is None
+    assert hit["bytes"] == 0
+
+
+def test_metrics_error(tmp_path, monkeypatch):
+    metrics = tmp_path / "metrics.jsonl"
+    monkeypatch.setenv("SINGULARITY_PERMANENTCACHE_METRICS", str(metrics))
+    with pytest.raises(FileNotFoundError):
+        pull_image_to_cache("docker://debian:buster-slim", tmp_path,
+                            str(tmp_path / "no_singularity"))
+    record = json.loads(metrics.read_text())
+    assert record["error"].startswith("FileNotFoundError")
+    assert record["lock_wait"] >= 0
+
+
+@pytest.fixture()
+def cache_server(tmp_path):
+    """Returns a function that starts a cache server in a thread."""
+    servers = []
+
+    def start_cache_server(singularity_exe: Path) -> CacheServer:
+        server = CacheServer(tmp_path / "spc.sock", tmp_path / "cache",
+                             str(singularity_exe))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start_cache_server
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_cache_server_single_pull(fake_singularity, cache_server):
+    exe = fake_singularity(delay=0.5)
+    server = cache_server(exe)
+    uri = "docker://debian:buster-slim"
+    with multiprocessing.pool.ThreadPool(5) as pool:
+        images = pool.map(lambda _: request_image(uri, server.socket_path),
+                          range(5))
+    assert len(set(images)) == 1
+    assert images[0] == Path(server.cache, uri_to_filename(uri) + ".sif")
+    assert images[0].read_text() == uri
+    # All requests were served by one pull.
+    assert len(read_pull_log(exe)) == 1
+
+
+def test_cache_server_preloaded(fake_singularity, cache_server, tmp_path,
+                                monkeypatch):
+    uri = "docker://debian:buster-slim"
+    image = pull_image_to_cache(uri, tmp_path / "cache",
+                                str(fake_singularity()))
+    with CacheIndex(tmp_path / "cache") as index:
+        index.connection.execute("UPDATE images SET accessed = 0")
+    server = cache_server(tmp_path / "no_singularity")
+    module = singularity_permanent_cache.singularity_permanent_cache
+
+    def no_pull(*args, **kwargs):
+        raise AssertionError("Images in the cache are not pulled.")
+    monkeypatch.setattr(module, "pull_image_to_cache", no_pull)
+    assert request_image(uri, server.socket_path) == image
+    # The access is recorded in the background.
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        with CacheIndex(tmp_path / "cache") as index:
+            if index.get(uri)["accessed"] > 0:
+                break
+        time.sleep(0.05)
+    else:
+        pytest.fail("The access was not recorded.")
+
+
+def test_cache_server_error(fake_singularity, cache_server, tmp_path):
+    server = cache_server(tmp_path / "no_singularity")
+    with pytest.raises(CacheServerError) as error:
+        request_image("docker://debian:10", server.socket_path)
+    error.match("Cache server could not provide docker://debian:10: "
+                "FileNotFoundError")
+
+
+def test_cache_server_timeout(fake_singularity, cache_server):
+    exe = fake_singularity(delay=1.0)
+    server = cache_server(exe)
+    uri = "docker://debian:buster-slim"
+    with pytest.raises(TimeoutError):
+        server.resolve(uri, timeout=0.1)
+    # The pull continues after the timeout.
+    with pytest.raises(TimeoutError):
+        request_image(uri, server.socket_path, lock_timeout=0)
+    assert server.resolve(uri, timeout=10).exists()
+    assert len(read_pull_log(exe)) == 1
+
+
+def test_cache_server_pull_options(fake_singularity, cache_server):
+    exe = fake_singularity()
+    server = cache_server(exe)
+    for uri in EVICTION_URIS[:2]:
+        request_image(uri, server.socket_path)
+    with CacheIndex(server.cache) as index:
+        index.connection.execute("UPDATE images SET accessed = 0")
+    # The server evicts images with the maximum size of the request.
+    image = request_image(EVICTION_URIS[2], server.socket_path, max_size=0)
+    assert image.exists()
+    assert [path.name for path in server.cache.glob("*.sif")] == [image.name]
+    # Checked hits are not served from memory.
+    with image.open("a") as image_h:
+        image_h.write("corrupt")
+    image = request_image(EVICTION_URIS[2], server.socket_path,
+                          check_hits=True)
+    assert image.read_text() == EVICTION_URIS[2]
+    assert len(read_pull_log(exe)) == 4
+
+
+def test_cache_server_socket_mode(fake_singularity, cache_server):
+    server = cache_server(fake_singularity())
+    assert server.socket_path.stat().st_mode & 0o777 == 0o600
+
+
+def test_request_image_other_user(fake_singularity, cache_server,
+                                  monkeypatch, caplog):
+    server = cache_server(fake_singularity())
+    uri = "docker://debian:buster-slim"
+    module = singularity_permanent_cache.singularity_permanent_cache
+    # The socket is owned by someone else.
+    monkeypatch.setattr(module.os, "getuid", lambda: os.geteuid() + 1)
+    assert request_image(uri, server.socket_path) is None
+    assert "it is not a socket of this user" in caplog.text
+    monkeypatch.undo()
+    # The socket was replaced by one of a server of someone else.
+    monkeypatch.setattr(module, "_peer_uid", lambda client: os.getuid() + 1)
+    assert request_image(uri, server.socket_path) is None
+    assert "it is run by another user" in caplog.text
+    assert not read_pull_log(fake_singularity())
+
+
+def test_request_image_not_a_socket(tmp_path, caplog):
+    (tmp_path / "spc.sock").write_text("")
+    assert request_image("docker://debian:10", tmp_path / "spc.sock") is None
+    assert "it is not a socket of this user" in caplog.text
+
+
+def test_default_socket_path(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    socket_path = default_socket_path(tmp_path / "cache")
+    assert socket_path.parent == tmp_path / "spc-{0}".format(os.getuid())
+    module = singularity_permanent_cache.singularity_permanent_cache
+    module._make_private_dir(socket_path.parent)
+    assert socket_path.parent.stat().st_mode & 0o777 == 0o700
+    # Other users could replace the sockets in a dir that is not private.
+    socket_path.parent.chmod(0o777)
+    with pytest.raises(PermissionError):
+        module._make_private_dir(socket_path.parent)
+
+
+def test_request_image_no_server(tmp_path):
+    assert request_image("docker://debian:10", tmp_path / "spc.sock") is None
+    # A socket that is left behind by a server that stopped.
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server_socket:
+        server_socket.bind(str(tmp_path / "spc.sock"))
+    assert request_image("docker://debian:10", tmp_path / "spc.sock") is None
+
+
+def test_main_uses_cache_server(fake_singularity, cache_server, capsys):
+    server_exe = fake_singularity()
+    server = cache_server(server_exe)
+    uri = "docker://debian:buster-slim"
+    # The client is given a singularity that does not exist, so it can
+    # only get the image from the server.
+    sys.argv = ["spc", "-d", str(server.cache), "--socket",
+                str(server.socket_path), "-s", "no_singularity", uri]
+    main()
+    assert capsys.readouterr().out == str(
+        Path(server.cache, uri_to_filename(uri) + ".sif"))
+    sys.argv = ["spc", "-d", str(server.cache), "--socket",
+                str(server.socket_path), "-s", "no_singularity", uri,
+                "docker://ubuntu:20.04"]
+    main()
+    assert len(capsys.readouterr().out.splitlines()) == 2
+    assert len(read_pull_log(server_exe)) == 2
+
+
+def test_main_cache_server_error(cache_server, tmp_path, caplog):
+    server = cache_server(tmp_path / "no_singularity")
+    # The client would fail differently if it pulled the image itself.
+    sys.argv = ["spc", "-d", str(server.cache), "--socket",
+                str(server.socket_path), "-s", "no_singularity",
+                "docker://debian:10"]
+    with pytest.raises(SystemExit) as error:
+        main()
+    assert error.value.code == 1
+    assert "Cache server could not provide docker://debian:10" in caplog.text
+
+
+def test_main_cache_server_timeout(fake_singularity, cache_server):
+    server = cache_server(fake_singularity(delay=1.0))
+    sys.argv = ["spc", "-d", str(server.cache), "--socket",
+                str(server.socket_path), "-s", "no_singularity",
+                "--lock-timeout", "0", "docker://debian:10",
+                "docker://ubuntu:20.04"]
+    with pytest.raises(SystemExit) as error:
+        main()
+    assert error.value.code == os.EX_TEMPFAIL
+
+
+def run_async(coroutine):
+    loop = asyncio.new_event_loop()
+    # Attaches the child watcher, which Python < 3.8 needs for subprocesses.
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def test_pull_image_to_cache_async_shares_pull(fake_singularity, tmp_path):
+    exe = fake_singularity(delay=0.5)
+    uri = "docker://debian:buster-slim"
+    metrics = tmp_path / "metrics.jsonl"
+
+    async def pull():
+        pulls = [asyncio.ensure_future(pull_image_to_cache_async(
+            uri, tmp_path, str(exe), metrics=str(metrics)))
+            for _ in range(3)]
+        await asyncio.sleep(0.1)
+        # Cancelling one call does not cancel the pull for the others.
+        pulls[0].cancel()
+        return await asyncio.gather(*pulls[1:])
+
+    image, other_image = run_async(pull())
+    assert image == other_image == Path(tmp_path,
+                                        uri_to_filename(uri) + ".sif")
+    assert image.read_text() == uri
+    assert len(read_pull_log(exe)) == 1
+    assert len(metrics.read_text().splitlines()) == 1
+    assert run_async(pull_image_to_cache_async(uri, tmp_path,
+                                               str(exe))) == image
+    assert len(read_pull_log(exe)) == 1
+
+
+@pytest.mark.parametrize("lock_backend", ["flock", "lockf", "lease"])
+def test_pull_image_to_cache_async_does_not_block_loop(fake_singularity,
+                                                       tmp_path,
+                                                       lock_backend):
+    exe = fake_singularity()
+    uri = "docker://debian:buster-slim"
+    lockfile = str(tmp_path / (uri_to_filename(uri) + ".sif.lock"))
+
+    async def pull_while_locked():
+        with get_lock_backend(lock_backend)(lockfile, uri=uri):
+            with pytest.raises(LockTimeoutError):
+                await pull_image_to_cache_async(uri, tmp_path, str(exe),
+                                                lock_backend,
+                                                lock_timeout=0.1)
+            pull = asyncio.ensure_future(pull_image_to_cache_async(
+                uri, tmp_path, str(exe), lock_backend))
+            ticks = 0
+            for _ in range(10):
+                await asyncio.sleep(0.02)
+                ticks += 1
+            assert not pull.done()
+        return await pull, ticks
+
+    image, ticks = run_async(pull_while_locked())
+    assert ticks == 10
+    assert image.read_text() == uri
+
+
+def test_pull_images_to_cache_async(fake_singularity, flaky_singularity,
+                                    tmp_path):
+    exe = fake_singularity(delay=1.0)
+    uris = ["docker://debian:buster-slim", "docker://ubuntu:20.04",
+            "docker://debian:buster-slim"]
+    images = run_async(pull_images_to_cache_async(uris, tmp_path / "cache",
+                                                  str(exe), jobs=2))
+    assert list(images) == uris[:2]
+    for uri, image in images.items():
+        assert image.read_text() == uri
+    (_, start1, end1), (_, start2, end2) = read_pull_log(exe)
+    assert start1 < end2 and start2 < end1
+    # Failed pulls are retried.
+    make_flaky_singularity, attempts = flaky_singularity
+    images = run_async(pull_images_to_cache_async(
+        ["docker://alpine:3"], tmp_path / "cache",
+        str(make_flaky_singularity(1)), retries=1))
+    assert images["docker://alpine:3"].read_text() == "docker://alpine:3"
+    assert attempts() == 2
+
+
+def test_pull_image_to_cache_async_tiers(fake_singularity, tmp_path):
+    exe = fake_singularity()
+    uri = "docker://debian:buster-slim"
+    tiers = [tmp_path / "local", tmp_path / "shared"]
+    image = run_async(pull_image_to_cache_async(uri, tiers, str(exe)))
+    assert image == Path(tiers[0], uri_to_filename(uri) + ".sif")
+    assert Path(tiers[1], image.name).read_text() == uri
+    assert len(read_pull_log(exe)) == 1
+
+
+def test_singularity_command_async(caplog):
+    caplog.set_level(0)
+    result = run_async(singularity_command_async(
+        sys.executable, "-c",
+        "import sys\n"
+        "print('Getting image source signatures', flush=True)\n"
+        "sys.stderr.write('Copying blob 1%\\rCopying blob 100%\\n')\n"))
+    assert result.returncode == 0
+    assert "Copying blob 100%" in caplog.messages[-1]
+    assert result.stdout.splitlines() == [
+        "Getting image source signatures", "Copying blob 1%",
+        "Copying blob 100%"]
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        run_async(singularity_command_async(
+            sys.executable, "-c",
+            "import sys; sys.exit('FATAL: Unable to pull image')"))
+    assert "FATAL: Unable to pull image" in error.value.output
+
+
+def test_benchmark(tmp_path):
+    benchmark = Path(__file__).parent.parent / "benchmarks" / "benchmark.py"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [str(Path(cli.__file__).parent.parent)] +
+        [path for path in [os.environ.get("PYTHONPATH")] if path]))
+    arguments = [sys.executable, str(benchmark), "--processes", "1,4",
+                 "--entries", "0,10", "--hits", "2", "--images", "2",
+                 "--delay", "0", "--size", "1K", "--dir", str(tmp_path)]
+    results = tmp_path / "results.json"
+    subprocess.run(arguments + ["-o", str(results)], env=env, check=True,
+                   stderr=subprocess.DEVNULL)
+    report = json.loads(results.read_text())
+    assert [(result["scenario"], result["entries"], result["processes"])
+            for result in report["results"]] == [
+        (scenario, entries, processes) for entries in (0, 10)
+        for processes in (1, 4) for scenario in ("hit", "miss")]
+    for result in report["results"]:
+        assert result["latency"]["count"] == 2 * result["processes"]
+        if result["scenario"] == "miss":
+            assert result["duplicate_pulls"] == 0
+        else:
+            assert result["misses"] == 0
+            assert (result["locked_latency"]["count"] ==
+                    2 * result["processes"])
+    # A run that is much slower than the baseline fails.
+    for result in report["results"]:
+        result["wall_time"] = 0
+        result["latency"]["p50"] = 0
+    results.write_text(json.dumps(report))
+    assert subprocess.run(arguments + ["--baseline", str(results)], env=env,
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL).returncode == 1
+
+
+# Command line entry point
+def test_cli_copies_are_the_same(monkeypatch):
+    module = singularity_permanent_cache.singularity_permanent_cache
+    assert cli.COMMANDS == module.COMMANDS
+    assert cli.INDEX_FILE == module.INDEX_FILE
+    assert cli.ACCESS_TIME_RESOLUTION == module.ACCESS_TIME_RESOLUTION
+    for value in ("", "0", "1", "yes", "TRUE", "off"):
+        monkeypatch.setenv("SINGULARITY_PERMANENTCACHE_CHECK_HITS", value)
+        assert cli.check_hits_from_env() == module.get_check_hits_from_env()
+    assert cli.FILENAME_SAFE_CHARACTERS == module.FILENAME_SAFE_CHARACTERS
+    assert cli.MAX_FILENAME_LENGTH == module.MAX_FILENAME_LENGTH
+    for uri, _ in URIS:
+        assert cli.uri_to_filename(uri) == uri_to_filename(uri)
+
+
+@pytest.mark.parametrize("path", ["cache", "cache/", "./cache", "/cache",
+                                  "//cache", "///cache", "a//b/./c", "../a",
+                                  "", "."])
+def test_cli_normalize_path(path):
+    assert cli.normalize_path(path) == str(Path(path))
+
+
+@pytest.mark.parametrize(["argv", "result"], [
+    (["docker://debian:10"], ("docker://debian:10", None)),
+    (["-d", "cache", "-s", "sing", "docker://debian:10"],
+     ("docker://debian:10", "cache")),
+    (["--cache-dir=cache", "docker://debian:10"],
+     ("docker://debian:10", "cache")),
+    (["--lock-timeout", "0", "docker://debian:10"],
+     ("docker://debian:10", None)),
+    (["--lock-timeout", "soon", "docker://debian:10"], None),
+    (["--retries", "3", "docker://debian:10"], ("docker://debian:10", None)),
+    (["-d", "local", "-d", "shared", "docker://debian:10"],
+     ("docker://debian:10", "local")),
+    ([], None),
+    (["list"], None),
+    (["-d", "cache", "list"], None),
+    (["-d"], None),
+    (["-v", "docker://debian:10"], None),
+    (["docker://debian:10", "docker://ubuntu:20.04"], None),
+])
+def test_cli_parse_hit_arguments(argv, result):
+    assert cli.parse_hit_arguments(argv) == result
+
+
+def test_cli_main(fake_singularity, tmp_path, capsys):
+    exe = fake_singularity()
+    uri = "docker://debian:buster-slim"
+    sys.argv = ["spc", "-d", str(tmp_path / "cache"), "-s", str(exe), uri]
+    # A miss is handled by the main function of the package.
+    cli.main()
+    image = capsys.readouterr().out
+    assert image == str(tmp_path / "cache" / (uri_to_filename(uri) + ".sif"))
+    assert cli.cache_hit(uri, str(tmp_path / "cache")) == image
+    cli.main()
+    assert capsys.readouterr().out == image
+    assert len(read_pull_log(exe)) == 1
+
+
+def test_cli_cache_hit_outdated_access_time(fake_singularity, tmp_path):
+    exe = fake_singularity()
+    uri = "docker://debian:buster-slim"
+    image = pull_image_to_cache(uri, tmp_path, str(exe))
+    with CacheIndex(tmp_path) as index:
+        index.connection.execute("UPDATE images SET accessed = 0")
+    # The full program has to update the access time.
+    assert cli.cache_hit(uri, str(tmp_path)) is None
+    assert pull_image_to_cache(uri, tmp_path, str(exe)) == image
+    assert cli.cache_hit(uri, str(tmp_path)) == str(image)
+
+
+def test_cli_cache_hit_check_hits(fake_singularity, tmp_path, monkeypatch):
+    uri = "docker://debian:buster-slim"
+    image = pull_image_to_cache(uri, tmp_path, str(fake_singularity()))
+    os.utime(str(image), (0, 0))
+    assert cli.cache_hit(uri, str(tmp_path)) == str(image)
+    monkeypatch.setenv("SINGULARITY_PERMANENTCACHE_CHECK_HITS", "1")
+    assert cli.cache_hit(uri, str(tmp_path)) is None
+
+
+@pytest.mark.parametrize(["argv", "result"], [
+    (["lookup", "--manifest", "m.json", "docker://debian:10"],
+     ("m.json", ["docker://debian:10"])),
+    (["lookup", "docker://debian:10", "--manifest=m.json",
+      "docker://ubuntu:20.04"],
+     ("m.json", ["docker://debian:10", "docker://ubuntu:20.04"])),
+    (["lookup", "docker://debian:10"], None),
+    (["lookup", "--manifest", "m.json"], None),
+    (["lookup", "--manifest"], None),
+    (["lookup", "--help"], None),
+    (["docker://debian:10"], None),
+])
+def test_cli_parse_lookup_arguments(argv, result):
+    assert cli.parse_lookup_arguments(argv) == result
+
+
+def test_cli_lookup_imports(tmp_path):
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(json.dumps({"images": {
+        "docker://debian:10": {"path": "/images/debian.sif",
+                               "digest": None}}}))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [str(Path(cli.__file__).parent.parent)] +
+        [path for path in [os.environ.get("PYTHONPATH")] if path]))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         "from singularity_permanent_cache.cli import main; main()",
+         "lookup", "--manifest", str(manifest), "docker://debian:10"],
+        env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    assert result.stdout == "/images/debian.sif"
+    imported = {line.split("|")[-1].strip()
+                for line in result.stderr.splitlines()}
+    for module in ("argparse", "logging", "sqlite3",
+                   "singularity_permanent_cache.singularity_permanent_cache"):
+        assert module not in imported
+
+
+def _startup_time(args, env, runs: int = 5) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.monotonic()
+        subprocess.run([sys.executable] + args, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        times.append(time.monotonic() - start)
+    return min(times)
+
+
+def test_cli_cache_hit_startup(fake_singularity, tmp_path):
+    """
+    Benchmark of the time it takes to run the program for a cache hit. A
+    cache hit may not import the modules that are needed to pull images,
+    and should take much less extra time than importing them.
+    """
+    uri = "docker://debian:buster-slim"
+    pull_image_to_cache(uri, tmp_path, str(fake_singularity()))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [str(Path(cli.__file__).parent.parent)] +
+        [path for path in [os.environ.get("PYTHONPATH")] if path]))
+    # The same as the scripts that pip installs for the entry points.
+    hit = ["-c", "from singularity_permanent_cache.cli import main; main()",
+           "-d", str(tmp_path), uri]
+    imports = subprocess.run(
+        [sys.executable, "-X", "importtime"] + hit, env=env, check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True).stderr
+    imported = {line.split("|")[-1].strip() for line in imports.splitlines()}
+    for module in ("argparse", "logging", "subprocess", "typing",
+                   "singularity_permanent_cache.singularity_permanent_cache"):
+        assert module not in imported
+
+    interpreter = _startup_time(["-c", "pass"], env)
+    full = _startup_time(["-c", "import singularity_permanent_cache; "
+                                "singularity_permanent_cache.main"], env)
+    cache_hit = _startup_time(hit, env)
+    assert cache_hit - interpreter < (full - interpreter) / 2, (
+        "Startup time. Interpreter: {0:.1f} ms. Cache hit: {1:.1f} ms. "
+        "Importing everything: {2:.1f} ms.".format(
+            interpreter * 1e3, cache_hit * 1e3, full * 1e3))